@@ -4,80 +4,101 @@
 import argparse
 import json
 import logging
+import os
 import pickle
 import re
 from collections import Counter, defaultdict
 
 import torch
 
-from pyrocov.fasta import NextcladeDB
+from pyrocov.columnar import load_columns
+from pyrocov.fasta import MUTATION_COLUMNS, NextcladeDB
+from pyrocov.gisaid import iter_feed, load_index, read_sequences
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
 
 
-def count_mutations(mutation_counts, status_counts, row):
-    # Check whether row is valid
-    status = row["qc.overallStatus"]
-    status_counts[status] += 1
-    if status != "good":
-        return
-    mutation_counts[None] += 1  # hack to count number of lineages
-    for col in ["aaSubstitutions", "aaDeletions"]:
-        ms = row[col]
-        if not ms:
+def count_mutations(mutation_counts, status_counts, columns):
+    # Check whether each row is valid.
+    status_counts.update(columns["qc.overallStatus"])
+    for i, status in enumerate(columns["qc.overallStatus"]):
+        if status != "good":
             continue
-        ms = ms.split(",")
-        mutation_counts.update(ms)
-        # Add within-gene pairs of mutations.
-        by_gene = defaultdict(list)
-        for m in ms:
-            g, m = m.split(":")
-            by_gene[g].append(m)
-        for g, ms in by_gene.items():
-            # Sort by position, then alphabetical.
-            ms.sort(key=lambda m: (int(re.search(r"\d+", m).group(0)), m))
-            for i, m1 in enumerate(ms):
-                for m2 in ms[i + 1 :]:
-                    mutation_counts[f"{g}:{m1},{m2}"] += 1
-
-
-def main(args):
-    # Load the filtered accession ids.
-    logger.info(f"Loading {args.columns_file_in}")
-    with open(args.columns_file_in, "rb") as f:
-        columns = pickle.load(f)
-        id_to_lineage = dict(zip(columns["accession_id"], columns["lineage"]))
-        del columns
-
-    # Count mutations via nextclade.
-    # This is batched and cached under the hood.
-    logger.info(f"Loading {args.gisaid_file_in}")
-    lineage_mutation_counts = defaultdict(Counter)
-    lineage_status_counts = defaultdict(Counter)
-    db = NextcladeDB()
-    with open(args.gisaid_file_in, "rt") as f:
-        for i, line in enumerate(f):
-            datum = json.loads(line)
-
-            # Filter to sequences with sufficient data.
-            lineage = id_to_lineage.get(datum["covv_accession_id"])
-            if lineage is None:
-                continue
-            nchars = sum(datum["sequence"].count(b) for b in "ACGT")
-            if not (args.min_nchars <= nchars <= args.max_nchars):
+        mutation_counts[None] += 1  # hack to count number of lineages
+        for col in ["aaSubstitutions", "aaDeletions"]:
+            ms = columns[col][i]
+            if not ms:
                 continue
+            ms = ms.split(",")
+            mutation_counts.update(ms)
+            # Add within-gene pairs of mutations.
+            by_gene = defaultdict(list)
+            for m in ms:
+                g, m = m.split(":")
+                by_gene[g].append(m)
+            for g, ms in by_gene.items():
+                # Sort by position, then alphabetical.
+                ms.sort(key=lambda m: (int(re.search(r"\d+", m).group(0)), m))
+                for i1, m1 in enumerate(ms):
+                    for m2 in ms[i1 + 1 :]:
+                        mutation_counts[f"{g}:{m1},{m2}"] += 1
+
+
+class Featurizer:
+    """
+    Consumer of GISAID feed lines that schedules sequences of known lineages
+    for alignment and accumulates per-lineage mutation counts.
+
+    :param args: Parsed arguments, see :func:`add_featurize_args`.
+    :param dict id_to_lineage: A mutable dict mapping accession id to lineage.
+        Rows with unknown accession ids are skipped.
+    """
+
+    def __init__(self, args, id_to_lineage):
+        self.args = args
+        self.id_to_lineage = id_to_lineage
+        self.lineage_mutation_counts = defaultdict(Counter)
+        self.lineage_status_counts = defaultdict(Counter)
+        self.db = NextcladeDB(max_workers=args.nextclade_workers)
+
+    def schedule(self, line):
+        datum = json.loads(line)
+        self.schedule_sequence(datum["covv_accession_id"], datum["sequence"])
+
+    def schedule_sequence(self, accession_id, sequence):
+        # Filter to sequences with sufficient data.
+        lineage = self.id_to_lineage.get(accession_id)
+        if lineage is None:
+            return
+        nchars = sum(sequence.count(b) for b in "ACGT")
+        if not (self.args.min_nchars <= nchars <= self.args.max_nchars):
+            return
+
+        # Schedule sequence for alignment.
+        seq = sequence.replace("\n", "")
+        mutation_counts = self.lineage_mutation_counts[lineage]
+        status_counts = self.lineage_status_counts[lineage]
+        self.db.schedule(
+            seq,
+            count_mutations,
+            mutation_counts,
+            status_counts,
+            columns=MUTATION_COLUMNS,
+            batch_key=lineage,
+        )
 
-            # Schedule sequence for alignment.
-            seq = datum["sequence"].replace("\n", "")
-            mutation_counts = lineage_mutation_counts[lineage]
-            status_counts = lineage_status_counts[lineage]
-            db.schedule(seq, count_mutations, mutation_counts, status_counts)
+    def finish(self):
+        self.db.wait(log_every=self.args.log_every)
+        save_features(
+            self.args, self.lineage_mutation_counts, self.lineage_status_counts
+        )
 
-            if i % args.log_every == 0:
-                print(".", end="", flush=True)
-    db.wait(log_every=args.log_every)
 
+def save_features(args, lineage_mutation_counts, lineage_status_counts):
+    """
+    Filters per-lineage mutation counts and saves dense features.
+    """
     message = ["Total quality:"]
     status_counts = Counter()
     for c in lineage_status_counts.values():
@@ -153,15 +174,61 @@ def main(args):
     torch.save(result, args.features_file_out)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Featurize nextclade mutations")
-    parser.add_argument("--gisaid-file-in", default="results/gisaid.json")
-    parser.add_argument("--columns-file-in", default="results/gisaid.columns.pkl")
+def main(args):
+    # Load the filtered accession ids.
+    logger.info(f"Loading {args.columns_dir_in}")
+    columns = load_columns(args.columns_dir_in, ["accession_id", "lineage"])
+    id_to_lineage = dict(zip(columns["accession_id"], columns["lineage"]))
+    del columns
+
+    # Count mutations via nextclade.
+    # This is batched and cached under the hood.
+    logger.info(f"Loading {args.gisaid_file_in}")
+    featurizer = Featurizer(args, id_to_lineage)
+    index = None
+    if not args.gisaid_file_in.endswith(".xz"):
+        index = load_index(args.index_dir_in, args.gisaid_file_in)
+        if index is None and os.path.exists(args.index_dir_in):
+            logger.info(f"Ignoring stale {args.index_dir_in}")
+    if index is not None:
+        # Seek directly to sequences of filtered rows.
+        rows = [i for i, a in enumerate(index["accession_id"]) if a in id_to_lineage]
+        ids = [index["accession_id"][i] for i in rows]
+        sequences = read_sequences(
+            args.gisaid_file_in, index["offset"][rows], index["length"][rows]
+        )
+        for i, (accession_id, sequence) in enumerate(zip(ids, sequences)):
+            featurizer.schedule_sequence(accession_id, sequence)
+            if i % args.log_every == 0:
+                print(".", end="", flush=True)
+    else:
+        for i, line in enumerate(iter_feed(args.gisaid_file_in)):
+            featurizer.schedule(line)
+            if i % args.log_every == 0:
+                print(".", end="", flush=True)
+    featurizer.finish()
+
+
+def add_featurize_args(parser):
     parser.add_argument("--features-file-out", default="results/nextclade.features.pt")
     parser.add_argument("--counts-file-out", default="results/nextclade.counts.pkl")
     parser.add_argument("--min-nchars", default=29000, type=int)
     parser.add_argument("--max-nchars", default=31000, type=int)
     parser.add_argument("--min-good-samples", default=5, type=float)
+    parser.add_argument(
+        "--nextclade-workers",
+        default=1,
+        type=int,
+        help="number of concurrent nextclade processes",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Featurize nextclade mutations")
+    parser.add_argument("--gisaid-file-in", default="results/gisaid.json.xz")
+    parser.add_argument("--columns-dir-in", default="results/gisaid.columns")
+    parser.add_argument("--index-dir-in", default="results/gisaid.index")
+    add_featurize_args(parser)
     parser.add_argument("-l", "--log-every", default=1000, type=int)
     args = parser.parse_args()
     main(args)
@@ -5,23 +5,28 @@ import argparse
 import functools
 import gc
 import logging
+import math
 import os
-import re
-from typing import Callable, Union
+from timeit import default_timer
+from typing import Callable
 
 import pyro
 import torch
 
 from pyrocov import mutrans, pangolin, sarscov2
-from pyrocov.util import torch_map
+from pyrocov.cache import ResultCache, code_version
+from pyrocov.scheduler import Scheduler
+from pyrocov.util import torch_load, torch_map
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
 
 
-def cached(filename: Union[str, Callable]):
+def cached(describe: Callable):
     """
-    Simple utiltity to cache results based on filename.
+    Simple utiltity to cache results in the content-addressed cache
+    :func:`get_cache`, where ``describe(*args, **kwargs)`` returns a
+    ``(name, config)`` pair determining the result.
     """
 
     def decorator(fn):
@@ -30,16 +35,22 @@ def cached(filename: Union[str, Callable]):
             base_args = args[0]
             if base_args.no_cache:
                 return fn(*args, **kwargs)
-            f = filename(*args, **kwargs) if callable(filename) else filename
-            if os.path.exists(f) and not base_args.force:
-                logger.info(f"loading cached {f}")
-                return torch.load(f, map_location=torch.empty(()).device)
+            name, config = describe(*args, **kwargs)
+            cache = get_cache(base_args)
+            key = cache.key(name, config)
+            if cache.lookup(key) and not base_args.force:
+                logger.info(f"loading cached {name} {key}")
+                return cache.load(key, map_location=torch.empty(()).device)
             if base_args.no_new:
-                raise ValueError(f"Missing {f}")
+                raise ValueError(f"Missing {name} {key}")
+            start_time = default_timer()
             result = fn(*args, **kwargs)
-            if not args[0].test:
-                logger.info(f"saving {f}")
-                torch.save(result, f)
+            if not base_args.test:
+                logger.info(f"saving {cache.path(key)}")
+                compute_time = default_timer() - start_time
+                cache.save(
+                    key, result, name=name, config=config, compute_time=compute_time
+                )
             return result
 
         return cached_fn
@@ -47,10 +58,66 @@ def cached(filename: Union[str, Callable]):
     return decorator
 
 
-def _safe_str(v):
-    v = str(v)
-    v = re.sub("[^A-Za-x0-9-]", "_", v)
-    return v
+def get_cache(args):
+    """
+    Returns the cache of results in ``args.cache_dir``, keyed by the GISAID
+    and nextclade inputs and the version of :mod:`pyrocov.mutrans`.
+    """
+    max_size = None
+    if args.cache_max_gb is not None:
+        max_size = int(args.cache_max_gb * 2 ** 30)
+    return ResultCache(
+        args.cache_dir,
+        inputs=["results/gisaid.columns", "results/nextclade.features.pt"],
+        version=code_version(mutrans.__file__),
+        max_size=max_size,
+    )
+
+
+def configure_torch(args):
+    torch.set_default_dtype(torch.double if args.double else torch.float)
+    if args.cuda:
+        torch.set_default_tensor_type(
+            torch.cuda.DoubleTensor if args.double else torch.cuda.FloatTensor
+        )
+    if args.debug:
+        torch.autograd.set_detect_anomaly(True)
+
+
+def _init_worker(args):
+    configure_torch(args)
+    # Split cores evenly among the args.jobs workers.
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.jobs))
+
+
+def make_scheduler(args, name):
+    """
+    Creates a scheduler running up to ``args.jobs`` tasks at a time in worker
+    processes, saving task status to ``results/mutrans.{name}.status.json``.
+    """
+    status_file = None
+    if not args.test and not args.no_cache:
+        status_file = f"results/mutrans.{name}.status.json"
+    max_memory = math.inf if args.max_memory is None else args.max_memory * 2 ** 30
+    return Scheduler(
+        jobs=args.jobs,
+        max_memory=max_memory,
+        status_file=status_file,
+        resume=not args.force,
+        initializer=_init_worker,
+        initargs=(args,),
+        load=functools.partial(torch_load, map_location=torch.empty(()).device),
+    )
+
+
+def fit_memory(args, dataset, *_, **__):
+    """
+    Roughly estimates peak memory in bytes of a single fit to ``dataset``.
+    """
+    T, P, S = dataset["weekly_strains"].shape
+    itemsize = 8 if args.double else 4
+    # SVI holds about a dozen [T,P,S] tensors, and predict() chunks ~5e7 values.
+    return itemsize * (12 * T * P * S + 5e7)
 
 
 def holdout_to_hashable(holdout):
@@ -61,35 +128,98 @@ def hashable_to_holdout(holdout):
     return {k: dict(v) for k, v in holdout}
 
 
-def _load_data_filename(args, **kwargs):
-    parts = ["data", "double" if args.double else "single"]
-    for k, v in sorted(kwargs.get("include", {}).items()):
-        parts.append(f"I{k}={_safe_str(v)}")
-    for k, v in sorted(kwargs.get("exclude", {}).items()):
-        parts.append(f"E{k}={_safe_str(v)}")
-    parts.append(str(kwargs.get("end_day")))
-    return "results/mutrans.{}.pt".format(".".join(parts))
+def _load_daily_key(args, **kwargs):
+    include = sorted(kwargs.get("include", {}).items())
+    exclude = sorted(kwargs.get("exclude", {}).items())
+    return "daily", (args.double, include, exclude)
 
 
-@cached(_load_data_filename)
-def load_data(args, **kwargs):
+@cached(_load_daily_key)
+def load_daily(args, **kwargs):
     """
-    Cached wrapper to load GISAID data.
+    Cached wrapper to load daily GISAID data.
     """
-    return mutrans.load_gisaid_data(device=args.device, **kwargs)
+    return mutrans.load_gisaid_daily(device=args.device, **kwargs)
 
 
-def _fit_filename(name, *args):
-    strs = [name]
-    for arg in args[2:]:
-        if isinstance(arg, tuple):
-            strs.append("-".join(f"{k}={_safe_str(v)}" for k, v in arg))
-        else:
-            strs.append(str(arg))
-    return "results/mutrans.{}.pt".format(".".join(strs))
+def load_data(args, *, end_day=None, **kwargs):
+    """
+    Loads GISAID data binned by ``args.timestep`` and truncated to
+    ``end_day``, derived from cached daily data.
+    """
+    daily = load_daily(args, **kwargs)
+    dataset = mutrans.rebin_gisaid_data(daily, timestep=args.timestep, end_day=end_day)
+    if end_day is None and not any(kwargs.values()):
+        save_legacy_data(args, dataset)
+    return dataset
+
+
+def save_legacy_data(args, dataset):
+    """
+    Saves the full dataset to ``results/mutrans.data.single.None.pt``, which
+    is read by notebooks.
+    """
+    if args.test or args.timestep != mutrans.TIMESTEP:
+        return
+    precision = "double" if args.double else "single"
+    filename = f"results/mutrans.data.{precision}.None.pt"
+    if os.path.exists(filename) and not args.force:
+        return
+    logger.info(f"saving {filename}")
+    temp = f"{filename}.{os.getpid()}.temp"
+    torch.save(dataset, temp)
+    os.replace(temp, filename)
+
+
+def _cache_filename(name, args, *config):
+    """
+    Returns the filename a cached task saves its result to, or None if not
+    cached.
+    """
+    if args.test or args.no_cache:
+        return None
+    cache = get_cache(args)
+    return cache.path(cache.key(*_fit_key(name, args, None, *config)))
+
+
+def _fit_key(name, *args):
+    """
+    Returns the name and config determining a fit, including any settings in
+    ``args`` that affect results.
+    """
+    settings = (
+        ("timestep", args[0].timestep),
+        ("place_subsample_size", args[0].place_subsample_size),
+        ("converge_window", args[0].converge_window),
+        ("converge_rtol", args[0].converge_rtol),
+        ("converge_param_rtol", args[0].converge_param_rtol),
+        ("converge_patience", args[0].converge_patience),
+        ("forecast_samples", args[0].forecast_samples),
+        ("num_samples", args[0].num_samples),
+        ("seed", args[0].seed),
+        ("double", args[0].double),
+    )
+    return name, (args[2:], settings)
 
 
-@cached(lambda *args: _fit_filename("svi", *args))
+def _fit_svi_key(*args, warm_start=None, warm_configs=()):
+    if warm_start is None:
+        return _fit_key("svi", *args)
+    # A warm started fit depends on the chain of fits preceding it.
+    return _fit_key("svi.warm", *args, warm_configs)
+
+
+def _fit_filename(name, *args, **kwargs):
+    """
+    Returns a filename for auxiliary output of :func:`fit_svi`, such as a
+    checkpoint, named by the key under which its result is cached.
+    """
+    cache = get_cache(args[0])
+    key = cache.key(*_fit_svi_key(*args, **kwargs))
+    return f"results/mutrans.{key}.{name}"
+
+
+@cached(_fit_svi_key)
 def fit_svi(
     args,
     dataset,
@@ -104,10 +234,29 @@ def fit_svi(
     f=6,
     end_day=None,
     holdout=(),
+    *,
+    warm_start=None,
+    warm_configs=(),
 ):
     """
-    Cached wrapper to fit a model via SVI.
+    Cached wrapper to fit a model via SVI, optionally warm started from a
+    previous result, where ``warm_configs`` is the tuple of configs of the
+    chain of fits preceding this fit.
     """
+    config = (cond_data, model_type, guide_type, n, lr, lrd, cn, r, f, end_day, holdout)
+    key_kwargs = dict(warm_start=warm_start, warm_configs=warm_configs)
+    checkpoint = None
+    if args.checkpoint_every and not args.test:
+        checkpoint = _fit_filename(
+            "checkpoint.pt", args, dataset, *config, **key_kwargs
+        )
+    telemetry_file = None
+    if args.telemetry and not args.test:
+        telemetry_file = _fit_filename(
+            "telemetry.jsonl", args, dataset, *config, **key_kwargs
+        )
+        if os.path.exists(telemetry_file) and not args.resume:
+            os.remove(telemetry_file)
     cond_data = [kv.split("=") for kv in cond_data.split(",") if kv]
     cond_data = {k: float(v) for k, v in cond_data}
     holdout = hashable_to_holdout(holdout)
@@ -127,6 +276,18 @@ def fit_svi(
         seed=args.seed,
         jit=args.jit,
         num_samples=args.num_samples,
+        place_subsample_size=args.place_subsample_size,
+        converge_window=args.converge_window,
+        converge_rtol=args.converge_rtol,
+        converge_param_rtol=args.converge_param_rtol,
+        converge_patience=args.converge_patience,
+        checkpoint=checkpoint,
+        checkpoint_every=args.checkpoint_every,
+        resume=args.resume,
+        warm_start=warm_start,
+        telemetry_every=args.telemetry_every,
+        telemetry_file=telemetry_file,
+        forecast_samples=args.forecast_samples,
     )
 
     if "lineage" in holdout.get("exclude", {}):
@@ -142,17 +303,272 @@ def fit_svi(
     return result
 
 
+def fit_svi_batch(args, dataset, clades, configs):
+    """
+    Fits a batch of leave-one-out models in a single vectorized SVI run, where
+    each fit ignores the strains in its clade. Results are cached per config,
+    interchangeably with :func:`fit_svi`.
+    """
+    results = {}
+    todo = []
+    cache = None if args.no_cache else get_cache(args)
+    for clade, config in zip(clades, configs):
+        key = (
+            None
+            if cache is None
+            else cache.key(*_fit_key("svi", args, dataset, *config))
+        )
+        if key is not None and cache.lookup(key) and not args.force:
+            logger.info(f"loading cached svi {key}")
+            results[config] = cache.load(key, map_location=torch.empty(()).device)
+        elif args.no_new:
+            raise ValueError(f"Missing svi {key}")
+        else:
+            todo.append((clade, config))
+    if not todo:
+        return results
+    start_time = default_timer()
+
+    # All configs share a dataset and differ only in holdout.
+    cond_data, model_type, guide_type, n, lr, lrd, cn, r, f = todo[0][1][:9]
+    assert all(config[:-1] == todo[0][1][:-1] for _, config in todo)
+    cond_data = [kv.split("=") for kv in cond_data.split(",") if kv]
+    cond_data = {k: float(v) for k, v in cond_data}
+    strain_mask = torch.ones(
+        len(todo), dataset["weekly_strains"].size(-1), dtype=torch.bool
+    )
+    for k, (clade, _) in enumerate(todo):
+        strain_mask[k, clade] = False
+    batch_dataset = dataset.copy()
+    batch_dataset["strain_mask"] = strain_mask.to(dataset["weekly_strains"].device)
+
+    result = mutrans.fit_svi(
+        batch_dataset,
+        cond_data=cond_data,
+        model_type=model_type,
+        guide_type=guide_type,
+        num_steps=n,
+        learning_rate=lr,
+        learning_rate_decay=lrd,
+        clip_norm=cn,
+        rank=r,
+        forecast_steps=f,
+        log_every=args.log_every,
+        seed=args.seed,
+        jit=args.jit,
+        num_samples=args.num_samples,
+        place_subsample_size=args.place_subsample_size,
+        converge_window=args.converge_window,
+        converge_rtol=args.converge_rtol,
+        converge_param_rtol=args.converge_param_rtol,
+        converge_patience=args.converge_patience,
+        telemetry_every=args.telemetry_every,
+    )
+
+    # Split into per-config results.
+    compute_time = (default_timer() - start_time) / len(todo)
+    for k, (_, config) in enumerate(todo):
+        results[config] = {
+            "median": {
+                "coef": result["median"]["coef"][k].reshape(-1).float(),  # [F]
+                "rate_loc": result["median"]["rate_loc"][k].reshape(-1).float(),
+            },
+            "args": args,
+        }
+        if cache is not None and not args.test:
+            name, key_config = _fit_key("svi", args, dataset, *config)
+            key = cache.key(name, key_config)
+            logger.info(f"saving {cache.path(key)}")
+            cache.save(
+                key,
+                results[config],
+                name=name,
+                config=key_config,
+                compute_time=compute_time,
+            )
+    return results
+
+
+def load_config_data(args, config):
+    """
+    Loads the dataset of a config.
+    """
+    # Holdout is the last in the config
+    holdout = hashable_to_holdout(config[-1])
+    # end_day is second from last
+    end_day = config[-2]
+    return load_data(args, end_day=end_day, **holdout)
+
+
+def add_config_data(scheduler, args, config):
+    """
+    Adds a task loading the dataset of a config, shared among configs.
+    """
+    name = f"data:{config[-2]}:{config[-1]}"
+    return scheduler.add(name, load_config_data, args, config, local=True)
+
+
+def fit_config(args, dataset, config, *, warm_start=None, warm_configs=()):
+    """
+    Fits a single config and collects results on cpu.
+    """
+    logger.info(f"Config: {config}")
+
+    # Run SVI
+    result = fit_svi(
+        args, dataset, *config, warm_start=warm_start, warm_configs=warm_configs
+    )
+    mutrans.log_stats(dataset, result)
+
+    # Save the results for this config
+
+    # Augment gisaid dataset with JHU timeseries counts
+    dataset = dataset.copy()
+    dataset.update(mutrans.load_jhu_data(dataset))
+
+    # Generate results
+    result["mutations"] = dataset["mutations"]
+    result["weekly_strains"] = dataset["weekly_strains"]
+    result["weekly_cases"] = dataset["weekly_cases"]
+    result["weekly_strains_shape"] = tuple(dataset["weekly_strains"].shape)
+    result["location_id"] = dataset["location_id"]
+    result["lineage_id_inv"] = dataset["lineage_id_inv"]
+
+    result = torch_map(result, device="cpu", dtype=torch.float)  # to save space
+
+    # Ensure number of regions match
+    assert dataset["weekly_strains"].shape[1] == result["mean"]["probs"].shape[1]
+    assert dataset["weekly_cases"].shape[1] == result["mean"]["probs"].shape[1]
+    if args.forecast_samples:
+        # Probs are served lazily by mutrans.Forecast from rate/init samples.
+        for stats in ("mean", "std", "median"):
+            result[stats].pop("probs", None)
+
+    # Cleanup
+    del dataset
+    pyro.clear_param_store()
+    gc.collect()
+    return result
+
+
+def fit_configs(args, configs, name="mutrans", *, warm_start=False):
+    """
+    Fits a list of configs, in parallel unless ``warm_start``, in which case
+    each fit is warm started from the previous fit. Returns a dict mapping
+    config to result.
+    """
+    scheduler = make_scheduler(args, name)
+    refs = []
+    prev_result = None
+    for i, config in enumerate(configs):
+        dataset = add_config_data(scheduler, args, config)
+        if warm_start and i:
+            # Warm start from the previous fit, which must finish first.
+            kwargs = {"warm_start": prev_result, "warm_configs": tuple(configs[:i])}
+        else:
+            kwargs = {}
+        prev_result = scheduler.add(
+            f"fit:{config}",
+            fit_config,
+            args,
+            dataset,
+            config,
+            memory=fit_memory,
+            **kwargs,
+        )
+        refs.append(prev_result)
+    return dict(zip(configs, scheduler.run(refs)))
+
+
+def fit_holdouts(args, configs, name):
+    """
+    Fits a list of configs, returning a dict mapping holdout to stats.
+    """
+    scheduler = make_scheduler(args, name)
+    refs = []
+    for config in configs:
+        dataset = add_config_data(scheduler, args, config)
+        refs.append(
+            scheduler.add(
+                f"stats:{config}",
+                fit_holdout,
+                args,
+                dataset,
+                *config,
+                memory=fit_memory,
+                filename=_cache_filename("stats", args, *config),
+            )
+        )
+    return {config[-1]: stats for config, stats in zip(configs, scheduler.run(refs))}
+
+
+@cached(lambda *args: _fit_key("stats", *args))
+def fit_holdout(args, dataset, *config):
+    """
+    Fits a single config and returns only its stats.
+    """
+    holdout = hashable_to_holdout(config[-1])
+    logger.info(f"Holdout: {holdout}")
+    result = fit_svi(args, dataset, *config)
+    stats = mutrans.log_stats(dataset, result)
+
+    # Clean up to save memory.
+    del dataset, result
+    pyro.clear_param_store()
+    gc.collect()
+    return stats
+
+
+def fit_loo(args, dataset, clade, config):
+    """
+    Fits a single config with a clade of lineages left out. If ``dataset`` is
+    None, it is loaded, as in worker processes.
+    """
+    logger.info(f"Config: {config}")
+    if dataset is None:
+        dataset = load_data(args)
+
+    # Construct a leave-one-out dataset by zeroing out a subclade.
+    loo_dataset = dataset.copy()
+    loo_dataset["weekly_strains"] = dataset["weekly_strains"].clone()
+    loo_dataset["weekly_strains"][:, :, clade] = 0
+
+    # Run SVI
+    result = fit_svi(args, loo_dataset, *config)
+
+    # Cleanup
+    del loo_dataset
+    pyro.clear_param_store()
+    gc.collect()
+    return result
+
+
+def fit_loo_batch(args, dataset, clades, configs):
+    """
+    Like :func:`fit_loo` but fits a batch of leave-one-out configs.
+    """
+    if dataset is None:
+        dataset = load_data(args)
+    results = fit_svi_batch(args, dataset, clades, configs)
+    pyro.clear_param_store()
+    gc.collect()
+    return results
+
+
 def backtesting(args, default_config):
     configs = []
     empty_holdout = ()
     for max_day in args.backtesting_max_day.split(","):
         max_day = int(max_day)
+        num_steps = args.num_steps
+        if configs and args.warm_start and args.warm_num_steps is not None:
+            num_steps = args.warm_num_steps
         configs.append(
             (
                 args.cond_data,
                 args.model_type,
                 args.guide_type,
-                args.num_steps,
+                num_steps,
                 args.learning_rate,
                 args.learning_rate_decay,
                 args.clip_norm,
@@ -162,47 +578,7 @@ def backtesting(args, default_config):
                 empty_holdout,
             )
         )
-    # Sequentially fit models.
-    results = {}
-    for config in configs:
-        logger.info(f"Config: {config}")
-
-        # Holdout is the last in the config
-        holdout = hashable_to_holdout(config[-1])
-        # end_day is second from last
-        end_day = config[-2]
-
-        # load dataset
-        dataset = load_data(args, end_day=end_day, **holdout)
-
-        # Run SVI
-        result = fit_svi(args, dataset, *config)
-        mutrans.log_stats(dataset, result)
-
-        # Save the results for this config
-
-        # Augment gisaid dataset with JHU timeseries counts
-        dataset.update(mutrans.load_jhu_data(dataset))
-
-        # Generate results
-        result["mutations"] = dataset["mutations"]
-        result["weekly_strains"] = dataset["weekly_strains"]
-        result["weekly_cases"] = dataset["weekly_cases"]
-        result["weekly_strains_shape"] = tuple(dataset["weekly_strains"].shape)
-        result["location_id"] = dataset["location_id"]
-        result["lineage_id_inv"] = dataset["lineage_id_inv"]
-
-        result = torch_map(result, device="cpu", dtype=torch.float)  # to save space
-        results[config] = result
-
-        # Ensure number of regions match
-        assert dataset["weekly_strains"].shape[1] == result["mean"]["probs"].shape[1]
-        assert dataset["weekly_cases"].shape[1] == result["mean"]["probs"].shape[1]
-
-        # Cleanup
-        del dataset
-        pyro.clear_param_store()
-        gc.collect()
+    results = fit_configs(args, configs, "backtesting", warm_start=args.warm_start)
 
     if args.vary_holdout:
         mutrans.log_holdout_stats({k[-1]: v for k, v in results.items()})
@@ -218,7 +594,9 @@ def vary_leaves(args, default_config):
     to ``results/mutrans.vary_leaves.pt``.
     """
     # Load a single common dataset.
-    dataset = load_data(args)
+    scheduler = make_scheduler(args, "vary_leaves")
+    data = scheduler.add("data", load_data, args, local=True)
+    dataset = scheduler.run([data])[0]
     lineage_id = {name: i for i, name in enumerate(dataset["lineage_id_inv"])}
     descendents = pangolin.find_descendents(dataset["lineage_id_inv"])
     if args.only_gene:
@@ -235,7 +613,17 @@ def vary_leaves(args, default_config):
         config = tuple(config)
         return config
 
-    result = fit_svi(args, dataset, *make_config())
+    config = make_config()
+    result = scheduler.add(
+        f"fit:{config}",
+        fit_svi,
+        args,
+        data,
+        *config,
+        memory=fit_memory,
+        filename=_cache_filename("svi", args, *config),
+    )
+    result = scheduler.run([result])[0]
 
     # Rank lineages by divergence from parent.
     lineages = mutrans.rank_loo_lineages(dataset, result)
@@ -249,29 +637,54 @@ def vary_leaves(args, default_config):
 
     # Run inference for each lineage. This is very expensive.
     results = {}
+    clades = []
+    configs = []
     for lineage in lineages:
-        config = make_config(exclude={"lineage": "^" + lineage + "$"})
-        logger.info(f"Config: {config}")
-
-        # Construct a leave-one-out dataset by zeroing out a subclade.
+        configs.append(make_config(exclude={"lineage": "^" + lineage + "$"}))
         clade = [lineage_id[lineage]]
         for descendent in descendents[lineage]:
             clade.append(lineage_id[descendent])
-        loo_dataset = dataset.copy()
-        loo_dataset["weekly_strains"] = dataset["weekly_strains"].clone()
-        loo_dataset["weekly_strains"][:, :, clade] = 0
-
-        # Run SVI
-        result = fit_svi(args, loo_dataset, *config)
+        clades.append(clade)
+    # Workers load the dataset themselves, rather than receiving it by pickle.
+    loo_data = data if args.jobs <= 1 else None
+    memory = fit_memory(args, dataset)
+    if args.loo_batch_size > 1:
+        # Run batches of fits in parallel, masking out a subclade in each fit.
+        refs = []
+        for i in range(0, len(configs), args.loo_batch_size):
+            batch = slice(i, i + args.loo_batch_size)
+            refs.append(
+                scheduler.add(
+                    f"loo_batch:{configs[batch]}",
+                    fit_loo_batch,
+                    args,
+                    loo_data,
+                    clades[batch],
+                    configs[batch],
+                    memory=len(configs[batch]) * memory,
+                )
+            )
+        for batch_results in scheduler.run(refs):
+            results.update(batch_results)
+    else:
+        refs = [
+            scheduler.add(
+                f"loo:{config}",
+                fit_loo,
+                args,
+                loo_data,
+                clade,
+                config,
+                memory=memory,
+                filename=_cache_filename("svi", args, *config),
+            )
+            for clade, config in zip(clades, configs)
+        ]
+        results = dict(zip(configs, scheduler.run(refs)))
+    for result in results.values():
         result["mutations"] = dataset["mutations"]
         result["location_id"] = dataset["location_id"]
         result["lineage_id_inv"] = dataset["lineage_id_inv"]
-        results[config] = result
-
-        # Cleanup
-        del result
-        pyro.clear_param_store()
-        gc.collect()
 
     if not args.test:
         logger.info("saving results/mutrans.vary_leaves.pt")
@@ -300,21 +713,9 @@ def vary_gene(args, default_config):
         config = tuple(config)
         return config
 
-    results = {}
-    for holdout in grid:
-        # Fit a single model.
-        logger.info(f"Holdout: {holdout}")
-        dataset = load_data(args, **holdout)
-        result = fit_svi(args, dataset, *make_config(**holdout))
-
-        # Save metrics.
-        key = holdout_to_hashable(holdout)
-        results[key] = mutrans.log_stats(dataset, result)
-
-        # Clean up to save memory.
-        del dataset, result
-        pyro.clear_param_store()
-        gc.collect()
+    # Fit a model to each holdout and save metrics.
+    configs = [make_config(**holdout) for holdout in grid]
+    results = fit_holdouts(args, configs, "vary_gene")
 
     if not args.test:
         logger.info("saving results/mutrans.vary_gene.pt")
@@ -338,21 +739,9 @@ def vary_nsp(args, default_config):
         config = tuple(config)
         return config
 
-    results = {}
-    for holdout in grid:
-        # Fit a single model.
-        logger.info(f"Holdout: {holdout}")
-        dataset = load_data(args, **holdout)
-        result = fit_svi(args, dataset, *make_config(**holdout))
-
-        # Save metrics.
-        key = holdout_to_hashable(holdout)
-        results[key] = mutrans.log_stats(dataset, result)
-
-        # Clean up to save memory.
-        del dataset, result
-        pyro.clear_param_store()
-        gc.collect()
+    # Fit a model to each holdout and save metrics.
+    configs = [make_config(**holdout) for holdout in grid]
+    results = fit_holdouts(args, configs, "vary_nsp")
 
     if not args.test:
         logger.info("saving results/mutrans.vary_nsp.pt")
@@ -363,13 +752,7 @@ def main(args):
     """Main Entry Point"""
 
     # Torch configuration
-    torch.set_default_dtype(torch.double if args.double else torch.float)
-    if args.cuda:
-        torch.set_default_tensor_type(
-            torch.cuda.DoubleTensor if args.double else torch.cuda.FloatTensor
-        )
-    if args.debug:
-        torch.autograd.set_detect_anomaly(True)
+    configure_torch(args)
 
     # Configure fits.
     configs = []
@@ -472,47 +855,7 @@ def main(args):
     else:
         configs.append(default_config)
 
-    # Sequentially fit models.
-    results = {}
-    for config in configs:
-        logger.info(f"Config: {config}")
-
-        # Holdout is the last in the config
-        holdout = hashable_to_holdout(config[-1])
-        # end_day is second from last
-        end_day = config[-2]
-
-        # load dataset
-        dataset = load_data(args, end_day=end_day, **holdout)
-
-        # Run SVI
-        result = fit_svi(args, dataset, *config)
-        mutrans.log_stats(dataset, result)
-
-        # Save the results for this config
-
-        # Augment gisaid dataset with JHU timeseries counts
-        dataset.update(mutrans.load_jhu_data(dataset))
-
-        # Generate results
-        result["mutations"] = dataset["mutations"]
-        result["weekly_strains"] = dataset["weekly_strains"]
-        result["weekly_cases"] = dataset["weekly_cases"]
-        result["weekly_strains_shape"] = tuple(dataset["weekly_strains"].shape)
-        result["location_id"] = dataset["location_id"]
-        result["lineage_id_inv"] = dataset["lineage_id_inv"]
-
-        result = torch_map(result, device="cpu", dtype=torch.float)  # to save space
-        results[config] = result
-
-        # Ensure number of regions match
-        assert dataset["weekly_strains"].shape[1] == result["mean"]["probs"].shape[1]
-        assert dataset["weekly_cases"].shape[1] == result["mean"]["probs"].shape[1]
-
-        # Cleanup
-        del dataset
-        pyro.clear_param_store()
-        gc.collect()
+    results = fit_configs(args, configs)
 
     if args.vary_holdout:
         mutrans.log_holdout_stats({k[-1]: v for k, v in results.items()})
@@ -531,6 +874,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--vary-leaves", type=int, help="min number of samples per held out lineage"
     )
+    parser.add_argument(
+        "--loo-batch-size",
+        default=1,
+        type=int,
+        help="number of leave-one-out fits to run in parallel in --vary-leaves",
+    )
     parser.add_argument("--vary-gene", action="store_true")
     parser.add_argument("--vary-nsp", action="store_true")
     parser.add_argument("--only-gene")
@@ -543,19 +892,99 @@ if __name__ == "__main__":
     parser.add_argument("-lrd", "--learning-rate-decay", default=0.1, type=float)
     parser.add_argument("-cn", "--clip-norm", default=10.0, type=float)
     parser.add_argument("-r", "--rank", default=200, type=int)
+    parser.add_argument(
+        "-ps",
+        "--place-subsample-size",
+        type=int,
+        help="number of places to subsample per SVI step",
+    )
+    parser.add_argument(
+        "-cw",
+        "--converge-window",
+        type=int,
+        help="number of SVI steps per convergence check; default never stops early",
+    )
+    parser.add_argument("--converge-rtol", default=1e-4, type=float)
+    parser.add_argument("--converge-param-rtol", default=0.05, type=float)
+    parser.add_argument("--converge-patience", default=3, type=int)
+    parser.add_argument(
+        "--checkpoint-every",
+        default=100,
+        type=int,
+        help="number of SVI steps between checkpoints, or 0 to disable",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="resume fits from checkpoints"
+    )
+    parser.add_argument(
+        "--telemetry-every",
+        type=int,
+        help="number of SVI steps between records of gradient norms and medians, "
+        "or 0 to disable; defaults to --log-every",
+    )
+    parser.add_argument(
+        "--telemetry",
+        action="store_true",
+        help="also write telemetry of each fit to a .jsonl file",
+    )
+    parser.add_argument(
+        "--warm-start",
+        action="store_true",
+        help="initialize each backtesting fit from the previous end day's fit",
+    )
+    parser.add_argument(
+        "--warm-num-steps",
+        type=int,
+        help="number of SVI steps for warm started fits; defaults to --num-steps",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        help="maximum estimated GB of memory of fits running at once",
+    )
     parser.add_argument("-f", "--forecast-steps", default=6, type=int)
+    parser.add_argument(
+        "--forecast-samples",
+        default=0,
+        type=int,
+        help="number of rate/init samples to save for lazy forecasting, "
+        "in place of saved probs",
+    )
     parser.add_argument("-fp64", "--double", action="store_true")
     parser.add_argument("-fp32", "--float", action="store_false", dest="double")
     parser.add_argument(
         "--cuda", action="store_true", default=torch.cuda.is_available()
     )
     parser.add_argument("-b", "--backtesting-max-day", default=None)
+    parser.add_argument(
+        "--timestep",
+        default=mutrans.TIMESTEP,
+        type=int,
+        help="number of days per time bin",
+    )
     parser.add_argument("--cpu", dest="cuda", action="store_false")
     parser.add_argument("--jit", action="store_true", default=False)
     parser.add_argument("--no-jit", dest="jit", action="store_false")
     parser.add_argument("--seed", default=20210319, type=int)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        help="number of configs to fit in parallel worker processes",
+    )
     parser.add_argument("-l", "--log-every", default=50, type=int)
     parser.add_argument("--no-new", action="store_true")
+    parser.add_argument(
+        "--cache-dir",
+        default="results/cache",
+        help="directory of the content-addressed cache of results",
+    )
+    parser.add_argument(
+        "--cache-max-gb",
+        type=float,
+        help="maximum GB of cached results, evicting least recently used",
+    )
     parser.add_argument("--no-cache", action="store_true")
     parser.add_argument("--force", action="store_true")
     parser.add_argument("--test", action="store_true")
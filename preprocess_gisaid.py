@@ -3,21 +3,37 @@
 
 import argparse
 import datetime
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import pickle
+import shutil
+import threading
 import warnings
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 
+import numpy as np
+
+from featurize_nextclade import Featurizer, add_featurize_args
 from pyrocov import pangolin
+from pyrocov.columnar import (
+    append_columns,
+    load_columns,
+    read_meta,
+    save_columns,
+    update_rows,
+)
 from pyrocov.geo import gisaid_normalize
+from pyrocov.gisaid import get_accession_id, iter_feed, read_feed, save_index, scan_feed
 from pyrocov.mutrans import START_DATE
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
 
 DATE_FORMATS = {4: "%Y", 7: "%Y-%m", 10: "%Y-%m-%d"}
+TRUNCATE = int(1e10)
 
 
 def parse_date(string):
@@ -32,6 +48,226 @@ def parse_date(string):
 
 
 FIELDS = ["virus_name", "accession_id", "collection_date", "location", "add_location"]
+ENCODED_FIELDS = ["collection_date", "location", "add_location", "lineage"]
+
+
+def hash_metadata(metadata):
+    """
+    Computes a 64 bit digest of a row's metadata.
+    """
+    if isinstance(metadata, str):
+        metadata = metadata.encode("utf-8")
+    digest = hashlib.blake2b(metadata, digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def process_line(args, line, columns, stats, seen=None, updates=None):
+    """
+    Parses a single line of the GISAID feed, appending to ``columns`` and
+    updating ``stats`` iff the row passes filters.
+
+    If ``seen`` is a dict mapping accession id to the digest of its metadata
+    when last processed, rows whose metadata is unchanged are skipped, and
+    ``(accession_id, digest)`` pairs of all other rows are appended to
+    ``updates``.
+    """
+    # Optimize for faster reading.
+    line, _ = line.split(', "sequence": ', 1)
+    line += "}"
+    process_metadata(args, line, columns, stats, seen, updates)
+
+
+def process_metadata(args, metadata, columns, stats, seen=None, updates=None):
+    """
+    Like :func:`process_line` but for a str or bytes JSON object of metadata
+    excluding the sequence, e.g. as found by :func:`~pyrocov.gisaid.scan_feed`.
+    """
+    # Skip rows that were processed in a previous run.
+    if seen is not None:
+        if isinstance(metadata, str):
+            metadata = metadata.encode("utf-8")
+        digest = hash_metadata(metadata)
+        accession_id = get_accession_id(metadata)
+        if seen.get(accession_id) == digest:
+            return
+        updates.append((accession_id, digest))
+
+    # Filter out bad data.
+    datum = json.loads(metadata)
+    if len(datum["covv_collection_date"]) < 7:
+        return  # Drop rows with no month information.
+    date = parse_date(datum["covv_collection_date"])
+    if date < args.start_date:
+        date = args.start_date  # Clip rows before start date.
+    lineage = datum["covv_lineage"]
+    if lineage in (None, "None", "", "XA"):
+        return  # Drop rows with unknown or ambiguous lineage.
+    try:
+        lineage = pangolin.compress(lineage)
+        lineage = pangolin.decompress(lineage)
+        assert lineage
+    except (ValueError, AssertionError) as e:
+        warnings.warn(str(e))
+        return
+
+    # Fix duplicate locations.
+    datum["covv_location"] = gisaid_normalize(datum["covv_location"])
+
+    # Collate.
+    columns["lineage"].append(lineage)
+    for key in FIELDS:
+        columns[key].append(datum["covv_" + key])
+    columns["day"].append((date - args.start_date).days)
+
+    # Aggregate statistics.
+    stats["date"][datum["covv_collection_date"]] += 1
+    stats["location"][datum["covv_location"]] += 1
+    stats["lineage"][lineage] += 1
+
+
+def split_shards(filename, num_shards):
+    """
+    Splits a file into ``num_shards`` contiguous byte ranges. Ranges are
+    newline-aligned lazily by :func:`read_shard`.
+    """
+    size = os.path.getsize(filename)
+    bounds = [size * i // num_shards for i in range(num_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+_SEEN = None
+
+
+def _init_worker(seen):
+    global _SEEN
+    _SEEN = seen
+
+
+def index_record(index, metadata, offset, length):
+    """
+    Records the location of a sequence found by
+    :func:`~pyrocov.gisaid.scan_feed`.
+    """
+    index["accession_id"].append(get_accession_id(metadata))
+    index["offset"].append(offset)
+    index["length"].append(length)
+
+
+def process_lines(args, lines):
+    """
+    Processes an iterable of lines of the GISAID feed in a worker process.
+    """
+    columns = defaultdict(list)
+    stats = defaultdict(Counter)
+    updates = []
+    num_lines = 0
+    for i, line in enumerate(lines):
+        process_line(args, line, columns, stats, _SEEN, updates)
+        num_lines += 1
+        if i % args.log_every == 0:
+            print(".", end="", flush=True)
+    return dict(columns), dict(stats), updates, num_lines, {}
+
+
+def process_records(args, records):
+    """
+    Processes an iterable of records found by
+    :func:`~pyrocov.gisaid.scan_feed` in a worker process.
+    """
+    columns = defaultdict(list)
+    stats = defaultdict(Counter)
+    updates = []
+    index = defaultdict(list)
+    num_lines = 0
+    for i, (metadata, offset, length) in enumerate(records):
+        index_record(index, metadata, offset, length)
+        process_metadata(args, metadata, columns, stats, _SEEN, updates)
+        num_lines += 1
+        if i % args.log_every == 0:
+            print(".", end="", flush=True)
+    return dict(columns), dict(stats), updates, num_lines, dict(index)
+
+
+def _process_shard(task):
+    args, start, end = task
+    return process_records(args, scan_feed(args.gisaid_file_in, start, end))
+
+
+def _process_batch(task):
+    return process_lines(*task)
+
+
+def update_lineages(id_to_lineage, updates, columns):
+    """
+    Updates a dict mapping accession id to lineage with processed rows.
+    """
+    for accession_id, _ in updates:
+        id_to_lineage.pop(accession_id, None)
+    new_ids = columns.get("accession_id", [])
+    id_to_lineage.update(zip(new_ids, columns.get("lineage", [])))
+
+
+def update_columns(args, columns, stats, updates):
+    """
+    Updates the existing columns store and stats with rows processed in an
+    incremental run. New rows are appended and changed rows are overwritten
+    in place. Only if changed rows are now filtered out is the columns store
+    rewritten.
+    """
+    with open(args.stats_file_out, "rb") as f:
+        old_stats = pickle.load(f)
+    for key in ["date", "location", "lineage"]:
+        old_stats.setdefault(key, Counter())
+
+    # Find previously kept rows that have been reprocessed.
+    processed = {accession_id for accession_id, _ in updates}
+    old_ids = load_columns(args.columns_dir_out, ["accession_id"])["accession_id"]
+    old_rows = {a: i for i, a in enumerate(old_ids) if a in processed}
+    old = load_columns(args.columns_dir_out, ["collection_date", "location", "lineage"])
+    for i in old_rows.values():
+        old_stats["date"][old["collection_date"][i]] -= 1
+        old_stats["location"][old["location"][i]] -= 1
+        old_stats["lineage"][old["lineage"][i]] -= 1
+    del old_ids, old
+
+    # Overwrite changed rows and append new rows.
+    new_ids = columns.get("accession_id", [])
+    changed = [j for j, a in enumerate(new_ids) if a in old_rows]
+    if changed:
+        logger.info(f"updating {len(changed)} changed rows")
+        update_rows(
+            args.columns_dir_out,
+            [old_rows[new_ids[j]] for j in changed],
+            {key: [values[j] for j in changed] for key, values in columns.items()},
+        )
+    if len(changed) < len(new_ids):
+        added = [j for j, a in enumerate(new_ids) if a not in old_rows]
+        append_columns(
+            args.columns_dir_out,
+            {key: [values[j] for j in added] for key, values in columns.items()},
+        )
+
+    # Remove rows that are now filtered out.
+    dropped = old_rows.keys() - set(new_ids)
+    if dropped:
+        logger.info(f"removing {len(dropped)} rows that are now filtered out")
+        old_columns = load_columns(args.columns_dir_out)
+        keep = np.ones(read_meta(args.columns_dir_out)["num_rows"], dtype=bool)
+        keep[[old_rows[a] for a in dropped]] = False
+        kept = {}
+        for key, values in old_columns.items():
+            if isinstance(values, np.ndarray):
+                kept[key] = values[keep]
+            elif key in ENCODED_FIELDS:
+                kept[key] = [values.values[c] for c in values.codes[keep].tolist()]
+            else:
+                kept[key] = [v for v, k in zip(values, keep.tolist()) if k]
+        del old_columns
+        save_columns(args.columns_dir_out, kept, encode=ENCODED_FIELDS)
+
+    for key, counts in stats.items():
+        old_stats[key].update(counts)
+    return {key: +counts for key, counts in old_stats.items()}
 
 
 def main(args):
@@ -42,73 +278,186 @@ def main(args):
 
     columns = defaultdict(list)
     stats = defaultdict(Counter)
-    covv_fields = ["covv_" + key for key in FIELDS]
-
-    with open(args.gisaid_file_in) as f:
-        for i, line in enumerate(f):
-            # Optimize for faster reading.
-            line, _ = line.split(', "sequence": ', 1)
-            line += "}"
-
-            # Filter out bad data.
-            datum = json.loads(line)
-            if len(datum["covv_collection_date"]) < 7:
-                continue  # Drop rows with no month information.
-            date = parse_date(datum["covv_collection_date"])
-            if date < args.start_date:
-                date = args.start_date  # Clip rows before start date.
-            lineage = datum["covv_lineage"]
-            if lineage in (None, "None", "", "XA"):
-                continue  # Drop rows with unknown or ambiguous lineage.
-            try:
-                lineage = pangolin.compress(lineage)
-                lineage = pangolin.decompress(lineage)
-                assert lineage
-            except (ValueError, AssertionError) as e:
-                warnings.warn(str(e))
-                continue
-
-            # Fix duplicate locations.
-            datum["covv_location"] = gisaid_normalize(datum["covv_location"])
-
-            # Collate.
-            columns["lineage"].append(lineage)
-            for covv_key, key in zip(covv_fields, FIELDS):
-                columns[key].append(datum[covv_key])
-            columns["day"].append((date - args.start_date).days)
-
-            # Aggregate statistics.
-            stats["date"][datum["covv_collection_date"]] += 1
-            stats["location"][datum["covv_location"]] += 1
-            stats["lineage"][lineage] += 1
+    updates = []
+    index = defaultdict(list)
+    scannable = not args.gisaid_file_in.endswith(".xz")
+
+    # Load digests of rows processed in previous runs, keeping the latest
+    # digest of each accession id.
+    seen = None
+    incremental = False
+    if args.incremental:
+        seen = {}
+        incremental = os.path.exists(args.seen_dir)
+        if incremental:
+            logger.info(f"Loading {args.seen_dir}")
+            old = load_columns(args.seen_dir)
+            seen.update(zip(old["accession_id"], old["digest"].tolist()))
+            del old
+    elif os.path.exists(args.seen_dir):
+        # A full run invalidates digests of previous runs.
+        shutil.rmtree(args.seen_dir)
 
+    # Optionally fan out lines to sequence featurization in the same pass.
+    featurizer = None
+    if args.featurize:
+        id_to_lineage = {}
+        if incremental:
+            old = load_columns(args.columns_dir_out, ["accession_id", "lineage"])
+            id_to_lineage.update(zip(old["accession_id"], old["lineage"]))
+            del old
+        featurizer = Featurizer(args, id_to_lineage)
+
+    if args.workers > 1:
+        if args.truncate < TRUNCATE:
+            raise ValueError("--truncate is not supported with --workers > 1")
+        pending: deque = deque()
+        if not scannable or featurizer is not None:
+            # Process batches of lines streamed from the feed.
+            def iter_tasks():
+                for batch in read_feed(args.gisaid_file_in):
+                    if featurizer is not None:
+                        pending.append(batch)
+                    yield args, batch
+
+            process = _process_batch
+        else:
+            # Scan newline-aligned byte ranges of the file.
+            def iter_tasks():
+                for start, end in split_shards(args.gisaid_file_in, 4 * args.workers):
+                    yield args, start, end
+
+            process = _process_shard
+
+        # Limit read-ahead, since Pool.imap() eagerly consumes tasks.
+        throttle = threading.BoundedSemaphore(4 * args.workers)
+
+        def throttled(tasks):
+            for task in tasks:
+                throttle.acquire()
+                yield task
+
+        # Merge results in original row order.
+        num_lines = 0
+        with multiprocessing.Pool(args.workers, _init_worker, (seen,)) as pool:
+            for result in pool.imap(process, throttled(iter_tasks())):
+                columns_, stats_, updates_, num_lines_, index_ = result
+                for key, values in columns_.items():
+                    columns[key].extend(values)
+                for key, values in index_.items():
+                    index[key].extend(values)
+                for key, counts in stats_.items():
+                    stats[key].update(counts)
+                updates.extend(updates_)
+                num_lines += num_lines_
+                if featurizer is not None:
+                    update_lineages(featurizer.id_to_lineage, updates_, columns_)
+                    for line in pending.popleft():
+                        featurizer.schedule(line)
+                throttle.release()
+    elif scannable and featurizer is None:
+        records = scan_feed(args.gisaid_file_in)
+        for i, (metadata, offset, length) in enumerate(records):
+            index_record(index, metadata, offset, length)
+            process_metadata(args, metadata, columns, stats, seen, updates)
             if i % args.log_every == 0:
                 print(".", end="", flush=True)
             if i >= args.truncate:
                 break
+        num_lines = i + 1
+    else:
+        for i, line in enumerate(iter_feed(args.gisaid_file_in)):
+            num_rows = len(columns.get("day", ()))
+            num_updates = len(updates)
+            process_line(args, line, columns, stats, seen, updates)
+            if featurizer is not None:
+                new_rows = {k: v[num_rows:] for k, v in columns.items()}
+                update_lineages(
+                    featurizer.id_to_lineage, updates[num_updates:], new_rows
+                )
+                featurizer.schedule(line)
+            if i % args.log_every == 0:
+                print(".", end="", flush=True)
+            if i >= args.truncate:
+                break
+        num_lines = i + 1
 
-    num_dropped = i + 1 - len(columns["day"])
-    logger.info(f"dropped {num_dropped}/{i+1} = {num_dropped/(i+1)/100:0.2g}% rows")
+    if incremental:
+        num_skipped = num_lines - len(updates)
+        logger.info(f"skipped {num_skipped}/{num_lines} previously processed rows")
+        num_lines -= num_skipped
+    num_dropped = num_lines - len(columns["day"])
+    logger.info(
+        f"dropped {num_dropped}/{num_lines} = {num_dropped/max(1, num_lines)/100:0.2g}% rows"
+    )
 
-    logger.info(f"saving {args.columns_file_out}")
-    with open(args.columns_file_out, "wb") as f:
-        pickle.dump(dict(columns), f)
+    if incremental:
+        logger.info(f"updating {args.columns_dir_out}")
+        stats = update_columns(args, columns, stats, updates)
+    else:
+        logger.info(f"saving {args.columns_dir_out}")
+        save_columns(args.columns_dir_out, columns, encode=ENCODED_FIELDS)
 
     logger.info(f"saving {args.stats_file_out}")
     with open(args.stats_file_out, "wb") as f:
         pickle.dump(dict(stats), f)
 
+    if index:
+        logger.info(f"saving {args.index_dir_out}")
+        save_index(args.index_dir_out, index, args.gisaid_file_in)
+    elif os.path.exists(args.index_dir_out):
+        # Remove any index of a previous version of the feed.
+        shutil.rmtree(args.index_dir_out)
+
+    if featurizer is not None:
+        featurizer.finish()
+
+    # Record which rows have been processed, for future incremental runs.
+    if args.incremental:
+        logger.info(f"saving {args.seen_dir}")
+        seen_columns = {
+            "accession_id": [accession_id for accession_id, _ in updates],
+            "digest": [digest for _, digest in updates],
+        }
+        if incremental:
+            # Append new digests, which supersede old digests when loaded.
+            append_columns(args.seen_dir, seen_columns)
+            seen.update(updates)
+            if read_meta(args.seen_dir)["num_rows"] > 2 * len(seen):
+                logger.info(f"compacting {args.seen_dir}")
+                seen_columns = {
+                    "accession_id": list(seen),
+                    "digest": list(seen.values()),
+                }
+                save_columns(args.seen_dir, seen_columns)
+        else:
+            save_columns(args.seen_dir, seen_columns)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Preprocess GISAID data")
-    parser.add_argument("--gisaid-file-in", default="results/gisaid.json")
-    parser.add_argument("--columns-file-out", default="results/gisaid.columns.pkl")
+    parser.add_argument("--gisaid-file-in", default="results/gisaid.json.xz")
+    parser.add_argument("--columns-dir-out", default="results/gisaid.columns")
     parser.add_argument("--stats-file-out", default="results/gisaid.stats.pkl")
+    parser.add_argument("--seen-dir", default="results/gisaid.seen")
+    parser.add_argument("--index-dir-out", default="results/gisaid.index")
     parser.add_argument("--subset-file-out", default="results/gisaid.subset.tsv")
     parser.add_argument("--subset-dir-out", default="results/fasta")
     parser.add_argument("--start-date", default=START_DATE)
     parser.add_argument("-l", "--log-every", default=1000, type=int)
-    parser.add_argument("--truncate", default=int(1e10), type=int)
+    parser.add_argument("--truncate", default=TRUNCATE, type=int)
+    parser.add_argument("-w", "--workers", default=1, type=int)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="process only rows that are new or changed since the previous run",
+    )
+    parser.add_argument(
+        "--featurize",
+        action="store_true",
+        help="also featurize sequences via nextclade in the same pass",
+    )
+    add_featurize_args(parser)
     args = parser.parse_args()
     args.start_date = parse_date(args.start_date)
     main(args)
@@ -3,7 +3,7 @@
 # Ensure data directory (or a link) exists.
 test -e results || mkdir results
 
-# Download and decompress data.
+# Download data. This is decompressed on the fly by python scripts.
 curl -u $GISAID_USERNAME:$GISAID_PASSWORD --retry 4 \
   https://www.epicov.org/epi3/3p/$GISAID_FEED/export/provision.json.xz \
-  | xz -d -T8 > results/gisaid.json
+  -o results/gisaid.json.xz
@@ -0,0 +1,220 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import torch
+
+from .util import torch_load
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = "manifest.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    config TEXT NOT NULL,
+    version TEXT,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    compute_time REAL,
+    hits INTEGER NOT NULL DEFAULT 0
+)
+"""
+_COLUMNS = (
+    "key",
+    "name",
+    "config",
+    "version",
+    "size",
+    "created",
+    "accessed",
+    "compute_time",
+    "hits",
+)
+
+
+def fingerprint(path):
+    """
+    Cheaply fingerprints a file or directory by the sizes and modification
+    times of its files, without reading their contents.
+
+    :param str path: Path to a file or directory.
+    :returns: A json serializable fingerprint, or None if ``path`` does not
+        exist.
+    """
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    return {
+        name: fingerprint(os.path.join(path, name)) for name in sorted(os.listdir(path))
+    }
+
+
+def code_version(*filenames):
+    """
+    Returns a hash of the contents of source files.
+    """
+    h = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    A content-addressed cache of results, saved as files named by a hash of
+    their config, the fingerprints of input files, and a code version.
+
+    Entries are recorded in a sqlite manifest at
+    ``{dirname}/manifest.sqlite``, with their name, config, size, and times
+    of creation, last access, and computation. The manifest can be queried
+    directly, e.g.::
+
+        sqlite3 results/cache/manifest.sqlite \\
+            "SELECT name, size, compute_time FROM entries ORDER BY accessed"
+
+    Lookups read only the manifest, not the results. If ``max_size`` is given,
+    least recently used entries are evicted whenever a new entry is saved.
+
+    :param str dirname: Path to the cache directory.
+    :param inputs: An iterable of paths of input files or directories, whose
+        fingerprints are included in every key.
+    :param str version: A code version included in every key.
+    :param int max_size: Optional maximum total size in bytes of entries.
+    """
+
+    def __init__(self, dirname, *, inputs=(), version=None, max_size=None):
+        self.dirname = dirname
+        self.version = version
+        self.max_size = max_size
+        self.inputs = {path: fingerprint(path) for path in inputs}
+        os.makedirs(dirname, exist_ok=True)
+        self._execute(_SCHEMA)
+
+    def _execute(self, query, params=()):
+        # Connect per query, allowing concurrent access from worker processes.
+        filename = os.path.join(self.dirname, MANIFEST_FILENAME)
+        conn = sqlite3.connect(filename, timeout=60)
+        try:
+            with conn:
+                return conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+
+    def key(self, name, config):
+        """
+        Computes the key of a result.
+
+        :param str name: The name of the kind of result.
+        :param config: A config whose ``repr()`` determines the result.
+        :returns: A hex digest.
+        :rtype: str
+        """
+        data = [name, repr(config), self.inputs, self.version]
+        return hashlib.sha256(json.dumps(data).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        """
+        Returns the path of a result's file, whether or not it exists.
+        """
+        return os.path.join(self.dirname, key[:2], key + ".pt")
+
+    def lookup(self, key):
+        """
+        Returns the path of a cached result, or None if not cached.
+        """
+        rows = self._execute("SELECT 1 FROM entries WHERE key=?", (key,))
+        if not rows or not os.path.exists(self.path(key)):
+            return None
+        return self.path(key)
+
+    def load(self, key, **kwargs):
+        """
+        Loads a cached result, recording the access.
+
+        :param str key: A key of a cached result.
+        :param kwargs: Keyword arguments to :func:`~pyrocov.util.torch_load`.
+        """
+        result = torch_load(self.path(key), **kwargs)
+        self._execute(
+            "UPDATE entries SET accessed=?, hits=hits+1 WHERE key=?",
+            (time.time(), key),
+        )
+        return result
+
+    def save(self, key, result, *, name, config, compute_time=None):
+        """
+        Saves a result, then evicts least recently used entries if needed.
+
+        :param str key: The key of the result, from :meth:`key`.
+        :param result: The result, to be saved by :func:`torch.save`.
+        :param str name: The name passed to :meth:`key`.
+        :param config: The config passed to :meth:`key`.
+        :param float compute_time: Optional time in seconds to compute the
+            result.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f"{path}.{os.getpid()}.temp"
+        torch.save(result, temp)
+        size = os.path.getsize(temp)
+        os.replace(temp, path)
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO entries "
+            "(key, name, config, version, size, created, accessed, compute_time) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, name, repr(config), self.version, size, now, now, compute_time),
+        )
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def entries(self, name=None):
+        """
+        Returns a list of dicts of entries in the manifest, in order of least
+        recent access.
+
+        :param str name: An optional name to filter entries.
+        :rtype: list
+        """
+        query = "SELECT {} FROM entries".format(", ".join(_COLUMNS))
+        params: tuple = ()
+        if name is not None:
+            query += " WHERE name=?"
+            params = (name,)
+        query += " ORDER BY accessed"
+        rows = self._execute(query, params)
+        return [dict(zip(_COLUMNS, row)) for row in rows]
+
+    def remove(self, key):
+        """
+        Removes an entry and its file.
+        """
+        self._execute("DELETE FROM entries WHERE key=?", (key,))
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def evict(self, max_size):
+        """
+        Removes least recently used entries until the total size is at most
+        ``max_size`` bytes.
+        """
+        rows = self._execute("SELECT key, size FROM entries ORDER BY accessed DESC")
+        total = 0
+        for key, size in rows:
+            total += size
+            if total > max_size:
+                logger.info(f"Evicting {key} from cache")
+                self.remove(key)
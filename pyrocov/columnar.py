@@ -0,0 +1,360 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+META_FILENAME = "meta.json"
+CODE_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+
+
+class DictColumn:
+    """
+    A dictionary-encoded column, stored as an integer ``codes`` array indexing
+    into a small list of distinct ``values``.
+    """
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def __iter__(self):
+        values = self.values
+        return (values[c] for c in self.codes.tolist())
+
+    def tolist(self):
+        return list(self)
+
+
+class StringColumn:
+    """
+    A column of mostly-distinct strings, stored as concatenated utf-8 ``data``
+    and an array of the end byte offset of each string.
+    """
+
+    def __init__(self, data, ends):
+        self.data = data
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, i):
+        start = int(self.ends[i - 1]) if i else 0
+        return bytes(self.data[start : int(self.ends[i])]).decode("utf-8")
+
+    def __iter__(self):
+        data = bytes(self.data)
+        start = 0
+        for end in self.ends.tolist():
+            yield data[start:end].decode("utf-8")
+            start = end
+
+    def tolist(self):
+        return list(self)
+
+
+def _read_array(filename, dtype, size, mmap):
+    if size == 0:
+        return np.zeros(0, dtype)
+    if mmap:
+        return np.memmap(filename, dtype=dtype, mode="r", shape=(size,))
+    return np.fromfile(filename, dtype=dtype, count=size)
+
+
+def _append_array(filename, array, size):
+    # Truncate any partially written data from an interrupted append.
+    with open(filename, "ab") as f:
+        f.truncate(size * array.dtype.itemsize)
+        f.write(array.tobytes())
+
+
+def _read_values(filename, size):
+    values = []
+    with open(filename) as f:
+        for _, line in zip(range(size), f):
+            values.append(json.loads(line))
+    return values
+
+
+def _append_values(filename, values, size):
+    with open(filename, "a+") as f:
+        f.seek(0)
+        for _ in range(size):
+            f.readline()
+        f.truncate(f.tell())
+        for value in values:
+            f.write(json.dumps(value))
+            f.write("\n")
+
+
+def _append_strings(prefix, info, values, size):
+    encoded = [v.encode("utf-8") for v in values]
+    ends = np.cumsum([len(v) for v in encoded], dtype=OFFSET_DTYPE)
+    ends += info["num_bytes"]
+    with open(prefix + ".data", "ab") as f:
+        f.truncate(info["num_bytes"])
+        f.write(b"".join(encoded))
+    _append_array(prefix + ".ends", ends, size)
+    if len(values):
+        info["num_bytes"] = int(ends[-1])
+
+
+def _write_meta(dirname, meta):
+    filename = os.path.join(dirname, META_FILENAME)
+    with open(filename + ".temp", "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(filename + ".temp", filename)
+
+
+def read_meta(dirname):
+    """
+    Reads metadata of a columnar store, including ``num_rows`` and a
+    ``columns`` dict mapping column name to column type.
+    """
+    with open(os.path.join(dirname, META_FILENAME)) as f:
+        return json.load(f)
+
+
+def _column_type(values, encode):
+    if encode:
+        return "dict"
+    if isinstance(values, np.ndarray):
+        if values.dtype.kind in "iu":
+            return "int"
+    elif not len(values):
+        return "unknown"  # Determined on first append.
+    elif all(isinstance(v, (int, np.integer)) for v in values):
+        return "int"
+    elif all(isinstance(v, str) for v in values):
+        return "str"
+    raise ValueError("Unsupported column type; try dictionary encoding")
+
+
+def _prefix(dirname, name, info):
+    # Rewritten string columns are saved under a new stem.
+    return os.path.join(dirname, info.get("stem", name))
+
+
+def _init_column(prefix, values, encode):
+    """
+    Creates empty files of a column, returning the column's metadata.
+    """
+    type_ = _column_type(values, encode)
+    if type_ == "int":
+        dtype = values.dtype.name if isinstance(values, np.ndarray) else "int64"
+        open(prefix + ".int", "wb").close()
+        return {"type": type_, "dtype": dtype}
+    if type_ == "dict":
+        open(prefix + ".codes", "wb").close()
+        open(prefix + ".values", "w").close()
+        return {"type": type_, "num_values": 0}
+    if type_ == "str":
+        open(prefix + ".data", "wb").close()
+        open(prefix + ".ends", "wb").close()
+        return {"type": type_, "num_bytes": 0}
+    return {"type": type_}
+
+
+def append_columns(dirname, columns):
+    """
+    Appends rows to an existing columnar store. This writes only the new rows
+    and atomically updates metadata, so that interrupted appends are ignored.
+
+    :param str dirname: Path to a store created by :func:`save_columns`.
+    :param dict columns: A dict mapping column name to a list of new values.
+        This must include every column in the store.
+    """
+    meta = read_meta(dirname)
+    num_rows = meta["num_rows"]
+    num_new = len(next(iter(columns.values()), ()))
+    assert set(columns) == set(meta["columns"]), "mismatched columns"
+    for name, info in meta["columns"].items():
+        values = columns[name]
+        assert len(values) == num_new, "mismatched column lengths"
+        prefix = _prefix(dirname, name, info)
+        if info["type"] == "unknown":
+            if not num_new:
+                continue
+            info.update(_init_column(prefix, values, False))
+        if info["type"] == "int":
+            array = np.asarray(values, dtype=info["dtype"])
+            _append_array(prefix + ".int", array, num_rows)
+        elif info["type"] == "dict":
+            old_values = _read_values(prefix + ".values", info["num_values"])
+            index = {v: i for i, v in enumerate(old_values)}
+            codes = np.array(
+                [index.setdefault(v, len(index)) for v in values], dtype=CODE_DTYPE
+            )
+            _append_values(
+                prefix + ".values", list(index)[len(old_values) :], len(old_values)
+            )
+            _append_array(prefix + ".codes", codes, num_rows)
+            info["num_values"] = len(index)
+        elif info["type"] == "str":
+            _append_strings(prefix, info, values, num_rows)
+        else:
+            raise ValueError(f"Unknown column type: {info['type']}")
+    meta["num_rows"] = num_rows + num_new
+    _write_meta(dirname, meta)
+
+
+def update_rows(dirname, rows, columns):
+    """
+    Overwrites existing rows of a columnar store in place. Integer and
+    dictionary encoded columns are written in place, and string columns are
+    rewritten only if any of their values change.
+
+    Metadata is updated before rows are overwritten, so an interrupted update
+    leaves a valid store with some rows updated; repeating the update
+    completes it.
+
+    :param str dirname: Path to a store created by :func:`save_columns`.
+    :param rows: A list of indices of rows to overwrite.
+    :param dict columns: A dict mapping column name to a list of new values,
+        one per row. This must include every column in the store.
+    """
+    meta = read_meta(dirname)
+    num_rows = meta["num_rows"]
+    rows = np.asarray(rows, dtype=np.int64)
+    assert set(columns) == set(meta["columns"]), "mismatched columns"
+    if not len(rows):
+        return
+    assert 0 <= rows.min() and rows.max() < num_rows, "row out of bounds"
+
+    # Extend dictionaries and rewrite changed string columns, then metadata.
+    writes = []
+    old_prefixes = []
+    for name, info in meta["columns"].items():
+        values = columns[name]
+        assert len(values) == len(rows), "mismatched column lengths"
+        prefix = _prefix(dirname, name, info)
+        if info["type"] == "int":
+            array = np.asarray(values, dtype=info["dtype"])
+            writes.append((prefix + ".int", array))
+        elif info["type"] == "dict":
+            old_values = _read_values(prefix + ".values", info["num_values"])
+            index = {v: i for i, v in enumerate(old_values)}
+            codes = np.array(
+                [index.setdefault(v, len(index)) for v in values], dtype=CODE_DTYPE
+            )
+            _append_values(
+                prefix + ".values", list(index)[len(old_values) :], len(old_values)
+            )
+            info["num_values"] = len(index)
+            writes.append((prefix + ".codes", codes))
+        elif info["type"] == "str":
+            ends = _read_array(prefix + ".ends", OFFSET_DTYPE, num_rows, True)
+            data = _read_array(prefix + ".data", np.uint8, info["num_bytes"], True)
+            column = StringColumn(data, ends)
+            if all(column[i] == v for i, v in zip(rows.tolist(), values)):
+                continue
+            new_values = column.tolist()
+            for i, v in zip(rows.tolist(), values):
+                new_values[i] = v
+            info["version"] = info.get("version", 0) + 1
+            info["stem"] = f"{name}.v{info['version']}"
+            new_prefix = _prefix(dirname, name, info)
+            open(new_prefix + ".data", "wb").close()
+            open(new_prefix + ".ends", "wb").close()
+            info["num_bytes"] = 0
+            _append_strings(new_prefix, info, new_values, 0)
+            old_prefixes.append(prefix)
+    _write_meta(dirname, meta)
+    for prefix in old_prefixes:
+        os.remove(prefix + ".data")
+        os.remove(prefix + ".ends")
+
+    # Overwrite fixed width values in place.
+    for filename, array in writes:
+        old = np.memmap(filename, dtype=array.dtype, mode="r+", shape=(num_rows,))
+        old[rows] = array
+        old.flush()
+        del old
+
+
+def save_columns(dirname, columns, *, encode=()):
+    """
+    Saves a dict of equal-length columns to a memory-mappable columnar store.
+    The store is a directory with one flat file per array. Integer columns are
+    stored as plain arrays, columns listed in ``encode`` are dictionary
+    encoded, and remaining string columns are stored as utf-8 bytes plus
+    offsets. The type of an empty column is determined by its first append.
+    An existing store at ``dirname`` is atomically replaced.
+
+    :param str dirname: Path to the output directory.
+    :param dict columns: A dict mapping column name to a list or numpy array
+        of values.
+    :param encode: A collection of names of columns to dictionary encode.
+    """
+    temp_dirname = dirname + ".temp"
+    if os.path.exists(temp_dirname):
+        shutil.rmtree(temp_dirname)
+    os.makedirs(temp_dirname)
+
+    # Create empty columns, then append all rows.
+    meta = {"num_rows": 0, "columns": {}}
+    for name, values in columns.items():
+        prefix = os.path.join(temp_dirname, name)
+        meta["columns"][name] = _init_column(prefix, values, name in encode)
+    _write_meta(temp_dirname, meta)
+    append_columns(temp_dirname, columns)
+
+    # Atomically replace any old store.
+    if os.path.exists(dirname):
+        old_dirname = dirname + ".old"
+        os.rename(dirname, old_dirname)
+        os.rename(temp_dirname, dirname)
+        shutil.rmtree(old_dirname)
+    else:
+        os.rename(temp_dirname, dirname)
+
+
+def load_columns(dirname, names=None, *, mmap=True):
+    """
+    Loads some or all columns from a columnar store created by
+    :func:`save_columns`. Only the requested columns are read.
+
+    :param str dirname: Path to the store directory.
+    :param list names: Optional list of column names to load. Defaults to all.
+    :param bool mmap: Whether to memory map arrays rather than read them.
+    :returns: A dict mapping column name to either a numpy array, a
+        :class:`DictColumn`, or a :class:`StringColumn`.
+    :rtype: dict
+    """
+    meta = read_meta(dirname)
+    num_rows = meta["num_rows"]
+    if names is None:
+        names = list(meta["columns"])
+    columns = {}
+    for name in names:
+        info = meta["columns"][name]
+        prefix = _prefix(dirname, name, info)
+        if info["type"] == "int":
+            columns[name] = _read_array(
+                prefix + ".int", np.dtype(info["dtype"]), num_rows, mmap
+            )
+        elif info["type"] == "dict":
+            codes = _read_array(prefix + ".codes", CODE_DTYPE, num_rows, mmap)
+            values = _read_values(prefix + ".values", info["num_values"])
+            columns[name] = DictColumn(codes, values)
+        elif info["type"] == "str":
+            ends = _read_array(prefix + ".ends", OFFSET_DTYPE, num_rows, mmap)
+            data = _read_array(prefix + ".data", np.uint8, info["num_bytes"], mmap)
+            columns[name] = StringColumn(data, ends)
+        elif info["type"] == "unknown":
+            assert num_rows == 0
+            columns[name] = np.zeros(0, np.int64)
+        else:
+            raise ValueError(f"Unknown column type: {info['type']}")
+    return columns
@@ -2,15 +2,22 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import hashlib
+import itertools
+import json
 import logging
 import os
 import shutil
+import sqlite3
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from subprocess import check_call
 
 logger = logging.getLogger(__name__)
 NEXTSTRAIN_DATA = os.path.expanduser("~/github/nextstrain/nextclade/data/sars-cov-2")
 
+# Nextclade columns needed to count mutations.
+MUTATION_COLUMNS = ["qc.overallStatus", "aaSubstitutions", "aaDeletions"]
+
 
 def hash_sequence(seq):
     hasher = hashlib.sha1()
@@ -22,68 +29,176 @@ class NextcladeDB:
     """
     Database to store nextclade results through time, so that only new samples
     need to be sequenced.
+
+    Alignment runs in up to ``max_workers`` concurrent nextclade processes,
+    each on a separate temporary fasta shard, while the caller continues to
+    schedule sequences. Finished shards are committed in completion order.
+
+    :param str fileprefix: Prefix of database files.
+    :param int max_fasta_count: Number of sequences per nextclade invocation.
+    :param int max_workers: Maximum number of concurrent nextclade processes.
+    :param int max_batch_size: Maximum number of rows passed to each call of a
+        batched task.
     """
 
-    def __init__(self, fileprefix="results/nextcladedb", max_fasta_count=4000):
+    def __init__(
+        self,
+        fileprefix="results/nextcladedb",
+        max_fasta_count=4000,
+        max_workers=1,
+        max_batch_size=10000,
+    ):
         fileprefix = os.path.realpath(fileprefix)
-        self.header_filename = fileprefix + ".header.tsv"
-        self.rows_filename = fileprefix + ".rows.tsv"
-        self.rows_temp_filename = fileprefix + "rows.temp.tsv"
-        self.fasta_filename = fileprefix + ".temp.fasta"
-        self.tsv_filename = fileprefix + ".temp.tsv"
-        self.output_dir = os.path.dirname(self.tsv_filename)
-
-        # Load hashes of already-aligned sequences.
-        self._already_aligned = set()
-        if os.path.exists(self.rows_filename):
-            with open(self.rows_filename) as f:
-                for line in f:
-                    key = line.split("\t", 1)[0]
-                    self._already_aligned.add(key)
+        self.fileprefix = fileprefix
+        self.rows_dirname = fileprefix + ".rows"
+        self.manifest_filename = os.path.join(self.rows_dirname, "manifest.json")
+        self.output_dir = os.path.dirname(fileprefix)
+        self._migrate()
+
+        # Remove any segments left by interrupted commits.
+        self._segments = self._read_manifest()
+        for filename in os.listdir(self.rows_dirname):
+            if filename.endswith(".tsv") and filename not in self._segments:
+                os.remove(os.path.join(self.rows_dirname, filename))
+
+        # Open an index of already-aligned sequences.
+        self._index = sqlite3.connect(os.path.join(self.rows_dirname, "index.sqlite"))
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS rows "
+            "(key TEXT PRIMARY KEY, segment TEXT, offset INTEGER)"
+        )
+        self._index.execute("CREATE TABLE IF NOT EXISTS segments (name TEXT)")
+        self._repair_index()
 
         self.max_fasta_count = max_fasta_count
-        self._fasta_file = open(self.fasta_filename, "wt")
+        self.max_workers = max_workers
+        self.max_batch_size = max_batch_size
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._fasta_file = None
+        self._fasta_filename = None
         self._pending = set()
+        self._running = {}  # maps future to set of keys
+        self._shard_count = 0
 
         self._tasks = defaultdict(list)
 
-    def schedule(self, sequence, *fn_args):
+    def schedule(self, sequence, *fn_args, columns=None, batch_key=None):
         """
         Schedule a task for a given input ``sequence``.
+
+        The task ``fn, *args = fn_args`` will be called as ``fn(*args, row)``
+        where ``row`` is a dict mapping column name to value. If ``batch_key``
+        is given, tasks with equal ``batch_key`` are instead called in batches
+        as ``fn(*args, columns)`` where ``columns`` is a dict mapping column
+        name to a list of at most ``max_batch_size`` values, one per scheduled
+        sequence. Tasks with equal ``batch_key`` must have equal ``fn_args``.
+        Batch lists are reused after each call, so tasks should not keep them.
+
+        :param str sequence: A nucleotide sequence.
+        :param list columns: Optional list of column names to parse.
+            Defaults to all columns. Required if ``batch_key`` is given.
+        :param batch_key: An optional hashable key by which to batch calls to
+            the task.
         """
+        if batch_key is not None and not columns:
+            raise ValueError("batched tasks require columns")
         key = hash_sequence(sequence)
-        if key not in self._already_aligned:
-            self._schedule_alignment(key, sequence)
-        self._tasks[key].append(fn_args)
+        if key not in self._pending and not self._is_aligned(key):
+            if not any(key in keys for keys in self._running.values()):
+                self._schedule_alignment(key, sequence)
+        self._tasks[key].append((fn_args, columns, batch_key))
 
-    def maybe_schedule(self, sequence, *fn_args):
+    def maybe_schedule(self, sequence, *fn_args, columns=None, batch_key=None):
         """
         Schedule a task iff no new alignment work is required.
         Tasks requiring new alignment work will be silently dropped.
+        See :meth:`schedule` for arguments.
         """
+        if batch_key is not None and not columns:
+            raise ValueError("batched tasks require columns")
         key = hash_sequence(sequence)
-        if key in self._already_aligned:
-            self._tasks[key].append(fn_args)
+        if self._is_aligned(key):
+            self._tasks[key].append((fn_args, columns, batch_key))
 
     def wait(self, log_every=1000):
         """
         Wait for all scheduled or maybe_scheduled tasks to complete.
         """
         self._flush()
-        with open(self.header_filename) as f:
-            header = f.read().strip().split("\t")
-        with open(self.rows_filename) as f:
-            for i, row in enumerate(f):
-                row = row.strip().split("\t")
-                key = row[0]
-                row = dict(zip(header, row))
-                for fn_args in self._tasks.pop(key, []):
-                    fn, args = fn_args[0], fn_args[1:]
-                    fn(*args, row)
-                if log_every and i % log_every == 0:
-                    print(".", end="", flush=True)
+        self._commit(wait(self._running).done)
+
+        # Look up locations of requested rows, in batches of keys.
+        keys = list(self._tasks)
+        locations = []
+        for start in range(0, len(keys), 500):
+            batch = keys[start : start + 500]
+            query = "SELECT segment, offset, key FROM rows WHERE key IN ({})".format(
+                ",".join("?" * len(batch))
+            )
+            locations.extend(self._index.execute(query, batch))
+        locations.sort()
+
+        # Seek directly to requested rows.
+        i = 0
+        batches = {}
+        for segment, group in itertools.groupby(locations, lambda loc: loc[0]):
+            with open(os.path.join(self.rows_dirname, segment), "rb") as f:
+                header = f.readline().decode("utf-8").rstrip("\r\n").split("\t")
+                positions = {name: j for j, name in enumerate(header)}
+                for _, offset, key in group:
+                    f.seek(offset)
+                    line = f.readline().decode("utf-8").rstrip("\r\n")
+                    tasks = self._tasks.pop(key, [])
+                    self._dispatch(header, positions, line, tasks, batches)
+                    if log_every and i % log_every == 0:
+                        print(".", end="", flush=True)
+                    i += 1
+
+        # Call remaining partial batches.
+        for fn_args, values in batches.values():
+            if values[next(iter(values))]:
+                self._call_batch(fn_args, values)
+
+    def _dispatch(self, header, positions, line, tasks, batches):
+        # Split only as far as needed by projected columns.
+        maxsplit = -1
+        if all(columns is not None for _, columns, _ in tasks):
+            maxsplit = 1 + max(
+                (positions[name] for _, columns, _ in tasks for name in columns),
+                default=0,
+            )
+        fields = line.split("\t", maxsplit)
+
+        for fn_args, columns, batch_key in tasks:
+            if batch_key is not None:
+                batch_key = batch_key, tuple(columns)
+                if batch_key not in batches:
+                    batches[batch_key] = fn_args, {name: [] for name in columns}
+                values = batches[batch_key][1]
+                for name in columns:
+                    values[name].append(fields[positions[name]])
+                if len(values[columns[0]]) >= self.max_batch_size:
+                    self._call_batch(fn_args, values)
+                continue
+            if columns is None:
+                row = dict(zip(header, fields))
+            else:
+                row = {name: fields[positions[name]] for name in columns}
+            fn, args = fn_args[0], fn_args[1:]
+            fn(*args, row)
+
+    @staticmethod
+    def _call_batch(fn_args, values):
+        fn, args = fn_args[0], fn_args[1:]
+        fn(*args, values)
+        for column in values.values():
+            column.clear()
 
     def _schedule_alignment(self, key, sequence):
+        if self._fasta_file is None:
+            self._fasta_filename = f"{self.fileprefix}.temp.{self._shard_count}.fasta"
+            self._shard_count += 1
+            self._fasta_file = open(self._fasta_filename, "wt")
         self._fasta_file.write(">")
         self._fasta_file.write(key)
         self._fasta_file.write("\n")
@@ -94,9 +209,21 @@ class NextcladeDB:
             self._flush()
 
     def _flush(self):
+        # Commit any finished shards, blocking only if all workers are busy.
+        self._commit(d for d in list(self._running) if d.done())
+        while len(self._running) >= self.max_workers:
+            self._commit(wait(self._running, return_when=FIRST_COMPLETED).done)
         if not self._pending:
             return
+
         self._fasta_file.close()
+        self._fasta_file = None
+        future = self._executor.submit(self._align, self._fasta_filename)
+        self._running[future] = self._pending
+        self._pending = set()
+
+    def _align(self, fasta_filename):
+        tsv_filename = fasta_filename[: -len(".fasta")] + ".tsv"
         cmd = [
             "./nextclade",
             f"--input-root-seq={NEXTSTRAIN_DATA}/reference.fasta",
@@ -105,30 +232,105 @@ class NextcladeDB:
             f"--input-tree={NEXTSTRAIN_DATA}/tree.json",
             f"--input-qc-config={NEXTSTRAIN_DATA}/qc.json",
             f"--input-pcr-primers={NEXTSTRAIN_DATA}/primers.csv",
-            f"--input-fasta={self.fasta_filename}",
-            f"--output-tsv={self.tsv_filename}",
+            f"--input-fasta={fasta_filename}",
+            f"--output-tsv={tsv_filename}",
             f"--output-dir={self.output_dir}",
         ]
+        if self.max_workers > 1:
+            # Split cores evenly among concurrent nextclade processes.
+            jobs = max(1, (os.cpu_count() or 1) // self.max_workers)
+            cmd.append(f"--jobs={jobs}")
         logger.info(" ".join(cmd))
         check_call(cmd)
+        os.remove(fasta_filename)
+        return tsv_filename
+
+    def _commit(self, futures):
+        for future in futures:
+            self._running.pop(future)
+            tsv_filename = future.result()
+
+            # Move the output into an immutable segment, then atomically
+            # update the manifest. Segments not in the manifest are ignored.
+            segment = f"{self._next_segment():06d}.tsv"
+            os.rename(tsv_filename, os.path.join(self.rows_dirname, segment))
+            self._segments.append(segment)
+            self._write_manifest()
+            self._index_segment(segment)
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_filename):
+            return []
+        with open(self.manifest_filename) as f:
+            return json.load(f)["segments"]
+
+    def _write_manifest(self):
+        temp_filename = self.manifest_filename + ".temp"
+        with open(temp_filename, "w") as f:
+            json.dump({"segments": self._segments}, f)
+        os.replace(temp_filename, self.manifest_filename)
+
+    def _next_segment(self):
+        if not self._segments:
+            return 0
+        return int(self._segments[-1].split(".")[0]) + 1
+
+    def _is_aligned(self, key):
+        query = "SELECT 1 FROM rows WHERE key = ?"
+        return self._index.execute(query, (key,)).fetchone() is not None
 
-        # Append to a copy to ensure atomicity.
-        if os.path.exists(self.rows_filename):
-            shutil.copyfile(self.rows_filename, self.rows_temp_filename)
-        with open(self.tsv_filename) as f:
-            with open(self.rows_temp_filename, "a") as frows:
-                for i, line in enumerate(f):
-                    if i:
-                        frows.write(line)
-                    else:
-                        with open(self.header_filename, "w") as fheader:
-                            fheader.write(line)
-        os.rename(self.rows_temp_filename, self.rows_filename)
-        os.remove(self.fasta_filename)
-        os.remove(self.tsv_filename)
-        self._fasta_file = open(self.fasta_filename, "w")
-        self._already_aligned.update(self._pending)
-        self._pending.clear()
+    def _index_segment(self, segment):
+        rows = []
+        with open(os.path.join(self.rows_dirname, segment), "rb") as f:
+            offset = len(f.readline())
+            for line in f:
+                key = line.split(b"\t", 1)[0].decode("utf-8")
+                rows.append((key, segment, offset))
+                offset += len(line)
+        with self._index:
+            self._index.executemany("INSERT OR IGNORE INTO rows VALUES (?, ?, ?)", rows)
+            self._index.execute("INSERT INTO segments VALUES (?)", (segment,))
+
+    def _repair_index(self):
+        """
+        Synchronizes the index with the manifest, which is the source of truth.
+        """
+        indexed = {name for name, in self._index.execute("SELECT name FROM segments")}
+        stale = indexed - set(self._segments)
+        if stale:
+            with self._index:
+                for segment in stale:
+                    self._index.execute(
+                        "DELETE FROM rows WHERE segment = ?", (segment,)
+                    )
+                    self._index.execute(
+                        "DELETE FROM segments WHERE name = ?", (segment,)
+                    )
+        for segment in self._segments:
+            if segment not in indexed:
+                logger.info(f"Indexing {segment}")
+                self._index_segment(segment)
+
+    def _migrate(self):
+        """
+        Converts a legacy single-file database to a segmented database.
+        """
+        os.makedirs(self.rows_dirname, exist_ok=True)
+        header_filename = self.fileprefix + ".header.tsv"
+        rows_filename = self.fileprefix + ".rows.tsv"
+        if not os.path.exists(rows_filename) or os.path.exists(self.manifest_filename):
+            return
+        logger.info(f"Migrating {rows_filename} to {self.rows_dirname}")
+        segment = os.path.join(self.rows_dirname, "000000.tsv")
+        with open(segment, "w") as fout:
+            with open(header_filename) as f:
+                shutil.copyfileobj(f, fout)
+            with open(rows_filename) as f:
+                shutil.copyfileobj(f, fout)
+        self._segments = ["000000.tsv"]
+        self._write_manifest()
+        os.remove(rows_filename)
+        os.remove(header_filename)
 
 
 class ShardedFastaWriter:
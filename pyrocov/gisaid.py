@@ -0,0 +1,239 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import io
+import json
+import lzma
+import mmap
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+from .columnar import load_columns, save_columns
+
+SEQUENCE_KEY = b', "sequence": "'
+ACCESSION_KEY = b'"covv_accession_id": "'
+FEED_FILENAME = "feed.json"
+
+
+def open_feed(filename):
+    """
+    Opens a GISAID feed for reading text lines. Files ending in ``.xz`` are
+    decompressed on the fly, by a multithreaded ``xz`` process if available.
+    """
+    if not filename.endswith(".xz"):
+        return open(filename)
+    xz = shutil.which("xz")
+    if xz is None:
+        return lzma.open(filename, "rt")
+    with open(filename, "rb") as f:
+        proc = subprocess.Popen([xz, "-dc", "-T0"], stdin=f, stdout=subprocess.PIPE)
+    return _ProcessReader(proc)
+
+
+class _ProcessReader(io.TextIOWrapper):
+    def __init__(self, proc):
+        super().__init__(proc.stdout)
+        self.proc = proc
+
+    def close(self):
+        super().close()
+        if self.proc.poll() is None:
+            self.proc.kill()  # Stop decompressing if closed early.
+        if self.proc.wait() > 0:
+            raise subprocess.CalledProcessError(self.proc.returncode, self.proc.args)
+
+
+def read_feed(filename, *, batch_size=1000, max_batches=64):
+    """
+    Iterates over batches of lines of a plain or ``.xz`` compressed GISAID
+    feed. Reading and decompression run in a background thread that feeds a
+    bounded queue, so they overlap with processing of previous batches.
+
+    :param str filename: Path to a JSON lines file, optionally ``.xz``.
+    :param int batch_size: Number of lines per batch.
+    :param int max_batches: Maximum number of batches to read ahead.
+    :returns: An iterator over lists of lines.
+    """
+    batches = queue.Queue(max_batches)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            with open_feed(filename) as f:
+                batch = []
+                for line in f:
+                    batch.append(line)
+                    if len(batch) == batch_size:
+                        if not put(batch):
+                            return
+                        batch = []
+                if batch:
+                    put(batch)
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+        thread.join()
+
+
+def iter_feed(filename, **kwargs):
+    """
+    Iterates over lines of a plain or ``.xz`` compressed GISAID feed, reading
+    ahead in a background thread. See :func:`read_feed` for arguments.
+    """
+    for batch in read_feed(filename, **kwargs):
+        yield from batch
+
+
+def scan_feed(filename, start=0, end=None):
+    """
+    Scans records of an uncompressed GISAID feed via a memory map, skipping
+    over sequences without decoding them. This yields only records whose
+    lines begin in the byte range ``[start,end)``.
+
+    :param str filename: Path to an uncompressed JSON lines file.
+    :param int start: Optional start byte.
+    :param int end: Optional end byte.
+    :returns: An iterator over ``(metadata, offset, length)`` tuples where
+        ``metadata`` is a bytes JSON object of all fields preceding the
+        sequence, and ``offset, length`` locate the JSON encoded sequence
+        string in the file.
+    """
+    if os.path.getsize(filename) == 0:
+        return
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if end is None:
+                end = len(m)
+            pos = 0
+            if start:
+                # Skip the partial line, unless start is already at a line start.
+                pos = m.find(b"\n", start - 1)
+                if pos == -1:
+                    return
+                pos += 1
+            while pos < end:
+                line_end = m.find(b"\n", pos)
+                if line_end == -1:
+                    line_end = len(m)
+                key = m.find(SEQUENCE_KEY, pos, line_end)
+                if key == -1:
+                    raise ValueError(f"Missing sequence at byte {pos} of {filename}")
+                offset = key + len(SEQUENCE_KEY)
+                quote = _find_quote(m, offset, line_end)
+                if quote == -1:
+                    raise ValueError(
+                        f"Unterminated sequence at byte {pos} of {filename}"
+                    )
+                length = quote - offset
+                yield m[pos:key] + b"}", offset, length
+                pos = line_end + 1
+
+
+def _find_quote(m, start, end):
+    """
+    Finds the first unescaped double quote in ``m[start:end]``, or -1.
+    """
+    pos = m.find(b'"', start, end)
+    while pos != -1:
+        # A quote is escaped by an odd number of preceding backslashes.
+        slash = pos
+        while slash > start and m[slash - 1 : slash] == b"\\":
+            slash -= 1
+        if (pos - slash) % 2 == 0:
+            return pos
+        pos = m.find(b'"', pos + 1, end)
+    return -1
+
+
+def _feed_fingerprint(filename):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def save_index(dirname, index, filename):
+    """
+    Saves a sequence index of a feed, as recorded from :func:`scan_feed`,
+    together with the size and modification time of the feed.
+
+    :param str dirname: Path to an index directory.
+    :param dict index: A dict mapping column name to list, with columns
+        ``accession_id``, ``offset`` and ``length``.
+    :param str filename: Path to the indexed feed.
+    """
+    save_columns(dirname, index)
+    with open(os.path.join(dirname, FEED_FILENAME), "w") as f:
+        json.dump(_feed_fingerprint(filename), f)
+
+
+def load_index(dirname, filename):
+    """
+    Loads a sequence index saved by :func:`save_index`, or returns None if
+    the index is missing or if the feed has changed since it was indexed.
+
+    :param str dirname: Path to an index directory.
+    :param str filename: Path to the indexed feed.
+    :rtype: dict or None
+    """
+    try:
+        with open(os.path.join(dirname, FEED_FILENAME)) as f:
+            fingerprint = json.load(f)
+    except FileNotFoundError:
+        return None
+    if fingerprint != _feed_fingerprint(filename):
+        return None
+    return load_columns(dirname)
+
+
+def get_accession_id(metadata):
+    """
+    Extracts the accession id from the bytes metadata of a record, without
+    parsing JSON.
+    """
+    start = metadata.index(ACCESSION_KEY) + len(ACCESSION_KEY)
+    return metadata[start : metadata.index(b'"', start)].decode("utf-8")
+
+
+def read_sequences(filename, offsets, lengths):
+    """
+    Reads sequences from an uncompressed GISAID feed at locations previously
+    found by :func:`scan_feed`.
+
+    :param str filename: Path to an uncompressed JSON lines file.
+    :param offsets: An iterable of byte offsets of sequences.
+    :param lengths: An iterable of byte lengths of sequences.
+    :returns: An iterator over sequence strings.
+    """
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for offset, length in zip(offsets, lengths):
+                # Validate the location, in case the feed has been updated.
+                start = offset - len(SEQUENCE_KEY)
+                end = offset + length
+                if m[start:offset] != SEQUENCE_KEY or m[end : end + 1] != b'"':
+                    raise ValueError(f"Stale sequence index for {filename}")
+                yield json.loads(m[offset - 1 : offset + length + 1])
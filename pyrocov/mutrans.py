@@ -1,11 +1,12 @@
 # Copyright Contributors to the Pyro-Cov project.
 # SPDX-License-Identifier: Apache-2.0
 
+import contextlib
 import datetime
 import functools
 import logging
 import math
-import pickle
+import os
 import re
 import warnings
 from collections import Counter, OrderedDict, defaultdict
@@ -17,8 +18,10 @@ import pyro
 import pyro.distributions as dist
 import torch
 from pyro import poutine
+from pyro.distributions.transforms import biject_to, transform_to
 from pyro.infer import SVI, JitTrace_ELBO, Trace_ELBO
 from pyro.infer.autoguide import (
+    AutoContinuous,
     AutoDelta,
     AutoGuideList,
     AutoLowRankMultivariateNormal,
@@ -26,14 +29,16 @@ from pyro.infer.autoguide import (
     AutoStructured,
 )
 from pyro.infer.reparam import LocScaleReparam
-from pyro.ops.streaming import CountMeanVarianceStats, StatsOfDict
+from pyro.nn import PyroParam
 from pyro.optim import ClippedAdam
 from pyro.poutine.util import site_is_subsample
 
 import pyrocov.geo
 
 from . import pangolin, sarscov2
-from .util import pearson_correlation
+from .columnar import DictColumn, load_columns
+from .telemetry import Telemetry
+from .util import pearson_correlation, torch_load
 
 logger = logging.getLogger(__name__)
 
@@ -43,25 +48,54 @@ GENERATION_TIME = 5.5  # in days
 START_DATE = "2019-12-01"
 
 
-def date_range(stop):
+def date_range(stop, timestep=TIMESTEP):
     start = datetime.datetime.strptime(START_DATE, "%Y-%m-%d")
-    step = datetime.timedelta(days=TIMESTEP)
+    step = datetime.timedelta(days=timestep)
     return np.array([start + step * t for t in range(stop)])
 
 
+def factorize(column):
+    """
+    Converts a column to a pair ``(codes, values)`` of an integer array of
+    codes and a list of distinct values, such that ``column[i]`` equals
+    ``values[codes[i]]``.
+    """
+    if isinstance(column, DictColumn):
+        return np.asarray(column.codes), column.values
+    index: dict = {}
+    codes = [index.setdefault(value, len(index)) for value in column]
+    return np.array(codes, dtype=np.int64), list(index)
+
+
+def match_field(field, pattern):
+    """
+    Searches a regular expression ``pattern`` in a factorized column
+    ``field = (codes, values)``, evaluating once per distinct value.
+
+    :returns: A boolean array, true for rows that match.
+    :rtype: numpy.ndarray
+    """
+    codes, values = field
+    search = re.compile(pattern).search
+    matches = np.array([bool(search(value)) for value in values], dtype=bool)
+    return matches[codes]
+
+
 def get_fine_regions(columns, min_samples=50):
     """
     Select regions that have at least ``min_samples`` samples.
     Remaining regions will be coarsely aggregated up to country level.
     """
     # Count number of samples in each subregion.
-    counts = Counter()
-    for location in columns["location"]:
+    codes, values = factorize(columns["location"])
+    value_counts = np.bincount(codes, minlength=len(values)).tolist()
+    counts: Counter = Counter()
+    for location, count in zip(values, value_counts):
         parts = location.split("/")
         if len(parts) < 2:
             continue
         parts = tuple(p.strip() for p in parts[:3])
-        counts[parts] += 1
+        counts[parts] += count
 
     # Select fine countries.
     return frozenset(parts for parts, count in counts.items() if count >= min_samples)
@@ -119,32 +153,66 @@ def load_gisaid_data(
     include={},
     exclude={},
     end_day=None,
-    gisaid_columns_filename="results/gisaid.columns.pkl",
+    timestep=TIMESTEP,
+    gisaid_columns_dirname="results/gisaid.columns",
     nextclade_features_filename="results/nextclade.features.pt",
 ) -> dict:
     """
-    Loads the two files gisaid_columns_filename and nextclade_features_filename,
-    converts teh input to PyTorch tensors and truncates the data according to
-    ``include`` and ``exclude``.
+    Loads the columnar store gisaid_columns_dirname and the file
+    nextclade_features_filename, converts teh input to PyTorch tensors and
+    truncates the data according to ``include`` and ``exclude``.
+
+    This is equivalent to :func:`load_gisaid_daily` followed by
+    :func:`rebin_gisaid_data`.
 
     Keyword arguments:
     device -- torch device to use
     include --
     exclude --
     end_day -- last day to include
-    gisaid_columns_filename --
+    timestep -- number of days per time bin
+    gisaid_columns_dirname --
+    nextclade_features_filename --
+    """
+    daily = load_gisaid_daily(
+        device=device,
+        include=include,
+        exclude=exclude,
+        gisaid_columns_dirname=gisaid_columns_dirname,
+        nextclade_features_filename=nextclade_features_filename,
+    )
+    return rebin_gisaid_data(daily, timestep=timestep, end_day=end_day)
+
+
+def load_gisaid_daily(
+    *,
+    device="cpu",
+    include={},
+    exclude={},
+    gisaid_columns_dirname="results/gisaid.columns",
+    nextclade_features_filename="results/nextclade.features.pt",
+) -> dict:
+    """
+    Like :func:`load_gisaid_data` but returns sparse daily counts, which can
+    be cheaply binned and truncated by :func:`rebin_gisaid_data`. Sparse
+    entries are ordered by first observation.
+
+    Keyword arguments:
+    device -- torch device to use
+    include --
+    exclude --
+    gisaid_columns_dirname --
     nextclade_features_filename --
     """
     logger.info("Loading data")
     include = include.copy()
     exclude = exclude.copy()
 
-    if end_day:
-        logger.info(f"Load gisaid data end_day: {end_day}")
-
-    # Load ``gisaid_columns_filename``
-    with open(gisaid_columns_filename, "rb") as f:
-        columns = pickle.load(f)
+    # Load only the needed columns of ``gisaid_columns_dirname``.
+    names = ["day", "location", "lineage"]
+    if "virus_name" in include or "virus_name" in exclude:
+        names.append("virus_name")
+    columns = load_columns(gisaid_columns_dirname, names)
 
     logger.info("Training on {} rows with columns:".format(len(columns["day"])))
     logger.info(", ".join(columns.keys()))
@@ -187,77 +255,125 @@ def load_gisaid_data(
         features = features[:, :1] * 0
     logger.info("Loaded {} feature matrix".format(" x ".join(map(str, features.shape))))
 
-    # Aggregate regions
-
-    # Get lineages
-    lineages = list(map(pangolin.compress, columns["lineage"]))
+    # Map lineages to ids, once per distinct lineage.
     lineage_id_inv = list(map(pangolin.compress, aa_features["lineages"]))
     lineage_id = {k: i for i, k in enumerate(lineage_id_inv)}
-
-    sparse_data: dict = Counter()
-    location_id: dict = OrderedDict()
-
-    # Set of lineages that are skipped
-    skipped = set()
-
-    # Generate sparse_data
-    for virus_name, day, location, lineage in zip(
-        columns["virus_name"], columns["day"], columns["location"], lineages
-    ):
-        if lineage not in lineage_id:
-            if lineage not in skipped:
-                skipped.add(lineage)
-                logger.warning(f"WARNING skipping unsampled lineage {lineage}")
-            continue
-
-        # Filter by include/exclude
-        row = {
-            "virus_name": virus_name,
-            "location": location,
-            "day": day,
-            "lineage": pangolin.compress(lineage),
-        }
-        if not all(re.search(v, row[k]) for k, v in include.items()):
-            continue
-        if any(re.search(v, row[k]) for k, v in exclude.items()):
-            continue
-
-        # Filter by day
-        if end_day is not None:
-            if day > end_day:
-                continue
-
-        # preprocess parts
+    lineage_codes, lineages = factorize(columns["lineage"])
+    lineages = list(map(pangolin.compress, lineages))
+    lineage_counts = np.bincount(lineage_codes, minlength=len(lineages))
+    for lineage, count in zip(lineages, lineage_counts.tolist()):
+        if count and lineage not in lineage_id:
+            logger.warning(f"WARNING skipping unsampled lineage {lineage}")
+    s = np.array([lineage_id.get(k, -1) for k in lineages], dtype=np.int64)
+    s = s[lineage_codes]
+
+    # Aggregate locations, once per distinct location.
+    location_codes, locations = factorize(columns["location"])
+    coarse_id: dict = {}
+    p = np.full(len(locations), -1, dtype=np.int64)
+    for i, location in enumerate(locations):
         parts = location.split("/")
         if len(parts) < 2:
             continue
-        parts = tuple(p.strip() for p in parts[:3])
+        parts = tuple(part.strip() for part in parts[:3])
         if len(parts) == 3 and parts not in fine_regions:
             parts = parts[:2]
-        location = " / ".join(parts)
+        p[i] = coarse_id.setdefault(" / ".join(parts), len(coarse_id))
+    p = p[location_codes]
+
+    # Filter rows.
+    day = np.asarray(columns["day"])
+    keep = (s >= 0) & (p >= 0)
+    fields = {
+        "location": (location_codes, locations),
+        "lineage": (lineage_codes, lineages),
+    }
+    if "virus_name" in columns:
+        # Virus names are nearly unique, so match these row by row.
+        virus_names = columns["virus_name"].tolist()
+        fields["virus_name"] = (np.arange(len(virus_names)), virus_names)
+    for k, v in include.items():
+        keep &= match_field(fields[k], v)
+    for k, v in exclude.items():
+        keep &= ~match_field(fields[k], v)
+    day = day[keep]
+    p = p[keep]
+    s = s[keep]
+
+    # Aggregate to sparse daily counts, ordered by first observation.
+    P = len(coarse_id)
+    S = len(lineage_id)
+    index, first, count = np.unique(
+        (day * P + p) * S + s, return_index=True, return_counts=True
+    )
+    order = np.argsort(first, kind="stable")
+    index = torch.from_numpy(index[order])
+    count = torch.from_numpy(count[order])
 
-        p = location_id.setdefault(location, len(location_id))
-        s = lineage_id[lineage]
-        t = day // TIMESTEP
-        sparse_data[t, p, s] += 1
+    return {
+        "day": index // (P * S),
+        "place": index // S % P,
+        "lineage": index % S,
+        "count": count,
+        "locations": list(coarse_id),
+        "max_day": int(columns["day"].max()),
+        "num_rows": len(columns["day"]),
+        "mutations": mutations,
+        "features": features,
+        "lineage_id": lineage_id,
+        "lineage_id_inv": lineage_id_inv,
+    }
 
-    # Generate weekly_strains tensor from sparse_data
+
+def rebin_gisaid_data(daily, *, timestep=TIMESTEP, end_day=None) -> dict:
+    """
+    Aggregates sparse daily counts from :func:`load_gisaid_daily` into a
+    dense ``weekly_strains`` tensor with time bins of ``timestep`` days,
+    optionally truncated to ``end_day``. This is cheap relative to loading.
+
+    Keyword arguments:
+    timestep -- number of days per time bin
+    end_day -- last day to include
+    """
+    day = daily["day"]
+    p = daily["place"]
+    s = daily["lineage"]
+    count = daily["count"]
     if end_day is not None:
-        T = 1 + end_day // TIMESTEP
-    else:
-        T = 1 + max(columns["day"]) // TIMESTEP
+        logger.info(f"Load gisaid data end_day: {end_day}")
+        keep = day <= end_day
+        day, p, s, count = day[keep], p[keep], s[keep], count[keep]
+
+    # Order locations by first observation.
+    observed, first = np.unique(p.numpy(), return_index=True)
+    observed = observed[np.argsort(first)]
+    location_id = OrderedDict(
+        (daily["locations"][i], j) for j, i in enumerate(observed.tolist())
+    )
+    new_p = torch.full((len(daily["locations"]),), -1, dtype=torch.long)
+    new_p[observed] = torch.arange(len(observed))
+    p = new_p[p]
 
+    # Generate weekly_strains tensor from flat indices.
+    if end_day is not None:
+        T = 1 + end_day // timestep
+    else:
+        T = 1 + daily["max_day"] // timestep
     P = len(location_id)
-    S = len(lineage_id)
-    weekly_strains = torch.zeros(T, P, S)
-    for (t, p, s), n in sparse_data.items():
-        weekly_strains[t, p, s] = n
+    S = len(daily["lineage_id"])
+    index = ((day // timestep) * P + p) * S + s
+    weekly_strains = torch.zeros(T * P * S)
+    weekly_strains.scatter_add_(
+        0, index.to(weekly_strains.device), count.to(weekly_strains)
+    )
+    weekly_strains = weekly_strains.reshape(T, P, S)
 
     logger.info(f"Dataset size [T x P x S] {T} x {P} x {S}")
 
+    num_rows = daily["num_rows"]
     logger.info(
-        f"Keeping {int(weekly_strains.sum())}/{len(lineages)} rows "
-        f"(dropped {len(lineages) - int(weekly_strains.sum())})"
+        f"Keeping {int(weekly_strains.sum())}/{num_rows} rows "
+        f"(dropped {num_rows - int(weekly_strains.sum())})"
     )
 
     # Filter regions.
@@ -271,18 +387,19 @@ def load_gisaid_data(
 
     # Construct region-local time scales centered around observations.
     num_obs = weekly_strains.sum(-1)
-    local_time = torch.arange(float(len(num_obs))) * TIMESTEP / GENERATION_TIME
+    local_time = torch.arange(float(len(num_obs))) * timestep / GENERATION_TIME
     local_time = local_time[:, None]
     local_time = local_time - (local_time * num_obs).sum(0) / num_obs.sum(0)
 
     return {
         "location_id": location_id,
-        "mutations": mutations,
+        "mutations": daily["mutations"],
         "weekly_strains": weekly_strains,
-        "features": features,
-        "lineage_id": lineage_id,
-        "lineage_id_inv": lineage_id_inv,
+        "features": daily["features"],
+        "lineage_id": daily["lineage_id"],
+        "lineage_id_inv": daily["lineage_id_inv"],
         "local_time": local_time,
+        "timestep": timestep,
     }
 
 
@@ -377,16 +494,17 @@ def load_jhu_data(gisaid_data: dict) -> dict:
     daily_cases.clamp_(min=0)
     assert daily_cases.shape[1] == len(gisaid_data["location_id"])
 
-    # Convert daily counts to TIMESTEP counts (e.g. weekly).
+    # Convert daily counts to timestep counts (e.g. weekly).
+    timestep = gisaid_data.get("timestep", TIMESTEP)
     start_date = datetime.datetime.strptime(START_DATE, "%Y-%m-%d")
     jhu_start_date = pyrocov.geo.parse_date(us_cases_df.columns[11])
     assert start_date < jhu_start_date
     dt = (jhu_start_date - start_date).days
     T = len(gisaid_data["weekly_strains"])
     weekly_cases = daily_cases.new_zeros(T, len(locations))
-    for w in range(TIMESTEP):
-        t0 = (w + dt) // TIMESTEP
-        source = daily_cases[w::TIMESTEP]
+    for w in range(timestep):
+        t0 = (w + dt) // timestep
+        source = daily_cases[w::timestep]
         destin = weekly_cases[t0 : t0 + len(source)]
         destin[:] += source[: len(destin)]
     assert weekly_cases.sum() > 0
@@ -397,7 +515,56 @@ def load_jhu_data(gisaid_data: dict) -> dict:
     }
 
 
-def model(dataset, model_type, *, forecast_steps=None):
+def compact_observations(dataset):
+    """
+    Computes sufficient statistics of ``dataset["weekly_strains"]`` for the
+    ``"compact"`` likelihood in :func:`model`.
+
+    Since logits are linear in local time, the multinomial data term depends
+    only on per-(place,strain) totals and time-weighted totals. Only the
+    normalizer needs each nonempty ``(time, place)`` cell, and the factorial
+    terms are constant.
+
+    :param dict dataset: A dataset with ``"weekly_strains"`` and
+        ``"local_time"``, and optionally a ``"strain_mask"``.
+    :returns: A dict with ``"time"`` and ``"place"`` tensors of shape ``[C]``
+        over nonempty cells, a ``"total"`` tensor of shape ``[C]``,
+        ``"strain_total"`` and ``"time_total"`` tensors of shape ``[P, S]``,
+        and a ``"log_normalizer"`` tensor of shape ``[P]``. Given a
+        ``"strain_mask"``, statistics have leading batch shape ``[K, 1]``.
+    :rtype: dict
+    """
+    weekly_strains = dataset["weekly_strains"]  # [T, P, S]
+    local_time = dataset["local_time"]  # [T, P]
+    P = weekly_strains.size(1)
+    time, place = weekly_strains.sum(-1).nonzero(as_tuple=True)
+    counts = weekly_strains[time, place]  # [C, S]
+    log_factorial = (counts + 1).lgamma()  # [C, S]
+    strain_total = weekly_strains.sum(0)  # [P, S]
+    time_total = torch.einsum("tps,tp->ps", weekly_strains, local_time)  # [P, S]
+    if "strain_mask" in dataset:
+        mask = dataset["strain_mask"].to(counts.dtype)  # [K, S]
+        total = (mask @ counts.T)[:, None]  # [K, 1, C]
+        log_factorial = (mask @ log_factorial.T)[:, None]  # [K, 1, C]
+        strain_total = strain_total * mask[:, None, None]  # [K, 1, P, S]
+        time_total = time_total * mask[:, None, None]  # [K, 1, P, S]
+    else:
+        total = counts.sum(-1)  # [C]
+        log_factorial = log_factorial.sum(-1)  # [C]
+    log_normalizer = (total + 1).lgamma() - log_factorial
+    return {
+        "time": time,
+        "place": place,
+        "total": total,
+        "strain_total": strain_total,
+        "time_total": time_total,
+        "log_normalizer": log_normalizer.new_zeros(
+            log_normalizer.shape[:-1] + (P,)
+        ).index_add_(-1, place, log_normalizer),
+    }
+
+
+def model(dataset, model_type, *, forecast_steps=None, place_subsample_size=None):
     """
     Bayesian regression model of lineage portions as a function of mutation features.
 
@@ -407,12 +574,34 @@ def model(dataset, model_type, *, forecast_steps=None):
     - During prediction (after training), the likelihood statement is omitted
       and instead a ``probs`` tensor is recorded; this is the predicted lineage
       portions in each (time, regin) bin.
+
+    If ``model_type`` contains ``"compact"``, the multinomial likelihood is
+    evaluated via sufficient statistics and only on nonempty ``(time, place)``
+    cells, which yields the same density. Statistics are read from
+    ``dataset["compact_obs"]`` if present, as computed by
+    :func:`compact_observations`.
+
+    If ``place_subsample_size`` is given, each call observes only a random
+    subset of places, and ``pyro.plate`` scales the likelihood and local
+    latent variables to yield an unbiased ELBO estimate.
+
+    If ``dataset`` contains a ``[K, S]``-shaped boolean ``"strain_mask"``, the
+    model is batched over ``K`` independent fits in a ``"fits"`` plate, where
+    each fit observes only the counts of its masked strains. This allows
+    leave-one-out experiments to be fit in a single batch.
     """
     # Tensor shapes are commented at at the end of some lines.
     features = dataset["features"]
     local_time = dataset["local_time"][..., None]  # [T, P, 1]
     T, P, _ = local_time.shape
     S, F = features.shape
+    strain_mask = dataset.get("strain_mask")
+    batch_shape = ()
+    fits_plate = contextlib.ExitStack()  # A no-op context.
+    if strain_mask is not None:
+        assert "poisson" not in model_type
+        batch_shape = (len(strain_mask), 1)
+        fits_plate = pyro.plate("fits", len(strain_mask), dim=-4)
     if forecast_steps is None:  # During inference.
         weekly_strains = dataset["weekly_strains"]
         assert weekly_strains.shape == (T, P, S)
@@ -423,22 +612,32 @@ def model(dataset, model_type, *, forecast_steps=None):
         local_time = t0 + dt * torch.arange(float(T))[:, None, None]
         assert local_time.shape == (T, P, 1)
     strain_plate = pyro.plate("strain", S, dim=-1)
-    place_plate = pyro.plate("place", P, dim=-2)
+    place_plate = pyro.plate("place", P, dim=-2, subsample_size=place_subsample_size)
     time_plate = pyro.plate("time", T, dim=-3)
 
     # Configure reparametrization (which does not affect model density).
     reparam = {}
     if "reparam" in model_type:
-        local_time = local_time + pyro.param(
-            "local_time", lambda: torch.zeros(P, S)
-        )  # [T, P, S]
+        time_shift = pyro.param(
+            "local_time", lambda: torch.zeros(batch_shape + (P, S))
+        )  # [P, S]
         reparam["coef"] = LocScaleReparam()
         if "skip" not in model_type:
             reparam["rate_loc"] = LocScaleReparam()
         reparam["init_loc"] = LocScaleReparam()
         reparam["rate"] = LocScaleReparam()
         reparam["init"] = LocScaleReparam()
-    with poutine.reparam(config=reparam):
+        if strain_mask is not None:
+            # Learn centeredness independently for each fit.
+            for name in reparam:
+                shape = batch_shape + (1, 1) + ((F,) if name == "coef" else ())
+                centered = pyro.param(
+                    f"{name}_centered",
+                    lambda: torch.full(shape, 0.5),
+                    constraint=dist.constraints.unit_interval,
+                )
+                reparam[name] = LocScaleReparam(centered=centered)
+    with poutine.reparam(config=reparam), fits_plate:
 
         # Sample global random variables.
         coef_scale = pyro.sample("coef_scale", dist.LogNormal(-4, 2))
@@ -455,9 +654,14 @@ def model(dataset, model_type, *, forecast_steps=None):
         # on strain and place. Assume initial infections depend strongly on
         # strain and place.
         Dist = dist.Logistic if "sparse" in model_type else dist.Normal
-        coef = pyro.sample("coef", Dist(torch.zeros(F), coef_scale).to_event(1))  # [F]
+        coef = pyro.sample(
+            "coef", Dist(torch.zeros(F), coef_scale[..., None]).to_event(1)
+        )  # [F]
         with strain_plate:
             rate_loc_loc = 0.01 * coef @ features.T
+            if coef.dim() > 1:
+                # Drop the batch dim of coef that is aligned with the strain plate.
+                rate_loc_loc = rate_loc_loc.squeeze(-2)  # [..., 1, 1, S]
             if "skip" in model_type:
                 rate_loc = pyro.deterministic("rate_loc", rate_loc_loc)  # [S]
             else:
@@ -465,11 +669,54 @@ def model(dataset, model_type, *, forecast_steps=None):
                     "rate_loc", dist.Normal(rate_loc_loc, rate_loc_scale)
                 )  # [S]
             init_loc = pyro.sample("init_loc", dist.Normal(0, init_loc_scale))  # [S]
-        with place_plate, strain_plate:
+        with place_plate as place, strain_plate:
             rate = pyro.sample("rate", dist.Normal(rate_loc, rate_scale))  # [P, S]
             init = pyro.sample("init", dist.Normal(init_loc, init_scale))  # [P, S]
+        subsample = place_plate.subsample_size < P
+        if subsample:
+            assert forecast_steps is None, "cannot subsample during prediction"
+            local_time = local_time[:, place]
+            if "reparam" in model_type:
+                time_shift = time_shift.index_select(-2, place)
 
         # Finally observe counts.
+        compact = "compact" in model_type and "poisson" not in model_type
+        if forecast_steps is None and compact:
+            obs = dataset.get("compact_obs")
+            if obs is None:
+                obs = compact_observations(dataset)
+            t, p, total = obs["time"], obs["place"], obs["total"]
+            strain_total = obs["strain_total"]
+            time_total = obs["time_total"]
+            log_normalizer = obs["log_normalizer"]
+            if subsample:
+                # Select cells of subsampled places, renumbering places.
+                pos = place.new_full((P,), -1)
+                pos[place] = torch.arange(len(place), device=place.device)
+                p = pos[p]
+                c = (p >= 0).nonzero(as_tuple=True)[0]
+                t, p, total = t[c], p[c], total[..., c]
+                strain_total = strain_total.index_select(-2, place)
+                time_total = time_total.index_select(-2, place)
+                log_normalizer = log_normalizer[..., place]
+            time = local_time[t, p]  # [C, 1]
+            if "reparam" in model_type:
+                time_total = time_total + time_shift * strain_total
+                time = time + time_shift[..., p, :]  # [C, S]
+            log_prob = (init * strain_total + rate * time_total).sum(-1)  # [P]
+            log_prob = log_prob + log_normalizer
+            logits = init[..., p, :] + rate[..., p, :] * time  # [C, S]
+            log_prob = log_prob.index_add(-1, p, -total * logits.logsumexp(-1))
+            with place_plate:
+                pyro.factor("obs", log_prob[..., None])  # [P, 1]
+            return
+
+        if subsample:
+            weekly_strains = weekly_strains[:, place]
+        if strain_mask is not None and forecast_steps is None:
+            weekly_strains = weekly_strains * strain_mask[:, None, None]  # [K,T,P,S]
+        if "reparam" in model_type:
+            local_time = local_time + time_shift  # [T, P, S]
         logits = init + rate * local_time  # [T, P, S]
         if forecast_steps is None:  # During inference.
             if "poisson" in model_type:
@@ -508,11 +755,13 @@ class InitLocFn:
     def __init__(self, dataset):
         # Initialize init.
         init = dataset["weekly_strains"].sum(0)  # [P, S]
+        if "strain_mask" in dataset:
+            init = init * dataset["strain_mask"][:, None, None]  # [K, 1, P, S]
         init.add_(1 / init.size(-1)).div_(init.sum(-1, True))
         init.log_().sub_(init.median(-1, True).values)
         self.init = init  # [P, S]
         self.init_decentered = init / 2
-        self.init_loc = init.mean(0)  # [S]
+        self.init_loc = init.mean(-2, keepdim=init.dim() > 2)  # [S]
         self.init_loc_decentered = self.init_loc / 2
         assert not torch.isnan(self.init).any()
         self.pois = dataset["weekly_strains"].sum(-1, True).clamp(min=0.1)  # [T, P, 1]
@@ -551,6 +800,66 @@ class InitLocFn:
         raise ValueError(f"InitLocFn found unhandled site {repr(name)}; please update.")
 
 
+class AutoBatchedLowRankMultivariateNormal(AutoLowRankMultivariateNormal):
+    """
+    Low-rank multivariate normal guide with independent parameters for each
+    fit in a ``"fits"`` plate of the model, as used for batched fits. This is
+    equivalent to :class:`AutoLowRankMultivariateNormal` for models without
+    a ``"fits"`` plate.
+    """
+
+    def _setup_prototype(self, *args, **kwargs):
+        AutoContinuous._setup_prototype(self, *args, **kwargs)
+        self._latent_plates = None
+        frame = self._prototype_frames.get("fits")
+        if frame is None:
+            batch_shape: tuple = ()
+            loc = self._init_loc()
+        else:
+            # Pack latent variables of each fit along a batch dimension.
+            batch_shape = (frame.size,) + (1,) * (-1 - frame.dim)
+            locs = []
+            for name, site in self.prototype_trace.iter_stochastic_nodes():
+                value = biject_to(site["fn"].support).inv(site["value"].detach())
+                assert value.dim() - site["fn"].event_dim + frame.dim == 0
+                self._unconstrained_shapes[name] = (1,) + value.shape[1:]
+                locs.append(value.reshape(frame.size, -1))
+            loc = torch.cat(locs, -1)
+            self.latent_dim = loc.size(-1)
+            loc = loc.reshape(batch_shape + (self.latent_dim,))
+        self.loc = torch.nn.Parameter(loc)
+        if self.rank is None:
+            self.rank = int(round(self.latent_dim ** 0.5))
+        self.scale = PyroParam(
+            loc.new_full(
+                batch_shape + (self.latent_dim,), 0.5 ** 0.5 * self._init_scale
+            ),
+            constraint=self.scale_constraint,
+        )
+        self.cov_factor = torch.nn.Parameter(
+            loc.new_empty(batch_shape + (self.latent_dim, self.rank)).normal_(
+                0, 1 / self.rank ** 0.5
+            )
+        )
+
+    def sample_latent(self, *args, **kwargs):
+        if "fits" not in self._prototype_frames:
+            return super().sample_latent(*args, **kwargs)
+        plates = self._create_plates(*args, **kwargs)
+        with plates["fits"]:
+            latent = super().sample_latent(*args, **kwargs)
+        self._latent_plates = plates
+        return latent
+
+    def _create_plates(self, *args, **kwargs):
+        # Reuse plates created by sample_latent(), since each plate may be
+        # created only once per trace.
+        plates, self._latent_plates = self._latent_plates, None
+        if plates is None:
+            plates = super()._create_plates(*args, **kwargs)
+        return plates
+
+
 class Guide(AutoGuideList):
     """
     Custom guide for large-scale inference.
@@ -559,8 +868,8 @@ class Guide(AutoGuideList):
     with a mean field guide over remaining latent variables.
     """
 
-    def __init__(self, model, init_loc_fn, init_scale, rank):
-        super().__init__(model)
+    def __init__(self, model, init_loc_fn, init_scale, rank, create_plates=None):
+        super().__init__(model, create_plates=create_plates)
 
         # Jointly estimate globals, mutation coefficients, and strain coefficients.
         mvn = [
@@ -577,7 +886,7 @@ class Guide(AutoGuideList):
             "init_loc_decentered",
         ]
         self.append(
-            AutoLowRankMultivariateNormal(
+            AutoBatchedLowRankMultivariateNormal(
                 poutine.block(model, expose=mvn),
                 init_loc_fn=init_loc_fn,
                 init_scale=init_scale,
@@ -590,6 +899,34 @@ class Guide(AutoGuideList):
         self.append(AutoNormal(model, init_loc_fn=init_loc_fn, init_scale=init_scale))
 
 
+class _ChunkedMeanVariance:
+    """
+    Streaming mean and variance, updated by chunks of samples via the
+    parallel variant of Welford's algorithm.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, samples):
+        count = samples.size(0)
+        mean = samples.mean(0)
+        m2 = (samples - mean).pow_(2).sum(0)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * (count / total)
+        self.m2 += m2 + delta.pow_(2).mul_(self.count * count / total)
+        self.count = total
+
+    def variance(self):
+        return self.m2 / (self.count - 1)
+
+
 @torch.no_grad()
 @poutine.mask(mask=False)
 def predict(
@@ -602,7 +939,30 @@ def predict(
     vectorize=None,
     save_params=("rate", "init", "probs"),
     forecast_steps=0,
+    chunk_size=None,
+    max_chunk_numel=5e7,
+    quantiles=(),
+    num_forecast_samples=0,
 ) -> dict:
+    """
+    Computes the median, and the posterior mean and standard deviation of
+    ``save_params`` and small sites, from ``num_samples`` particles.
+
+    Particles are drawn in vectorized chunks of ``chunk_size``, so that
+    memory is bounded regardless of ``num_samples``. By default
+    ``chunk_size`` is chosen so each chunk of ``probs`` has at most
+    ``max_chunk_numel`` elements; ``vectorize=True`` draws a single chunk and
+    ``vectorize=False`` draws one particle at a time.
+
+    If ``quantiles`` are given, these are computed for sites whose samples
+    total at most ``max_chunk_numel`` elements, and saved as
+    ``result["quantiles"]``.
+
+    If ``num_forecast_samples`` is positive, that many samples of ``rate``
+    and ``init`` are saved as ``result["samples"]``, for use by
+    :class:`Forecast`.
+    """
+
     def get_conditionals(data):
         trace = poutine.trace(poutine.condition(model, data)).get_trace(
             dataset, model_type, forecast_steps=forecast_steps
@@ -624,28 +984,341 @@ def predict(
     save_params = {
         k for k, v in result["median"].items() if v.numel() < 1e5 or k in save_params
     }
-    if vectorize is None:
-        vectorize = result["median"]["probs"].numel() < 1e6
-    if vectorize:
-        with pyro.plate("particles", num_samples, dim=-4):
+    if chunk_size is None:
+        if vectorize is None:
+            chunk_size = int(max_chunk_numel // result["median"]["probs"].numel())
+        else:
+            chunk_size = num_samples if vectorize else 1
+    chunk_size = max(1, min(num_samples, chunk_size))
+    if chunk_size < num_samples:
+        logger.info(f"Predicting in chunks of {chunk_size} samples")
+    shapes = {k: result["median"][k].shape for k in save_params}
+    stats = {k: _ChunkedMeanVariance() for k in save_params}
+    quantile_samples: dict = {
+        k: []
+        for k, shape in shapes.items()
+        if quantiles and num_samples * shape.numel() <= max_chunk_numel
+    }
+    forecast_samples: dict = {
+        k: [] for k in ("rate", "init") if num_forecast_samples > 0
+    }
+    dim = -5 if "strain_mask" in dataset else -4
+    for start in range(0, num_samples, chunk_size):
+        size = min(chunk_size, num_samples - start)
+        with pyro.plate("particles", size, dim=dim):
             samples = get_conditionals(guide())
-        for k, v in samples.items():
-            if k in save_params:
-                result["mean"][k] = v.mean(0).squeeze()
-                result["std"][k] = v.std(0).squeeze()
-    else:
-        stats = StatsOfDict({k: CountMeanVarianceStats for k in save_params})
-        for _ in range(num_samples):
-            stats.update(get_conditionals(guide()))
-            print(".", end="", flush=True)
-        for name, stats_ in stats.get().items():
-            if "mean" in stats_:
-                result["mean"][name] = stats_["mean"]
-            if "variance" in stats_:
-                result["std"][name] = stats_["variance"].sqrt()
+        for k, shape in shapes.items():
+            # Some sites, e.g. of delta guides, may not depend on the particle.
+            v = samples[k].reshape((-1,) + shape).expand((size,) + shape)
+            stats[k].update(v)
+            if k in quantile_samples:
+                quantile_samples[k].append(v)
+            if k in forecast_samples and start < num_forecast_samples:
+                forecast_samples[k].append(v[: num_forecast_samples - start].clone())
+        del samples
+    for k, stats_ in stats.items():
+        result["mean"][k] = stats_.mean
+        result["std"][k] = stats_.variance().sqrt()
+    if quantile_samples:
+        q = torch.tensor(quantiles, dtype=torch.get_default_dtype())
+        for k, v in quantile_samples.items():
+            result["quantiles"][k] = torch.quantile(torch.cat(v), q.to(v[0]), dim=0)
+    for k, v in forecast_samples.items():
+        result["samples"][k] = torch.cat(v)
     return dict(result)
 
 
+class Forecast:
+    """
+    Lazily forecasts strain proportions ``probs = softmax(init + rate * time)``
+    from posterior samples or point estimates of ``rate`` and ``init``, for
+    any time steps including future time steps, and any subsets of places and
+    strains. Results of recent queries are cached.
+
+    Example::
+
+        forecast = Forecast.from_result(result)
+        probs = forecast.probs(range(T + 6), places=["Europe / United Kingdom"])
+        probs["mean"]  # [T + 6, 1, S]
+
+    :param torch.Tensor rate: Either a ``[P, S]`` point estimate or ``[N, P,
+        S]`` samples of ``rate``.
+    :param torch.Tensor init: A point estimate or samples of ``init``, of the
+        same shape as ``rate``.
+    :param torch.Tensor local_time: The ``[T, P]`` ``dataset["local_time"]``.
+    :param torch.Tensor time_shift: An optional ``[P, S]`` learned shift of
+        ``local_time``, as saved in ``result["params"]["local_time"]``.
+    :param dict location_id: An optional dict mapping place name to index.
+    :param list lineage_id_inv: An optional list of strain names.
+    :param int timestep: Number of days per time step.
+    :param int cache_size: Maximum number of cached queries.
+    :param int max_chunk_numel: Maximum number of elements of ``probs``
+        computed at once.
+    """
+
+    def __init__(
+        self,
+        rate,
+        init,
+        local_time,
+        time_shift=None,
+        *,
+        location_id=None,
+        lineage_id_inv=None,
+        timestep=TIMESTEP,
+        cache_size=16,
+        max_chunk_numel=5e7,
+    ):
+        assert rate.shape == init.shape
+        assert rate.dim() in (2, 3)
+        self.rate = rate
+        self.init = init
+        self.t0 = local_time[0]  # [P]
+        self.dt = local_time[1] - local_time[0]  # [P]
+        self.time_shift = time_shift
+        self.location_id = location_id
+        self.lineage_id = (
+            None
+            if lineage_id_inv is None
+            else {name: i for i, name in enumerate(lineage_id_inv)}
+        )
+        self.timestep = timestep
+        self.cache_size = cache_size
+        self.max_chunk_numel = max_chunk_numel
+        self._cache: OrderedDict = OrderedDict()
+
+    @classmethod
+    def from_result(cls, result, **kwargs):
+        """
+        Creates a forecast from a result of :func:`fit_svi`, using posterior
+        samples if saved, and otherwise median point estimates.
+        """
+        summary = result.get("samples") or result["median"]
+        kwargs.setdefault("location_id", result.get("location_id"))
+        kwargs.setdefault("lineage_id_inv", result.get("lineage_id_inv"))
+        return cls(
+            summary["rate"],
+            summary["init"],
+            result["local_time"],
+            result.get("params", {}).get("local_time"),
+            **kwargs,
+        )
+
+    def _index(self, keys, names):
+        if keys is None:
+            return None
+        ids = [names[k] if isinstance(k, str) else int(k) for k in keys]
+        return tuple(ids)
+
+    def time_index(self, date):
+        """
+        Returns the time step containing a date, which may be a
+        ``datetime.date`` or a string formatted like ``"2021-12-01"``.
+        """
+        if isinstance(date, str):
+            date = datetime.datetime.strptime(date, "%Y-%m-%d")
+        start = datetime.datetime.strptime(START_DATE, "%Y-%m-%d")
+        if not isinstance(date, datetime.datetime):
+            date = datetime.datetime(date.year, date.month, date.day)
+        return (date - start).days // self.timestep
+
+    @torch.no_grad()
+    def probs(self, times, places=None, strains=None):
+        """
+        Computes posterior mean and standard deviation of ``probs``. Cached
+        results are shared, so should not be modified.
+
+        :param times: An iterable of time steps, possibly beyond the data.
+        :param places: An optional iterable of place indices or names.
+            Defaults to all places.
+        :param strains: An optional iterable of strain indices or names.
+            Defaults to all strains. Proportions are normalized over all
+            strains, not just the selected strains.
+        :returns: A dict with ``"mean"`` and ``"std"`` tensors of shape
+            ``[len(times), len(places), len(strains)]``.
+        :rtype: dict
+        """
+        key = (
+            tuple(int(t) for t in times),
+            self._index(places, self.location_id),
+            self._index(strains, self.lineage_id),
+        )
+        result = self._cache.get(key)
+        if result is not None:
+            self._cache.move_to_end(key)
+            return result
+        result = self._compute(*key)
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def _compute(self, times, places, strains):
+        rate, init, t0, dt = self.rate, self.init, self.t0, self.dt
+        time_shift = self.time_shift
+        if places is not None:
+            p = torch.tensor(places, dtype=torch.long, device=rate.device)
+            rate = rate.index_select(-2, p)
+            init = init.index_select(-2, p)
+            t0, dt = t0[p], dt[p]
+            if time_shift is not None:
+                time_shift = time_shift.index_select(-2, p)
+        t = torch.tensor(times, dtype=rate.dtype, device=rate.device)
+        time = (t0 + dt * t[:, None])[..., None]  # [T, P, 1]
+        if time_shift is not None:
+            time = time + time_shift.to(time)  # [T, P, S]
+        s = None
+        if strains is not None:
+            s = torch.tensor(strains, dtype=torch.long, device=rate.device)
+
+        def get_probs(rate, init):
+            probs = (init + rate * time).softmax(-1)
+            return probs if s is None else probs.index_select(-1, s)
+
+        if rate.dim() == 2:  # A point estimate.
+            probs = get_probs(rate, init)
+            return {"mean": probs, "std": torch.zeros_like(probs)}
+        stats = _ChunkedMeanVariance()
+        numel = len(times) * rate[0].numel()
+        chunk_size = max(1, int(self.max_chunk_numel // max(1, numel)))
+        for start in range(0, len(rate), chunk_size):
+            end = start + chunk_size
+            stats.update(get_probs(rate[start:end, None], init[start:end, None]))
+        return {"mean": stats.mean, "std": stats.variance().sqrt()}
+
+
+@torch.no_grad()
+def _scalar_medians(guide, names):
+    """
+    Computes medians of only the latent variables ``names``, which is much
+    cheaper than ``guide.median()`` for guides with many latent variables.
+    """
+    if not names:
+        return {}
+    if isinstance(guide, AutoGuideList):
+        result = {}
+        for part in guide:
+            result.update(_scalar_medians(part, names))
+        return result
+    if isinstance(guide, AutoDelta):
+        return {
+            name: getattr(guide, name).detach()
+            for name, _ in guide.prototype_trace.iter_stochastic_nodes()
+            if name in names
+        }
+    if isinstance(guide, AutoNormal):
+        return {
+            name: biject_to(site["fn"].support)(guide._get_loc_and_scale(name)[0])
+            for name, site in guide.prototype_trace.iter_stochastic_nodes()
+            if name in names
+        }
+    if isinstance(guide, AutoLowRankMultivariateNormal):
+        # Avoid computing scales from the low-rank covariance.
+        return {
+            site["name"]: biject_to(site["fn"].support)(value)
+            for site, value in guide._unpack_latent(guide.loc.detach())
+            if site["name"] in names
+        }
+    return {k: v for k, v in guide.median().items() if k in names}
+
+
+def _site_axes(site, shape):
+    # Finds axes of an unconstrained site value that are indexed by plates.
+    axes = {}
+    for frame in site["cond_indep_stack"]:
+        axis = len(shape) - site["fn"].event_dim + frame.dim
+        if axis >= 0:
+            axes[frame.name] = axis
+    return axes
+
+
+def _remap_index(shape, axes, ids):
+    # Maps each element of a new value to a flat index into an old value, or -1.
+    old_shape = list(shape)
+    for name, axis in axes.items():
+        old_shape[axis] = ids[name][1]
+    index = torch.arange(int(np.prod(old_shape))).reshape(old_shape)
+    for name, axis in axes.items():
+        new_to_old = ids[name][0]
+        index = index.index_select(axis, new_to_old.clamp(min=0))
+        missing = (new_to_old < 0).reshape((-1,) + (1,) * (len(shape) - axis - 1))
+        index.masked_fill_(missing, -1)
+    return index, int(np.prod(old_shape))
+
+
+@torch.no_grad()
+def _warm_start(guide, dataset, warm_start):
+    """
+    Initializes guide and model parameters from a previous fit, remapping
+    places and strains by name. Values of new places and strains are left
+    as initialized.
+    """
+    place_ids = [warm_start["location_id"].get(k, -1) for k in dataset["location_id"]]
+    strain_id = {k: i for i, k in enumerate(warm_start["lineage_id_inv"])}
+    strain_ids = [strain_id.get(k, -1) for k in dataset["lineage_id_inv"]]
+    ids = {
+        "place": (torch.tensor(place_ids), len(warm_start["location_id"])),
+        "strain": (torch.tensor(strain_ids), len(strain_id)),
+    }
+    logger.info(
+        "Warm starting from {} of {} places and {} of {} strains".format(
+            sum(i >= 0 for i in place_ids),
+            len(place_ids),
+            sum(i >= 0 for i in strain_ids),
+            len(strain_ids),
+        )
+    )
+
+    # Compute an index into the flattened old value of each parameter.
+    store = pyro.get_param_store()
+    indices = {}
+    if "local_time" in store:
+        shape = store["local_time"].shape
+        indices["local_time"] = _remap_index(shape, {"place": 0, "strain": 1}, ids)
+    for part in guide if isinstance(guide, AutoGuideList) else [guide]:
+        if not isinstance(part, (AutoContinuous, AutoNormal, AutoDelta)):
+            raise ValueError(f"Cannot warm start a {type(part).__name__} guide")
+        sites = dict(part.prototype_trace.iter_stochastic_nodes())
+        if isinstance(part, AutoContinuous):
+            # Parameters are packed along their leading dimension.
+            rows, old_rows = [], 0
+            for name, shape in part._unconstrained_shapes.items():
+                index, old_size = _remap_index(
+                    shape, _site_axes(sites[name], shape), ids
+                )
+                index = index.reshape(-1)
+                rows.append(torch.where(index >= 0, index + old_rows, index))
+                old_rows += old_size
+            row = torch.cat(rows)
+        for _, value in part.named_parameters():
+            name = store.param_name(value)
+            if isinstance(part, AutoContinuous):
+                inner = int(np.prod(value.shape[1:]))
+                index = row[:, None] * inner + torch.arange(inner)
+                index.masked_fill_(row[:, None] < 0, -1)
+                indices[name] = index.reshape(value.shape), old_rows * inner
+            else:
+                site = sites[name.split(".")[-1]]
+                axes = _site_axes(site, value.shape)
+                indices[name] = _remap_index(value.shape, axes, ids)
+
+    # Copy old values, leaving other parameters as initialized.
+    constraints = store.get_state()["constraints"]
+    for name, value in store.named_parameters():
+        if name not in warm_start["params"]:
+            continue
+        old = warm_start["params"][name].to(device=value.device, dtype=value.dtype)
+        new = store[name]
+        if name in indices:
+            index, old_size = indices[name]
+            if old.numel() != old_size:
+                continue
+            index = index.to(value.device)
+            old = torch.where(index >= 0, old.reshape(-1)[index.clamp(min=0)], new)
+        if old.shape == new.shape:
+            value.copy_(transform_to(constraints[name]).inv(old))
+
+
 def fit_svi(
     dataset: dict,
     *,
@@ -663,9 +1336,58 @@ def fit_svi(
     log_every=50,
     seed=20210319,
     check_loss=False,
+    place_subsample_size=None,
+    converge_window=None,
+    converge_rtol=1e-4,
+    converge_param_rtol=0.05,
+    converge_patience=3,
+    checkpoint=None,
+    checkpoint_every=100,
+    resume=False,
+    warm_start=None,
+    telemetry_every=None,
+    telemetry_file=None,
+    forecast_samples=0,
 ) -> dict:
     """
     Fits a variational posterior using stochastic variational inference (SVI).
+
+    If ``place_subsample_size`` is given, each step subsamples places, so
+    that step cost does not grow with the number of places. This is
+    supported only by the ``"map"``, ``"normal"``, and custom guides.
+
+    If ``converge_window`` is given, inference stops before ``num_steps``
+    once ``converge_patience`` consecutive windows have each changed the
+    median loss by less than ``converge_rtol``, in either direction, and the
+    median ``coef`` and scalar latent variables by less than
+    ``converge_param_rtol``, relative to the previous window. The stopping
+    step is saved as ``result["converged_step"]``.
+
+    If ``checkpoint`` is a filename, the param store, optimizer state, RNG
+    state, and loss series are saved there every ``checkpoint_every`` steps.
+    If also ``resume`` is true and the checkpoint exists, inference continues
+    from the checkpoint, reproducing the steps of an uninterrupted fit. (With
+    ``jit=True`` the resumed fit is equivalent but not bitwise identical,
+    since tracing consumes random numbers.) The checkpoint is removed once
+    the fit completes.
+
+    If ``warm_start`` is a previous result with ``"params"``,
+    ``"location_id"``, and ``"lineage_id_inv"``, parameters are initialized
+    from matching places and lineages of that result. New places and
+    lineages are initialized by :class:`InitLocFn`. The ``dataset`` must
+    also include ``"location_id"`` and ``"lineage_id_inv"``.
+
+    Every ``telemetry_every`` steps (by default ``log_every``, or never if
+    0), gradient norms and medians of scalar latent variables are recorded
+    in ``result["series"]``, at steps listed
+    in ``result["series_steps"]`` and taking ``result["step_times"]``
+    seconds. Records are also appended to the JSON lines file
+    ``telemetry_file`` if given. ``result["series"]["loss"]`` records every
+    step.
+
+    If ``forecast_samples`` is positive, that many posterior samples of
+    ``rate`` and ``init`` are saved, so that :meth:`Forecast.from_result`
+    can forecast any horizon without refitting.
     """
     start_time = default_timer()
 
@@ -674,16 +1396,39 @@ def fit_svi(
     pyro.clear_param_store()
     param_store = pyro.get_param_store()
 
+    # Precompute observed cells once, rather than on every step.
+    if "compact" in model_type:
+        dataset = dataset.copy()
+        dataset["compact_obs"] = compact_observations(dataset)
+
+    # Optionally subsample places, sharing the subsample between model and guide.
+    create_plates = None
+    if place_subsample_size is not None:
+        if guide_type in ("full", "structured", "gaussian"):
+            raise ValueError(f"guide_type {guide_type} does not support subsampling")
+        P = dataset["local_time"].size(1)
+        logger.info(f"Subsampling {place_subsample_size} of {P} places per step")
+
+        def create_place_plate(*args, place_subsample_size=None, **kwargs):
+            return pyro.plate("place", P, dim=-2, subsample_size=place_subsample_size)
+
+        create_plates = create_place_plate
+
     # Initialize guide so we can count parameters and register hooks.
     cond_data = {k: torch.as_tensor(v) for k, v in cond_data.items()}
     model_ = poutine.condition(model, cond_data)
     init_loc_fn = InitLocFn(dataset)
     if guide_type == "map":
-        guide = AutoDelta(model_, init_loc_fn=init_loc_fn)
+        guide = AutoDelta(model_, init_loc_fn=init_loc_fn, create_plates=create_plates)
     elif guide_type == "normal":
-        guide = AutoNormal(model_, init_loc_fn=init_loc_fn, init_scale=0.01)
+        guide = AutoNormal(
+            model_,
+            init_loc_fn=init_loc_fn,
+            init_scale=0.01,
+            create_plates=create_plates,
+        )
     elif guide_type == "full":
-        guide = AutoLowRankMultivariateNormal(
+        guide = AutoBatchedLowRankMultivariateNormal(
             model_, init_loc_fn=init_loc_fn, init_scale=0.01, rank=rank
         )
     elif guide_type == "structured":
@@ -707,9 +1452,19 @@ def fit_svi(
             model_, init_loc_fn=init_loc_fn, init_scale=0.01, backend="funsor"
         )
     else:
-        guide = Guide(model_, init_loc_fn=init_loc_fn, init_scale=0.01, rank=rank)
+        guide = Guide(
+            model_,
+            init_loc_fn=init_loc_fn,
+            init_scale=0.01,
+            rank=rank,
+            create_plates=create_plates,
+        )
     # This initializes the guide:
     latent_shapes = {k: v.shape for k, v in guide(dataset, model_type).items()}
+    if warm_start is not None:
+        if "strain_mask" in dataset:
+            raise ValueError("warm_start is not supported for batched fits")
+        _warm_start(guide, dataset, warm_start)
     latent_numel = {k: v.numel() for k, v in latent_shapes.items()}
     logger.info(
         "\n".join(
@@ -726,14 +1481,12 @@ def fit_svi(
         )
     )
 
-    # Log gradient norms during inference.
-    series: dict = defaultdict(list)
-
-    def hook(g, series):
-        series.append(torch.linalg.norm(g.reshape(-1), math.inf).item())
-
-    for name, value in pyro.get_param_store().named_parameters():
-        value.register_hook(functools.partial(hook, series=series[name]))
+    # Record gradient norms and scalar medians during inference.
+    if telemetry_every is None:
+        telemetry_every = log_every
+    telemetry = Telemetry(num_steps, every=telemetry_every, filename=telemetry_file)
+    telemetry.watch(dict(param_store.named_parameters()))
+    scalars = [k for k, v in latent_numel.items() if v == 1]
 
     def optim_config(param_name):
         config: dict = {
@@ -741,8 +1494,7 @@ def fit_svi(
             "lrd": learning_rate_decay ** (1 / num_steps),
             "clip_norm": clip_norm,
         }
-        scalars = [k for k, v in latent_numel.items() if v == 1]
-        if any("locs." + s in name for s in scalars):
+        if any("locs." + s in param_name for s in scalars):
             config["lr"] *= 0.2
         elif "scales" in param_name:
             config["lr"] *= 0.1
@@ -760,19 +1512,43 @@ def fit_svi(
 
     optim = ClippedAdam(optim_config)
     Elbo = JitTrace_ELBO if jit else Trace_ELBO
-    elbo = Elbo(max_plate_nesting=3, ignore_jit_warnings=True)
+    max_plate_nesting = 4 if "strain_mask" in dataset else 3
+    elbo = Elbo(max_plate_nesting=max_plate_nesting, ignore_jit_warnings=True)
     svi = SVI(model_, guide, optim, elbo)
     losses = []
     num_obs = dataset["weekly_strains"].count_nonzero()
-    for step in range(num_steps):
-        loss = svi.step(dataset=dataset, model_type=model_type)
+    converged_step = None
+    prev_window = None
+    num_converged = 0
+    start_step = 0
+    if checkpoint is not None and resume and os.path.exists(checkpoint):
+        logger.info(f"Resuming from {checkpoint}")
+        state = torch_load(checkpoint, map_location=torch.empty(()).device)
+        start_step = state["step"]
+        with torch.no_grad():
+            for name, value in param_store.named_parameters():
+                value.copy_(state["params"][name])
+        optim.set_state(state["optim"])
+        losses.extend(state["losses"])
+        telemetry.load_state_dict(state["telemetry"])
+        prev_window = state["prev_window"]
+        num_converged = state["num_converged"]
+        pyro.util.set_rng_state(state["rng"])
+        if torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["cuda_rng"])
+    for step in range(start_step, num_steps):
+        telemetry.begin_step(step)
+        loss = svi.step(
+            dataset=dataset,
+            model_type=model_type,
+            place_subsample_size=place_subsample_size,
+        )
         assert not math.isnan(loss)
         losses.append(loss)
-        median = guide.median()
-        for name, value in median.items():
-            if value.numel() == 1:
-                series[name].append(float(value))
         if log_every and step % log_every == 0:
+            median = _scalar_medians(guide, scalars)
+            telemetry.end_step(step, loss, lambda: median)
+            telemetry.flush()
             logger.info(
                 " ".join(
                     [f"step {step: >4d} L={loss / num_obs:0.6g}"]
@@ -781,14 +1557,70 @@ def fit_svi(
                             "".join(p[0] for p in k.split("_")).upper(), v.item()
                         )
                         for k, v in median.items()
-                        if v.numel() == 1
                     ]
                 )
             )
+        else:
+            telemetry.end_step(
+                step, loss, functools.partial(_scalar_medians, guide, scalars)
+            )
         if check_loss and step >= 50:
             prev = torch.tensor(losses[-50:-25], device="cpu").median().item()
             curr = torch.tensor(losses[-25:], device="cpu").median().item()
             assert (curr - prev) < num_obs, "loss is increasing"
+        if converge_window and (step + 1) % converge_window == 0:
+            # Compare smoothed loss and key parameters to the previous window.
+            window_loss = torch.tensor(losses[-converge_window:], device="cpu")
+            window_loss = window_loss.median()
+            median = guide.median()
+            params = {
+                k: v.detach().clone()
+                for k, v in median.items()
+                if v.numel() == 1 or k.startswith("coef")
+            }
+            if prev_window is not None:
+                prev_loss, prev_params = prev_window
+                loss_change = (prev_loss - window_loss).item() / abs(prev_loss.item())
+                param_change = max(
+                    (v - prev_params[k]).norm().item()
+                    / max(prev_params[k].norm().item(), 1e-6)
+                    for k, v in params.items()
+                )
+                if (
+                    abs(loss_change) < converge_rtol
+                    and param_change < converge_param_rtol
+                ):
+                    num_converged += 1
+                else:
+                    num_converged = 0
+                if num_converged >= converge_patience:
+                    converged_step = step
+                    logger.info(
+                        f"Converged at step {step} with relative loss change "
+                        f"{loss_change:0.3g} and parameter change {param_change:0.3g}"
+                    )
+                    break
+            prev_window = window_loss, params
+        if checkpoint is not None and (step + 1) % checkpoint_every == 0:
+            state = {
+                "step": step + 1,
+                "params": {
+                    k: v.detach().clone() for k, v in param_store.named_parameters()
+                },
+                "optim": optim.get_state(),
+                "losses": losses,
+                "telemetry": telemetry.state_dict(),
+                "prev_window": prev_window,
+                "num_converged": num_converged,
+                "rng": pyro.util.get_rng_state(),
+                "cuda_rng": (
+                    torch.cuda.get_rng_state_all()
+                    if torch.cuda.is_available()
+                    else None
+                ),
+            }
+            torch.save(state, checkpoint + ".temp")
+            os.replace(checkpoint + ".temp", checkpoint)
 
     result = predict(
         model_,
@@ -797,16 +1629,25 @@ def fit_svi(
         model_type,
         num_samples=num_samples,
         forecast_steps=forecast_steps,
+        num_forecast_samples=forecast_samples,
     )
+    result["local_time"] = dataset["local_time"]
     result["losses"] = losses
+    result["converged_step"] = converged_step
+    telemetry.flush()
+    series = telemetry.series()
+    result["series_steps"] = series.pop("step")
+    result["step_times"] = series.pop("time")
     series["loss"] = losses
-    result["series"] = dict(series)
+    result["series"] = series
     result["params"] = {
         k: v.detach().float().cpu().clone()
         for k, v in param_store.items()
         if v.numel() < 1e7
     }
     result["walltime"] = default_timer() - start_time
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
     return result
 
 
@@ -0,0 +1,317 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+from timeit import default_timer
+
+from .util import torch_load
+
+logger = logging.getLogger(__name__)
+
+
+class Ref:
+    """
+    A reference to the result of a :class:`Scheduler` task. Refs may be
+    passed as arguments to other tasks, creating dependencies.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"Ref({self.name!r})"
+
+
+class _Task:
+    def __init__(self, name, fn, args, kwargs, memory, local, filename):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.memory = memory
+        self.local = local
+        self.filename = filename
+        self.deps = []
+        for arg in list(args) + list(kwargs.values()):
+            if isinstance(arg, Ref) and arg.name not in self.deps:
+                self.deps.append(arg.name)
+
+
+def _timed_call(fn, args, kwargs):
+    start_time = default_timer()
+    result = fn(*args, **kwargs)
+    return result, default_timer() - start_time
+
+
+class Scheduler:
+    """
+    Runs a dependency graph of tasks on a bounded pool of worker processes.
+
+    Tasks are added with unique names, and adding a task with an existing
+    name simply returns a :class:`Ref` to the existing task, so shared work
+    such as dataset loading is deduplicated. Tasks run in the order they were
+    added, as soon as their dependencies are complete, with at most ``jobs``
+    tasks running at once and with total estimated memory of running tasks
+    at most ``max_memory``. Results are released as soon as all tasks
+    depending on them have completed.
+
+    Task status is saved to an optional JSON ``status_file``. On resume, a
+    task that completed in a previous run and that saved its result to its
+    ``filename`` is loaded from that file rather than rerun, and its
+    dependencies are not run at all.
+
+    Example::
+
+        scheduler = Scheduler(jobs=4, status_file="results/status.json")
+        data = scheduler.add("data", load_data, args, local=True)
+        fits = [scheduler.add(f"fit.{c}", fit, args, data, c) for c in configs]
+        results = scheduler.run(fits)
+
+    :param int jobs: Maximum number of tasks to run at once. If at most 1,
+        all tasks run sequentially in this process.
+    :param float max_memory: Maximum total estimated memory of running
+        tasks. A task exceeding this alone is run only when no other tasks
+        are running.
+    :param str status_file: Optional path of a JSON file of task status.
+    :param bool resume: Whether to resume from an existing ``status_file``.
+    :param callable initializer: An optional initializer of worker processes.
+    :param tuple initargs: Arguments to ``initializer``.
+    :param callable load: A function to load a result from a filename.
+    """
+
+    def __init__(
+        self,
+        *,
+        jobs=1,
+        max_memory=math.inf,
+        status_file=None,
+        resume=True,
+        initializer=None,
+        initargs=(),
+        load=torch_load,
+    ):
+        self.jobs = jobs
+        self.max_memory = max_memory
+        self.status_file = status_file
+        self.initializer = initializer
+        self.initargs = initargs
+        self.load = load
+        self.tasks = {}
+        self.results = {}
+        self.status = {}
+        self._keep = set()
+        if status_file is not None and resume and os.path.exists(status_file):
+            with open(status_file) as f:
+                self.status = json.load(f)
+
+    def add(self, name, fn, *args, memory=0, local=False, filename=None, **kwargs):
+        """
+        Adds a task computing ``fn(*args, **kwargs)``, where any :class:`Ref`
+        arguments are replaced by results of the referenced tasks.
+
+        :param str name: A unique name of the task.
+        :param callable fn: A function. Unless ``local``, this must be
+            picklable, i.e. defined at module level.
+        :param float memory: Estimated peak memory of the task, or a function
+            computing this from the task's resolved arguments.
+        :param bool local: Whether to run the task in this process, e.g. for
+            cheap tasks whose results are needed by many other tasks.
+        :param str filename: Optional path to which the task saves its
+            result, allowing the result to be loaded on resume.
+        :returns: A reference to the task's result.
+        :rtype: Ref
+        """
+        if name not in self.tasks:
+            task = _Task(name, fn, args, kwargs, memory, local, filename)
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise ValueError(f"Task {name} depends on unknown task {dep}")
+            self.tasks[name] = task
+        return Ref(name)
+
+    def run(self, refs):
+        """
+        Runs all tasks needed to compute ``refs``. Results of ``refs`` are
+        kept, so that they can be used by tasks added later.
+
+        :param list refs: A list of :class:`Ref` s.
+        :returns: A list of results, one per ref.
+        :rtype: list
+        """
+        outputs = [ref.name for ref in refs]
+        self._keep.update(outputs)
+
+        # Find tasks that need to run, in topological order.
+        needed = set()
+        stack = list(outputs)
+        while stack:
+            name = stack.pop()
+            if name in needed or name in self.results:
+                continue
+            needed.add(name)
+            if not self._is_resumable(self.tasks[name]):
+                stack.extend(self.tasks[name].deps)
+        pending = [name for name in self.tasks if name in needed]
+        self._consumers = {name: [] for name in pending}
+        for name in pending:
+            if not self._is_resumable(self.tasks[name]):
+                for dep in self.tasks[name].deps:
+                    if dep in self._consumers:
+                        self._consumers[dep].append(name)
+        self._pending = pending
+
+        pool = None
+        num_remote = sum(not self.tasks[name].local for name in pending)
+        if self.jobs > 1 and num_remote:
+            # Spawn rather than fork, since torch state is not fork safe.
+            context = multiprocessing.get_context("spawn")
+            pool = context.Pool(
+                min(self.jobs, num_remote), self.initializer, self.initargs
+            )
+        try:
+            self._run(pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return [self.results[name] for name in outputs]
+
+    def _run(self, pool):
+        done = queue.Queue()
+        running = {}  # Maps name to estimated memory.
+        while self._pending or running:
+            name = self._next(pool, running)
+            if name is None:
+                # Wait for a remote task to finish.
+                name, ok, value = done.get()
+                running.pop(name)
+                if not ok:
+                    self._fail(name, value)
+                self._finish(name, *value)
+                continue
+
+            self._pending.remove(name)
+            task = self.tasks[name]
+            if self._is_resumable(task):
+                logger.info(f"Loading {name} from {task.filename}")
+                self.results[name] = self.load(task.filename)
+                continue
+            args, kwargs = self._resolve(task)
+            if pool is None or task.local:
+                logger.info(f"Running {name}")
+                try:
+                    value = _timed_call(task.fn, args, kwargs)
+                except BaseException as e:
+                    self._fail(name, e)
+                self._finish(name, *value)
+            else:
+                logger.info(f"Starting {name}")
+                running[name] = self._memory(task)
+                pool.apply_async(
+                    _timed_call,
+                    (task.fn, args, kwargs),
+                    callback=lambda value, name=name: done.put((name, True, value)),
+                    error_callback=lambda e, name=name: done.put((name, False, e)),
+                )
+
+    def _next(self, pool, running):
+        """
+        Chooses the next task to start, or None to wait for running tasks.
+        """
+        blocked = False
+        used = sum(running.values())
+        for name in self._pending:
+            task = self.tasks[name]
+            if self._is_resumable(task):
+                return name
+            if not self._is_ready(task):
+                continue
+            if pool is None:
+                return name
+            if task.local:
+                continue
+            if len(running) >= self.jobs or (
+                running and used + self._memory(task) > self.max_memory
+            ):
+                blocked = True
+                continue
+            return name
+
+        # Start local tasks only once their results can be used, so that
+        # results are not held in memory while waiting for workers.
+        for name in self._pending:
+            task = self.tasks[name]
+            if not task.local or not self._is_ready(task):
+                continue
+            if not self._consumers[name]:
+                return name
+            for consumer in self._consumers[name]:
+                consumer = self.tasks[consumer]
+                if (consumer.local or not blocked) and all(
+                    dep in self.results
+                    or dep in self._pending
+                    and self.tasks[dep].local
+                    and self._is_ready(self.tasks[dep])
+                    for dep in consumer.deps
+                ):
+                    return name
+        if not running:
+            # Avoid deadlock, e.g. if consumers wait on other local tasks.
+            for name in self._pending:
+                if self._is_ready(self.tasks[name]):
+                    return name
+        return None
+
+    def _is_ready(self, task):
+        return all(dep in self.results for dep in task.deps)
+
+    def _is_resumable(self, task):
+        return (
+            task.filename is not None
+            and self.status.get(task.name, {}).get("state") == "done"
+            and os.path.exists(task.filename)
+        )
+
+    def _resolve(self, task):
+        def resolve(arg):
+            return self.results[arg.name] if isinstance(arg, Ref) else arg
+
+        args = tuple(resolve(arg) for arg in task.args)
+        kwargs = {k: resolve(v) for k, v in task.kwargs.items()}
+        return args, kwargs
+
+    def _memory(self, task):
+        if not callable(task.memory):
+            return task.memory
+        args, kwargs = self._resolve(task)
+        return task.memory(*args, **kwargs)
+
+    def _finish(self, name, result, elapsed):
+        logger.info(f"Finished {name} in {elapsed:0.1f}s")
+        self.results[name] = result
+        self._set_status(name, {"state": "done", "time": elapsed})
+
+        # Release results no longer needed.
+        for dep in self.tasks[name].deps:
+            consumers = self._consumers.get(dep)
+            if consumers is not None and name in consumers:
+                consumers.remove(name)
+                if not consumers and dep not in self._keep:
+                    self.results.pop(dep, None)
+
+    def _fail(self, name, error):
+        self._set_status(name, {"state": "failed", "error": repr(error)})
+        raise error
+
+    def _set_status(self, name, status):
+        self.status[name] = status
+        if self.status_file is None:
+            return
+        temp = f"{self.status_file}.{os.getpid()}.temp"
+        with open(temp, "w") as f:
+            json.dump(self.status, f, indent=1)
+        os.replace(temp, self.status_file)
@@ -0,0 +1,142 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import functools
+import json
+from timeit import default_timer
+
+import torch
+
+
+class Telemetry:
+    """
+    Records training series at low overhead. Every ``every`` steps this
+    records step time, loss, the infinity norm of each watched parameter's
+    gradient, and any scalar values passed to :meth:`end_step`. Values are
+    written into preallocated buffers on the device where they are computed,
+    so recording never synchronizes with the device.
+
+    Example::
+
+        telemetry = Telemetry(num_steps, every=10)
+        telemetry.watch(dict(pyro.get_param_store().named_parameters()))
+        for step in range(num_steps):
+            telemetry.begin_step(step)
+            loss = svi.step()
+            telemetry.end_step(step, loss, medians_fn)
+        series = telemetry.series()
+
+    :param int num_steps: Total number of steps, used to size buffers.
+    :param int every: Interval between recorded steps, or 0 to record
+        nothing.
+    :param str filename: Optional path of a JSON lines file, to which
+        records are appended on each :meth:`flush`.
+    """
+
+    def __init__(self, num_steps, *, every=1, filename=None):
+        assert every >= 0
+        self.every = every
+        self.capacity = (num_steps + every - 1) // every if every else 0
+        self.filename = filename
+        self.num_rows = 0
+        self._num_flushed = 0
+        self._row = None
+        self._start_time = None
+        self._buffers = {
+            "step": torch.zeros(self.capacity, dtype=torch.long, device="cpu"),
+            "time": torch.zeros(self.capacity, dtype=torch.double, device="cpu"),
+            "loss": torch.zeros(self.capacity, dtype=torch.double, device="cpu"),
+        }
+
+    def _buffer(self, name, like):
+        buf = self._buffers.get(name)
+        if buf is None:
+            buf = like.new_zeros(self.capacity)
+            self._buffers[name] = buf
+        return buf
+
+    def watch(self, params):
+        """
+        Registers gradient hooks to record the infinity norm of gradients.
+
+        :param dict params: A dict mapping name to parameter tensor.
+        """
+        if not self.every:
+            return
+        for name, value in params.items():
+            buf = self._buffer(name, value.detach())
+            value.register_hook(functools.partial(self._hook, buf))
+
+    def _hook(self, buf, grad):
+        if self._row is not None:
+            buf[self._row] = grad.detach().abs().max()
+
+    def is_recorded(self, step):
+        return bool(self.every) and step % self.every == 0
+
+    def begin_step(self, step):
+        self._row = step // self.every if self.is_recorded(step) else None
+        self._start_time = default_timer()
+
+    def end_step(self, step, loss, values_fn=None):
+        """
+        Finishes a step, recording only if the step is due.
+
+        :param int step: The step number.
+        :param float loss: The loss of this step.
+        :param callable values_fn: An optional function returning a dict of
+            scalar tensors to record. This is called only on recorded steps.
+        """
+        row = self._row
+        self._row = None
+        if row is None:
+            return
+        self._buffers["time"][row] = default_timer() - self._start_time
+        self._buffers["step"][row] = step
+        self._buffers["loss"][row] = float(loss)
+        if values_fn is not None:
+            with torch.no_grad():
+                for name, value in values_fn().items():
+                    self._buffer(name, value)[row] = value.reshape(())
+        self.num_rows = row + 1
+
+    def series(self):
+        """
+        Returns recorded series, synchronizing once per series.
+
+        :returns: A dict mapping name to a list of recorded values.
+        :rtype: dict
+        """
+        return {
+            name: buf[: self.num_rows].tolist() for name, buf in self._buffers.items()
+        }
+
+    def flush(self):
+        """
+        Appends records since the last flush to :attr:`filename`, if any.
+        """
+        if self.filename is None or self._num_flushed == self.num_rows:
+            return
+        start, end = self._num_flushed, self.num_rows
+        columns = {k: v[start:end].tolist() for k, v in self._buffers.items()}
+        with open(self.filename, "a") as f:
+            for i in range(end - start):
+                f.write(json.dumps({k: v[i] for k, v in columns.items()}))
+                f.write("\n")
+        self._num_flushed = end
+
+    def state_dict(self):
+        return {
+            "every": self.every,
+            "num_rows": self.num_rows,
+            "num_flushed": self._num_flushed,
+            "buffers": {k: v.detach().clone() for k, v in self._buffers.items()},
+        }
+
+    def load_state_dict(self, state):
+        assert state["every"] == self.every
+        self.num_rows = state["num_rows"]
+        self._num_flushed = state["num_flushed"]
+        for name, old in state["buffers"].items():
+            buf = self._buffer(name, old)
+            buf[: self.num_rows] = old[: self.num_rows].to(buf.device)
@@ -2,6 +2,7 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import functools
+import inspect
 import itertools
 import operator
 import weakref
@@ -56,6 +57,16 @@ def deduplicate_tensor(x):
     return _TENSORS.setdefault(key, x)
 
 
+def torch_load(f, **kwargs):
+    """
+    Like :func:`torch.load` but allows loading arbitrary pickled objects, such
+    as ``argparse.Namespace`` s and numpy RNG state. Use only on trusted files.
+    """
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        kwargs.setdefault("weights_only", False)
+    return torch.load(f, **kwargs)
+
+
 def torch_map(x, **kwargs):
     """
     Calls ``leaf.to(**kwargs)`` on all tensor and module leaves of a nested
@@ -8,7 +8,8 @@ import os
 import pickle
 from collections import Counter
 
-from pyrocov.fasta import NextcladeDB
+from pyrocov.fasta import MUTATION_COLUMNS, NextcladeDB
+from pyrocov.gisaid import iter_feed
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(relativeCreated) 9d %(message)s", level=logging.INFO)
@@ -32,21 +33,20 @@ def main(args):
         )
     os.makedirs("results", exist_ok=True)
 
-    db = NextcladeDB()
+    db = NextcladeDB(max_workers=args.nextclade_workers)
     schedule = db.maybe_schedule if args.no_new else db.schedule
     mutation_counts = Counter()
-    with open(args.gisaid_file_in, "rt") as f:
-        for i, line in enumerate(f):
-            seq = json.loads(line)["sequence"]
+    for i, line in enumerate(iter_feed(args.gisaid_file_in)):
+        seq = json.loads(line)["sequence"]
 
-            # Filter by length.
-            nchars = sum(seq.count(b) for b in "ACGT")
-            if args.min_nchars <= nchars <= args.max_nchars:
-                seq = seq.replace("\n", "")
-                schedule(seq, count_mutations, mutation_counts)
+        # Filter by length.
+        nchars = sum(seq.count(b) for b in "ACGT")
+        if args.min_nchars <= nchars <= args.max_nchars:
+            seq = seq.replace("\n", "")
+            schedule(seq, count_mutations, mutation_counts, columns=MUTATION_COLUMNS)
 
-            if i % args.log_every == 0:
-                print(".", end="", flush=True)
+        if i % args.log_every == 0:
+            print(".", end="", flush=True)
     db.wait(log_every=args.log_every)
 
     logger.info(f"saving {args.counts_file_out}")
@@ -57,12 +57,18 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run NextClade on all sequences")
     parser.add_argument(
-        "--gisaid-file-in", default=os.path.expanduser("results/gisaid.json")
+        "--gisaid-file-in", default=os.path.expanduser("results/gisaid.json.xz")
     )
     parser.add_argument("--counts-file-out", default="results/nextclade.counts.pkl")
     parser.add_argument("--min-nchars", default=29000, type=int)
     parser.add_argument("--max-nchars", default=31000, type=int)
     parser.add_argument("--no-new", action="store_true")
+    parser.add_argument(
+        "--nextclade-workers",
+        default=1,
+        type=int,
+        help="number of concurrent nextclade processes",
+    )
     parser.add_argument("-l", "--log-every", default=1000, type=int)
     args = parser.parse_args()
     main(args)
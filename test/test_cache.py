@@ -0,0 +1,68 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import os
+
+import torch
+
+from pyrocov.cache import ResultCache
+
+
+def test_cache(tmpdir):
+    input_filename = os.path.join(tmpdir, "input.txt")
+    with open(input_filename, "w") as f:
+        f.write("a")
+    dirname = os.path.join(tmpdir, "cache")
+    cache = ResultCache(dirname, inputs=[input_filename], version="1")
+
+    key = cache.key("fit", (1, 2))
+    assert cache.key("fit", (1, 2)) == key
+    assert cache.key("fit", (1, 3)) != key
+    assert cache.key("stats", (1, 2)) != key
+    assert ResultCache(dirname, version="2").key("fit", (1, 2)) != key
+    assert cache.lookup(key) is None
+
+    cache.save(key, {"x": torch.ones(3)}, name="fit", config=(1, 2), compute_time=1.5)
+    assert cache.lookup(key) == cache.path(key)
+    assert torch.equal(cache.load(key)["x"], torch.ones(3))
+    (entry,) = cache.entries()
+    assert entry["name"] == "fit"
+    assert entry["config"] == "(1, 2)"
+    assert entry["size"] == os.path.getsize(cache.path(key))
+    assert entry["compute_time"] == 1.5
+    assert entry["hits"] == 1
+
+    # Changing an input invalidates keys.
+    with open(input_filename, "w") as f:
+        f.write("bb")
+    cache = ResultCache(dirname, inputs=[input_filename], version="1")
+    assert cache.key("fit", (1, 2)) != key
+
+
+def test_evict(tmpdir):
+    cache = ResultCache(os.path.join(tmpdir, "cache"))
+    keys = [cache.key("fit", i) for i in range(4)]
+    for i, key in enumerate(keys[:3]):
+        cache.save(key, torch.zeros(100), name="fit", config=i)
+    size = cache.entries()[0]["size"]
+
+    # Accessing an entry makes it most recently used.
+    cache.load(keys[0])
+    cache.max_size = 3 * size
+    cache.save(keys[3], torch.zeros(100), name="fit", config=3)
+    assert cache.lookup(keys[1]) is None
+    assert not os.path.exists(cache.path(keys[1]))
+    for key in [keys[0], keys[2], keys[3]]:
+        assert cache.lookup(key) is not None
+    assert sum(e["size"] for e in cache.entries()) <= 3 * size
+
+
+def test_load_namespace(tmpdir):
+    cache = ResultCache(os.path.join(tmpdir, "cache"))
+    key = cache.key("fit", 0)
+    args = argparse.Namespace(seed=1, model_type="reparam")
+    cache.save(key, {"args": args, "x": torch.ones(3)}, name="fit", config=0)
+    result = cache.load(key, map_location="cpu")
+    assert result["args"] == args
+    assert torch.equal(result["x"], torch.ones(3))
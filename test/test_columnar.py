@@ -0,0 +1,142 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+
+import numpy as np
+import pytest
+
+from pyrocov.columnar import (
+    append_columns,
+    load_columns,
+    read_meta,
+    save_columns,
+    update_rows,
+)
+
+
+def random_columns(num_rows, seed=0):
+    rng = np.random.RandomState(seed)
+    return {
+        "name": [f"hCoV-19/{i}/ü" for i in rng.permutation(num_rows).tolist()],
+        "location": [str(i) for i in rng.randint(0, 5, num_rows).tolist()],
+        "extra": [None if i else "" for i in rng.randint(0, 2, num_rows).tolist()],
+        "day": rng.randint(0, 1000, num_rows).tolist(),
+    }
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+@pytest.mark.parametrize("num_rows", [0, 1, 100])
+def test_save_load(tmpdir, num_rows, mmap):
+    dirname = os.path.join(tmpdir, "columns")
+    expected = random_columns(num_rows)
+    encode = ["location", "extra"]
+    save_columns(dirname, expected, encode=encode)
+    actual = load_columns(dirname, mmap=mmap)
+    assert list(actual) == list(expected)
+    for name, values in expected.items():
+        assert list(actual[name]) == values
+        assert len(actual[name]) == num_rows
+
+    # Check that we can load only a subset of columns.
+    actual = load_columns(dirname, ["day", "location"], mmap=mmap)
+    assert set(actual) == {"day", "location"}
+    assert isinstance(actual["day"], np.ndarray)
+    assert actual["day"].tolist() == expected["day"]
+    if num_rows:
+        assert actual["location"][num_rows - 1] == expected["location"][-1]
+        assert len(actual["location"].values) <= 5
+
+
+def test_append(tmpdir):
+    dirname = os.path.join(tmpdir, "columns")
+    expected = random_columns(100, seed=0)
+    save_columns(dirname, expected, encode=["location", "extra"])
+    for seed in range(1, 4):
+        new = random_columns(10 * seed, seed=seed)
+        new["location"] = [v + "new" for v in new["location"]]
+        append_columns(dirname, new)
+        for name, values in new.items():
+            expected[name].extend(values)
+    assert read_meta(dirname)["num_rows"] == len(expected["day"])
+    actual = load_columns(dirname)
+    for name, values in expected.items():
+        assert list(actual[name]) == values
+
+
+def test_interrupted_append(tmpdir):
+    dirname = os.path.join(tmpdir, "columns")
+    expected = random_columns(20)
+    save_columns(dirname, expected, encode=["location", "extra"])
+
+    # Simulate garbage left by an append interrupted before metadata update.
+    for filename in os.listdir(dirname):
+        if filename != "meta.json":
+            with open(os.path.join(dirname, filename), "ab") as f:
+                f.write(b"garbage\n")
+    actual = load_columns(dirname, mmap=False)
+    for name, values in expected.items():
+        assert list(actual[name]) == values
+
+    new = random_columns(5, seed=1)
+    append_columns(dirname, new)
+    actual = load_columns(dirname)
+    for name, values in expected.items():
+        assert list(actual[name]) == values + new[name]
+
+
+def test_empty_columns(tmpdir):
+    dirname = os.path.join(tmpdir, "columns")
+    save_columns(dirname, {"name": [], "day": np.zeros(0, np.int32)})
+    assert read_meta(dirname)["columns"]["name"]["type"] == "unknown"
+    assert list(load_columns(dirname)["name"]) == []
+
+    append_columns(dirname, {"name": [], "day": []})
+    append_columns(dirname, {"name": ["a", "bc"], "day": [1, 2]})
+    append_columns(dirname, {"name": ["d"], "day": np.array([3])})
+    meta = read_meta(dirname)
+    assert meta["columns"]["name"]["type"] == "str"
+    assert meta["columns"]["day"]["dtype"] == "int32"
+    actual = load_columns(dirname)
+    assert list(actual["name"]) == ["a", "bc", "d"]
+    assert actual["day"].tolist() == [1, 2, 3]
+
+
+def test_update_rows(tmpdir):
+    dirname = os.path.join(tmpdir, "columns")
+    expected = random_columns(20)
+    save_columns(dirname, expected, encode=["location", "extra"])
+
+    # Update fixed width columns in place.
+    rows = [3, 0, 17]
+    new = random_columns(3, seed=1)
+    new["name"] = [expected["name"][i] for i in rows]
+    new["location"][0] = "new"
+    update_rows(dirname, rows, new)
+    assert "stem" not in read_meta(dirname)["columns"]["name"]
+    for name, values in new.items():
+        for i, value in zip(rows, values):
+            expected[name][i] = value
+    actual = load_columns(dirname)
+    for name, values in expected.items():
+        assert list(actual[name]) == values
+
+    # Rewrite string columns whose values change.
+    new = random_columns(2, seed=2)
+    new["name"] = ["changed", "ü"]
+    update_rows(dirname, [5, 19], new)
+    assert read_meta(dirname)["columns"]["name"]["stem"] == "name.v1"
+    assert not os.path.exists(os.path.join(dirname, "name.data"))
+    for name, values in new.items():
+        for i, value in zip([5, 19], values):
+            expected[name][i] = value
+    actual = load_columns(dirname)
+    for name, values in expected.items():
+        assert list(actual[name]) == values
+
+    # Later appends follow the rewritten column.
+    new = random_columns(4, seed=3)
+    append_columns(dirname, new)
+    actual = load_columns(dirname)
+    for name, values in expected.items():
+        assert list(actual[name]) == values + new[name]
@@ -0,0 +1,126 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+
+import pytest
+
+from pyrocov.fasta import NextcladeDB, hash_sequence
+
+HEADER = ["seqName", "qc.overallStatus", "aaSubstitutions", "aaDeletions"]
+
+
+@pytest.fixture
+def aligned(monkeypatch):
+    """
+    Replaces the nextclade binary by a fake that records aligned sequences.
+    """
+    aligned = []
+
+    def align(self, fasta_filename):
+        with open(fasta_filename) as f:
+            lines = f.read().splitlines()
+        tsv_filename = fasta_filename[: -len(".fasta")] + ".tsv"
+        with open(tsv_filename, "w") as f:
+            f.write("\t".join(HEADER) + "\n")
+            for name, seq in zip(lines[0::2], lines[1::2]):
+                f.write(f"{name[1:]}\tgood\tS:{seq}\t\n")
+                aligned.append(seq)
+        os.remove(fasta_filename)
+        return tsv_filename
+
+    monkeypatch.setattr(NextcladeDB, "_align", align)
+    return aligned
+
+
+def record(rows, seq, row):
+    rows[seq] = row
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_nextclade_db(tmpdir, aligned, max_workers):
+    fileprefix = os.path.join(tmpdir, "nextcladedb")
+    db = NextcladeDB(fileprefix, max_fasta_count=3, max_workers=max_workers)
+    seqs = [f"ACGT{i}" for i in range(10)]
+    rows = {}
+    for seq in seqs:
+        db.schedule(seq, record, rows, seq, columns=["aaSubstitutions"])
+    db.wait(log_every=0)
+
+    assert sorted(aligned) == sorted(seqs)
+    assert rows == {seq: {"aaSubstitutions": f"S:{seq}"} for seq in seqs}
+
+
+def test_nextclade_db_migrate(tmpdir, aligned):
+    fileprefix = os.path.join(tmpdir, "nextcladedb")
+    old_seqs = [f"ACGT{i}" for i in range(5)]
+    with open(fileprefix + ".header.tsv", "w") as f:
+        f.write("\t".join(HEADER) + "\n")
+    with open(fileprefix + ".rows.tsv", "w") as f:
+        for seq in old_seqs:
+            f.write(f"{hash_sequence(seq)}\tgood\tS:{seq}\t\n")
+
+    db = NextcladeDB(fileprefix)
+    assert not os.path.exists(fileprefix + ".header.tsv")
+    assert not os.path.exists(fileprefix + ".rows.tsv")
+    seqs = old_seqs + ["TTTT"]
+    rows = {}
+    for seq in seqs:
+        db.schedule(seq, record, rows, seq)
+    db.wait(log_every=0)
+
+    # Only the new sequence is aligned.
+    assert aligned == ["TTTT"]
+    for seq in seqs:
+        assert rows[seq]["seqName"] == hash_sequence(seq)
+        assert rows[seq]["aaSubstitutions"] == f"S:{seq}"
+
+
+@pytest.mark.parametrize("reindex", [False, True])
+def test_nextclade_db_rerun(tmpdir, aligned, reindex):
+    fileprefix = os.path.join(tmpdir, "nextcladedb")
+    db = NextcladeDB(fileprefix, max_fasta_count=2)
+    old_seqs = [f"ACGT{i}" for i in range(5)]
+    for seq in old_seqs:
+        db.schedule(seq, record, {}, seq)
+    db.wait(log_every=0)
+    del db
+    if reindex:
+        os.remove(os.path.join(fileprefix + ".rows", "index.sqlite"))
+
+    # A re-run aligns only new sequences.
+    aligned.clear()
+    db = NextcladeDB(fileprefix, max_fasta_count=2)
+    rows = {}
+    for seq in old_seqs + ["TTTT"]:
+        db.schedule(seq, record, rows, seq, columns=["aaSubstitutions"])
+    db.maybe_schedule("GGGG", record, rows, "GGGG", columns=["aaSubstitutions"])
+    db.wait(log_every=0)
+    assert aligned == ["TTTT"]
+    assert set(rows) == set(old_seqs + ["TTTT"])
+
+
+def record_batch(batches, columns):
+    batches.append({name: list(values) for name, values in columns.items()})
+
+
+def test_nextclade_db_batched(tmpdir, aligned):
+    fileprefix = os.path.join(tmpdir, "nextcladedb")
+    db = NextcladeDB(fileprefix, max_batch_size=3)
+    seqs = [f"ACGT{i}" for i in range(10)]
+    batches = {"even": [], "odd": []}
+    for i, seq in enumerate(seqs):
+        key = "odd" if i % 2 else "even"
+        db.schedule(
+            seq,
+            record_batch,
+            batches[key],
+            columns=["aaSubstitutions"],
+            batch_key=key,
+        )
+    db.wait(log_every=0)
+
+    for key, expected in [("even", seqs[0::2]), ("odd", seqs[1::2])]:
+        assert [len(b["aaSubstitutions"]) for b in batches[key]] == [3, 2]
+        actual = sum((b["aaSubstitutions"] for b in batches[key]), [])
+        assert sorted(actual) == sorted(f"S:{seq}" for seq in expected)
@@ -0,0 +1,233 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import json
+import lzma
+import os
+import pickle
+import shutil
+
+import pytest
+
+from pyrocov.columnar import load_columns
+from pyrocov.gisaid import (
+    get_accession_id,
+    iter_feed,
+    load_index,
+    read_feed,
+    read_sequences,
+    save_index,
+    scan_feed,
+)
+
+
+@pytest.fixture
+def feed(tmpdir):
+    lines = [f'{{"covv_accession_id": "EPI_ISL_{i}"}}\n' for i in range(1000)]
+    filename = os.path.join(tmpdir, "gisaid.json")
+    with open(filename, "w") as f:
+        f.write("".join(lines))
+    with lzma.open(filename + ".xz", "wt") as f:
+        f.write("".join(lines))
+    return filename, lines
+
+
+@pytest.mark.parametrize("xz", [False, True])
+@pytest.mark.parametrize("batch_size", [1, 7, 1000, 2000])
+def test_read_feed(feed, xz, batch_size):
+    filename, expected = feed
+    if xz:
+        filename += ".xz"
+    batches = list(read_feed(filename, batch_size=batch_size, max_batches=2))
+    assert all(0 < len(batch) <= batch_size for batch in batches)
+    assert sum(batches, []) == expected
+
+
+def test_read_feed_lzma(feed, monkeypatch):
+    monkeypatch.setattr(shutil, "which", lambda name: None)
+    filename, expected = feed
+    filename += ".xz"
+    batch_size = 7
+    batches = list(read_feed(filename, batch_size=batch_size, max_batches=2))
+    assert all(0 < len(batch) <= batch_size for batch in batches)
+    assert sum(batches, []) == expected
+
+
+@pytest.mark.parametrize("xz", [False, True])
+def test_iter_feed_early_exit(feed, xz):
+    filename, expected = feed
+    if xz:
+        filename += ".xz"
+    actual = []
+    for line in iter_feed(filename, batch_size=10, max_batches=1):
+        actual.append(line)
+        if len(actual) == 25:
+            break
+    assert actual == expected[:25]
+
+
+@pytest.mark.parametrize("suffix", ["", ".xz"])
+def test_read_feed_missing(tmpdir, suffix):
+    with pytest.raises(FileNotFoundError):
+        list(read_feed(os.path.join(tmpdir, "missing.json" + suffix)))
+
+
+@pytest.fixture
+def sequence_feed(tmpdir):
+    data = [
+        {
+            "covv_accession_id": f"EPI_ISL_{i}",
+            "covv_location": "Europe / Ø",
+            "sequence": "ACGT\nNNN" * (i % 5),
+        }
+        for i in range(100)
+    ]
+    filename = os.path.join(tmpdir, "gisaid.json")
+    with open(filename, "w") as f:
+        for datum in data:
+            f.write(json.dumps(datum, ensure_ascii=False))
+            f.write("\n")
+    return filename, data
+
+
+@pytest.mark.parametrize("num_shards", [1, 2, 7, 300])
+def test_scan_feed(sequence_feed, num_shards):
+    filename, data = sequence_feed
+    size = os.path.getsize(filename)
+    bounds = [size * i // num_shards for i in range(num_shards + 1)]
+    records = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        records.extend(scan_feed(filename, start, end))
+    assert len(records) == len(data)
+
+    for (metadata, _, _), datum in zip(records, data):
+        expected = {k: v for k, v in datum.items() if k != "sequence"}
+        assert json.loads(metadata) == expected
+        assert get_accession_id(metadata) == datum["covv_accession_id"]
+
+    offsets = [offset for _, offset, _ in records]
+    lengths = [length for _, _, length in records]
+    actual = list(read_sequences(filename, offsets, lengths))
+    assert actual == [datum["sequence"] for datum in data]
+
+
+def test_scan_feed_empty(tmpdir):
+    filename = os.path.join(tmpdir, "gisaid.json")
+    open(filename, "w").close()
+    assert list(scan_feed(filename)) == []
+
+
+def test_read_sequences_stale(sequence_feed):
+    filename, _ = sequence_feed
+    _, offset, length = next(scan_feed(filename))
+    with pytest.raises(ValueError):
+        list(read_sequences(filename, [offset + 1], [length]))
+
+
+def test_scan_feed_escaped(tmpdir):
+    data = [
+        {"covv_accession_id": "EPI_ISL_0", "sequence": 'AC"GT\\'},
+        {"covv_accession_id": "EPI_ISL_1", "sequence": '\\"\\\\'},
+    ]
+    filename = os.path.join(tmpdir, "gisaid.json")
+    with open(filename, "w") as f:
+        for datum in data:
+            f.write(json.dumps(datum) + "\n")
+    records = list(scan_feed(filename))
+    offsets = [offset for _, offset, _ in records]
+    lengths = [length for _, _, length in records]
+    actual = list(read_sequences(filename, offsets, lengths))
+    assert actual == [datum["sequence"] for datum in data]
+
+
+def test_scan_feed_unterminated(tmpdir):
+    filename = os.path.join(tmpdir, "gisaid.json")
+    with open(filename, "w") as f:
+        f.write('{"covv_accession_id": "EPI_ISL_0", "sequence": "ACGT\n')
+    with pytest.raises(ValueError, match="Unterminated"):
+        list(scan_feed(filename))
+
+
+def test_index(sequence_feed, tmpdir):
+    filename, data = sequence_feed
+    index = {"accession_id": [], "offset": [], "length": []}
+    for metadata, offset, length in scan_feed(filename):
+        index["accession_id"].append(get_accession_id(metadata))
+        index["offset"].append(offset)
+        index["length"].append(length)
+    dirname = os.path.join(tmpdir, "gisaid.index")
+    save_index(dirname, index, filename)
+    actual = load_index(dirname, filename)
+    assert list(actual["accession_id"]) == index["accession_id"]
+    assert actual["offset"].tolist() == index["offset"]
+
+    # Changing the feed invalidates the index.
+    with open(filename, "a") as f:
+        f.write(json.dumps(data[0]) + "\n")
+    assert load_index(dirname, filename) is None
+    assert load_index(os.path.join(tmpdir, "missing"), filename) is None
+
+
+def write_metadata_feed(filename, num_rows):
+    lineages = ["B.1", "B.1.1.7", "AY.4", None]
+    dates = ["2021-03-04", "2020-1-2", "2021", "2019-06-01"]
+    locations = ["Europe / France", "Europe / United Kingdom / England"]
+    with open(filename, "w") as f:
+        for i in range(num_rows):
+            datum = {
+                "covv_virus_name": f"virus{i}",
+                "covv_accession_id": f"EPI_ISL_{i}",
+                "covv_collection_date": dates[i % len(dates)],
+                "covv_location": locations[i % len(locations)],
+                "covv_add_location": None,
+                "covv_lineage": lineages[i % len(lineages)],
+                "sequence": "ACGT" * (i % 3),
+            }
+            f.write(json.dumps(datum) + "\n")
+
+
+@pytest.mark.parametrize("xz", [False, True])
+def test_preprocess_workers(tmpdir, monkeypatch, xz):
+    import preprocess_gisaid
+
+    monkeypatch.chdir(tmpdir)
+    filename = os.path.join(tmpdir, "gisaid.json")
+    write_metadata_feed(filename, 100)
+    if xz:
+        with open(filename, "rb") as f, lzma.open(filename + ".xz", "wb") as g:
+            g.write(f.read())
+        filename += ".xz"
+
+    results = {}
+    for workers in [1, 3]:
+        out = os.path.join(tmpdir, f"workers{workers}")
+        args = argparse.Namespace(
+            gisaid_file_in=filename,
+            columns_dir_out=out + ".columns",
+            stats_file_out=out + ".stats.pkl",
+            seen_dir=out + ".seen",
+            index_dir_out=out + ".index",
+            start_date=preprocess_gisaid.parse_date("2019-12-01"),
+            log_every=1000,
+            truncate=preprocess_gisaid.TRUNCATE,
+            workers=workers,
+            incremental=False,
+            featurize=False,
+        )
+        preprocess_gisaid.main(args)
+        columns = load_columns(args.columns_dir_out)
+        columns = {k: list(v) for k, v in columns.items()}
+        with open(args.stats_file_out, "rb") as f:
+            stats = pickle.load(f)
+        assert os.path.exists(args.index_dir_out) == (not xz)
+        results[workers] = columns, stats
+
+    # Rows with no month or no lineage are dropped.
+    columns, stats = results[1]
+    assert len(columns["day"]) == 50
+    assert columns["accession_id"][:2] == ["EPI_ISL_0", "EPI_ISL_1"]
+    assert sum(stats["lineage"].values()) == 50
+
+    # Parallel ingestion preserves row order and stats.
+    assert results[3] == results[1]
@@ -0,0 +1,696 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import random
+import re
+from collections import Counter, OrderedDict
+
+import numpy as np
+import pyro
+import pytest
+import torch
+from pyro import poutine
+from pyro.infer import SVI
+
+import pyrocov.mutrans
+from pyrocov import pangolin
+from pyrocov.columnar import save_columns
+from pyrocov.mutrans import (
+    Forecast,
+    _ChunkedMeanVariance,
+    compact_observations,
+    fit_svi,
+    load_gisaid_daily,
+    load_gisaid_data,
+    match_field,
+    model,
+    predict,
+    rebin_gisaid_data,
+)
+
+
+def random_dataset(T, P, S, F, density=0.3):
+    weekly_strains = torch.distributions.Poisson(2.0).sample((T, P, S))
+    weekly_strains *= torch.rand(T, P, 1) < density  # Most cells are empty.
+    return {
+        "weekly_strains": weekly_strains,
+        "features": torch.randn(S, F),
+        "local_time": torch.randn(T, P),
+    }
+
+
+def make_strain_mask(S, K):
+    # Leave out one strain in each of K fits.
+    mask = torch.ones(K, S, dtype=torch.bool)
+    for k in range(K):
+        mask[k, k % S] = False
+    return mask
+
+
+@pytest.mark.parametrize("strain_mask", [False, True])
+@pytest.mark.parametrize("precompute", [False, True])
+@pytest.mark.parametrize("model_type", ["", "reparam", "sparse-skip-reparam"])
+def test_compact_log_prob(model_type, precompute, strain_mask):
+    dataset = random_dataset(T=5, P=4, S=3, F=2)
+    if strain_mask:
+        dataset["strain_mask"] = make_strain_mask(S=3, K=2)
+    trace = poutine.trace(model).get_trace(dataset, model_type)
+    expected = trace.log_prob_sum()
+
+    if precompute:
+        dataset["compact_obs"] = compact_observations(dataset)
+    compact_model = poutine.replay(model, trace=trace)
+    compact_trace = poutine.trace(compact_model).get_trace(
+        dataset, model_type + "-compact"
+    )
+    actual = compact_trace.log_prob_sum()
+    assert torch.allclose(actual, expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize("guide_type", ["custom", "normal", "map"])
+@pytest.mark.parametrize(
+    "model_type", ["sparse-skip-reparam", "sparse-skip-reparam-compact"]
+)
+def test_fit_svi_subsample(model_type, guide_type):
+    P = 8
+    dataset = random_dataset(T=5, P=P, S=3, F=2)
+    result = fit_svi(
+        dataset,
+        model_type=model_type,
+        guide_type=guide_type,
+        num_steps=4,
+        num_samples=5,
+        jit=False,
+        log_every=1,
+        rank=2,
+        place_subsample_size=3,
+    )
+    assert len(result["losses"]) == 4
+    assert result["median"]["probs"].shape[1] == P
+
+
+def test_fit_svi_resume(tmpdir, monkeypatch):
+    dataset = random_dataset(T=5, P=8, S=3, F=2)
+    kwargs = dict(
+        model_type="sparse-skip-reparam-compact",
+        guide_type="custom",
+        num_steps=30,
+        num_samples=5,
+        jit=False,
+        log_every=0,
+        rank=2,
+        place_subsample_size=3,
+    )
+    expected = fit_svi(dataset, **kwargs)
+
+    # Interrupt a fit after its first checkpoint.
+    checkpoint = os.path.join(tmpdir, "checkpoint.pt")
+    step = SVI.step
+    num_steps = [0]
+
+    def interrupted_step(self, *args, **kwargs):
+        num_steps[0] += 1
+        if num_steps[0] > 15:
+            raise KeyboardInterrupt
+        return step(self, *args, **kwargs)
+
+    with monkeypatch.context() as m:
+        m.setattr(SVI, "step", interrupted_step)
+        with pytest.raises(KeyboardInterrupt):
+            fit_svi(dataset, checkpoint=checkpoint, checkpoint_every=10, **kwargs)
+    assert os.path.exists(checkpoint)
+
+    # Resuming reproduces the uninterrupted fit.
+    actual = fit_svi(
+        dataset, checkpoint=checkpoint, checkpoint_every=10, resume=True, **kwargs
+    )
+    assert not os.path.exists(checkpoint)
+    assert actual["losses"] == expected["losses"]
+    for name, value in expected["params"].items():
+        assert torch.equal(actual["params"][name], value), name
+    assert torch.equal(actual["median"]["probs"], expected["median"]["probs"])
+
+
+@pytest.mark.parametrize("compact", ["", "-compact"])
+@pytest.mark.parametrize("model_type", ["", "reparam", "sparse-skip-reparam"])
+def test_batched_log_prob(model_type, compact):
+    K, S = 3, 4
+    dataset = random_dataset(T=5, P=6, S=S, F=2)
+    batched = dict(dataset, strain_mask=make_strain_mask(S, K))
+    model_type += compact
+
+    # Trace a batch of fits, with distinct params in each fit.
+    trace = poutine.trace(model).get_trace(batched, model_type)
+    for value in pyro.get_param_store().values():
+        value.data.uniform_(0.2, 0.8)
+    trace = poutine.trace(poutine.replay(model, trace=trace)).get_trace(
+        batched, model_type
+    )
+    trace.compute_log_prob()
+    batched_log_prob = trace.nodes["obs"]["log_prob"]
+    batched_params = {k: v.detach() for k, v in pyro.get_param_store().items()}
+
+    # Find shapes of an unbatched fit.
+    pyro.clear_param_store()
+    single = poutine.trace(model).get_trace(dataset, model_type)
+    shapes = {
+        name: site["value"].shape
+        for name, site in single.nodes.items()
+        if site["type"] == "sample"
+    }
+    param_shapes = {k: v.shape for k, v in pyro.get_param_store().items()}
+    assert set(param_shapes) == set(batched_params)
+
+    # Each fit agrees with a separate fit to data with its clade zeroed out.
+    for k in range(K):
+        data = {
+            name: site["value"][k].reshape(shapes[name])
+            for name, site in trace.nodes.items()
+            if site["type"] == "sample"
+            and not site["is_observed"]
+            and name not in ("fits", "place", "strain", "time")
+        }
+        pyro.clear_param_store()
+        for name, value in batched_params.items():
+            pyro.param(name, value[k].reshape(param_shapes[name]).clone())
+        loo = dict(dataset)
+        loo["weekly_strains"] = dataset["weekly_strains"] * batched["strain_mask"][k]
+        single = poutine.trace(poutine.condition(model, data)).get_trace(
+            loo, model_type
+        )
+        single.compute_log_prob()
+        expected = single.nodes["obs"]["log_prob"].sum()
+        actual = batched_log_prob[k].sum()
+        assert torch.allclose(actual, expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "model_type", ["sparse-skip-reparam", "sparse-skip-reparam-compact"]
+)
+def test_batched_fit_independent(model_type):
+    S = 4
+    dataset = random_dataset(T=5, P=6, S=S, F=2)
+    results = []
+    for other in [1, 2]:
+        strain_mask = torch.ones(2, S, dtype=torch.bool)
+        strain_mask[0, 0] = False
+        strain_mask[1, other] = False
+        pyro.set_rng_seed(0)
+        result = fit_svi(
+            dict(dataset, strain_mask=strain_mask),
+            model_type=model_type,
+            guide_type="custom",
+            num_steps=20,
+            num_samples=3,
+            jit=False,
+            log_every=0,
+            rank=2,
+        )
+        results.append(result)
+
+    # The first fit does not depend on the other fit in its batch.
+    a, b = results
+    for name, value in a["params"].items():
+        assert torch.allclose(value[0], b["params"][name][0], atol=1e-6), name
+    assert torch.allclose(a["median"]["coef"][0], b["median"]["coef"][0], atol=1e-6)
+    assert not torch.allclose(a["median"]["coef"][1], b["median"]["coef"][1])
+
+
+@pytest.mark.parametrize(
+    "log_every, telemetry_every, expected_steps",
+    [(5, None, [0, 5]), (0, None, []), (0, 1, list(range(10))), (5, 0, [0, 5])],
+)
+def test_fit_svi_telemetry(monkeypatch, log_every, telemetry_every, expected_steps):
+    calls = []
+
+    def scalar_medians(guide, names):
+        calls.append(names)
+        return {}
+
+    monkeypatch.setattr(pyrocov.mutrans, "_scalar_medians", scalar_medians)
+    dataset = random_dataset(T=5, P=4, S=3, F=2)
+    result = fit_svi(
+        dataset,
+        model_type="sparse-skip-reparam",
+        guide_type="custom",
+        num_steps=10,
+        num_samples=3,
+        jit=False,
+        log_every=log_every,
+        telemetry_every=telemetry_every,
+        rank=2,
+    )
+
+    # Medians are computed only on logged or recorded steps.
+    assert len(calls) == len(expected_steps)
+    recorded = expected_steps if telemetry_every != 0 else []
+    assert result["series_steps"] == recorded
+    assert len(result["series"]["loss"]) == 10
+
+
+def keyed_dataset(places, strains, F):
+    dataset = random_dataset(T=5, P=len(places), S=len(strains), F=F)
+    dataset["location_id"] = {name: i for i, name in enumerate(places)}
+    dataset["lineage_id_inv"] = list(strains)
+    return dataset
+
+
+@pytest.mark.parametrize("guide_type", ["custom", "normal", "map", "full"])
+def test_fit_svi_warm_start(guide_type):
+    kwargs = dict(
+        model_type="sparse-skip-reparam",
+        guide_type=guide_type,
+        num_samples=3,
+        jit=False,
+        log_every=0,
+        rank=2,
+    )
+    old_places = [f"place{i}" for i in range(6)]
+    old_strains = [f"strain{i}" for i in range(4)]
+    old_data = keyed_dataset(old_places, old_strains, F=3)
+    old = fit_svi(old_data, num_steps=20, **kwargs)
+    warm_start = {
+        "params": old["params"],
+        "location_id": old_data["location_id"],
+        "lineage_id_inv": old_data["lineage_id_inv"],
+    }
+
+    # Permute places and strains, dropping one and adding one of each.
+    places = [3, 0, 5, 1, 4, None]
+    strains = [2, None, 0, 3]
+    new_data = keyed_dataset(
+        [old_places[i] if i is not None else "new" for i in places],
+        [old_strains[i] if i is not None else "new" for i in strains],
+        F=3,
+    )
+    for j, i in enumerate(strains):
+        if i is not None:
+            new_data["features"][j] = old_data["features"][i]
+    kwargs.update(num_steps=1, learning_rate=0.0, seed=1)
+    new = fit_svi(new_data, warm_start=warm_start, **kwargs)
+    cold = fit_svi(new_data, **kwargs)
+
+    def assert_remapped(name, new, old, cold):
+        assert new.shape == cold.shape, name
+        if new.shape == (len(places), len(strains)):
+            for j, i in enumerate(places):
+                for b, a in enumerate(strains):
+                    if i is None or a is None:
+                        expected = cold[j, b]
+                    else:
+                        expected = old[i, a]
+                    assert torch.allclose(new[j, b], expected, atol=1e-5), name
+        elif new.shape == (len(strains),):
+            for b, a in enumerate(strains):
+                expected = cold[b] if a is None else old[a]
+                assert torch.allclose(new[b], expected, atol=1e-5), name
+        else:
+            assert torch.allclose(new, old, atol=1e-5), name
+
+    # Latent values match by place and strain, and new ones keep their init.
+    for name, value in new["median"].items():
+        if name.endswith("_scale") or name.endswith("_decentered"):
+            assert_remapped(name, value, old["median"][name], cold["median"][name])
+
+    packed = ("Guide.0.", "AutoBatchedLowRankMultivariateNormal.")
+    for name, value in new["params"].items():
+        if not name.startswith(packed):
+            assert_remapped(name, value, old["params"][name], cold["params"][name])
+            continue
+        if not name.endswith(".loc"):
+            continue
+
+        # Rows of packed parameters are copied with their locs.
+        prefix = name[: -len("loc")]
+        copied = 0
+        for r, loc in enumerate(value):
+            (matches,) = (old["params"][name] == loc).nonzero(as_tuple=True)
+            if len(matches):
+                copied += 1
+                old_row, params = matches[0], old["params"]
+            else:
+                old_row, params = r, cold["params"]
+                assert loc == cold["params"][name][r], name
+            for suffix in ["scale", "cov_factor"]:
+                actual = new["params"][prefix + suffix][r]
+                expected = params[prefix + suffix][old_row]
+                assert torch.allclose(actual, expected, atol=1e-5), prefix + suffix
+        # All but the new strain's init_loc, and new rates and inits in "full".
+        expected = len(value) - 1 - (2 * 9 if guide_type == "full" else 0)
+        assert copied == expected
+
+
+def test_fit_svi_warm_start_error():
+    places = [f"place{i}" for i in range(4)]
+    strains = [f"strain{i}" for i in range(3)]
+    dataset = keyed_dataset(places, strains, F=2)
+    kwargs = dict(
+        model_type="sparse-skip-reparam",
+        guide_type="structured",
+        num_steps=1,
+        num_samples=3,
+        jit=False,
+        log_every=0,
+    )
+    warm_start = {
+        "params": {},
+        "location_id": dataset["location_id"],
+        "lineage_id_inv": dataset["lineage_id_inv"],
+    }
+    with pytest.raises(ValueError, match="Cannot warm start"):
+        fit_svi(dataset, warm_start=warm_start, **kwargs)
+
+
+def test_chunked_mean_variance():
+    samples = torch.randn(23, 4, 5).exp()
+    stats = _ChunkedMeanVariance()
+    for chunk in samples.split(5):
+        stats.update(chunk)
+    assert stats.count == 23
+    assert torch.allclose(stats.mean, samples.mean(0), atol=1e-5)
+    assert torch.allclose(stats.variance(), samples.var(0), atol=1e-5)
+
+
+class ReplayGuide:
+    """
+    Replays fixed guide samples, a chunk per call, so that predictions are
+    reproducible across chunk sizes.
+    """
+
+    def __init__(self, guide, samples, chunk_size):
+        self.guide = guide
+        self.samples = samples
+        self.chunk_size = chunk_size
+        self.start = 0
+
+    def median(self, *args, **kwargs):
+        return self.guide.median(*args, **kwargs)
+
+    def __call__(self):
+        end = self.start + self.chunk_size
+        chunk = {k: v[self.start : end] for k, v in self.samples.items()}
+        self.start = end
+        return chunk
+
+
+@pytest.mark.parametrize("save_params", [("rate", "init", "probs"), ("rate",)])
+@pytest.mark.parametrize("guide_type", ["map", "custom"])
+def test_predict_chunks(monkeypatch, guide_type, save_params):
+    # probs is large enough to be saved only if in save_params.
+    dataset = random_dataset(T=25, P=50, S=80, F=2)
+    model_type = "sparse-skip-reparam"
+    captured = []
+
+    def capture(model, guide, *args, **kwargs):
+        captured.append((model, guide))
+        return {}
+
+    monkeypatch.setattr(pyrocov.mutrans, "predict", capture)
+    fit_svi(
+        dataset,
+        model_type=model_type,
+        guide_type=guide_type,
+        num_steps=3,
+        jit=False,
+        log_every=0,
+        rank=2,
+    )
+    ((model_, guide),) = captured
+
+    num_samples = 12
+    with pyro.plate("particles", num_samples, dim=-4):
+        samples = guide()
+    results = {}
+    for chunk_size in [1, 5, num_samples, 100]:
+        results[chunk_size] = predict(
+            model_,
+            ReplayGuide(guide, samples, chunk_size),
+            dataset,
+            model_type,
+            num_samples=num_samples,
+            save_params=save_params,
+            chunk_size=chunk_size,
+        )
+
+    expected = results[num_samples]
+    assert ("probs" in expected["mean"]) == ("probs" in save_params)
+    assert "rate" in expected["mean"]
+    if guide_type == "custom":
+        assert (expected["std"]["rate"] > 0).all()
+    for actual in results.values():
+        for key in ["median", "mean", "std"]:
+            assert set(actual[key]) == set(expected[key])
+            for name, value in expected[key].items():
+                assert value.shape == expected["median"][name].shape
+                assert torch.allclose(actual[key][name], value, atol=1e-5), name
+
+
+def fit_forecast_result(guide_type, model_type, **kwargs):
+    places = [f"place{i}" for i in range(8)]
+    strains = [f"strain{i}" for i in range(4)]
+    pyro.set_rng_seed(0)
+    dataset = keyed_dataset(places, strains, F=2)
+    result = fit_svi(
+        dataset,
+        model_type=model_type,
+        guide_type=guide_type,
+        num_steps=5,
+        jit=False,
+        log_every=0,
+        rank=2,
+        seed=0,
+        **kwargs,
+    )
+    result["location_id"] = dataset["location_id"]
+    result["lineage_id_inv"] = dataset["lineage_id_inv"]
+    return result
+
+
+@pytest.mark.parametrize("model_type", ["sparse-skip", "sparse-skip-reparam"])
+def test_forecast_map(model_type):
+    T = 5
+    result = fit_forecast_result("map", model_type, num_samples=3)
+    longer = fit_forecast_result("map", model_type, num_samples=3, forecast_steps=6)
+    assert longer["median"]["probs"].shape[0] == T + 6
+    forecast = Forecast.from_result(result)
+
+    # Forecasts match predictions, within and beyond the data.
+    actual = forecast.probs(range(T))
+    assert torch.allclose(actual["mean"], result["median"]["probs"], atol=1e-6)
+    assert torch.allclose(actual["mean"], result["mean"]["probs"], atol=1e-6)
+    assert (actual["std"] == 0).all()
+    actual = forecast.probs(range(T + 6))
+    assert torch.allclose(actual["mean"], longer["median"]["probs"], atol=1e-6)
+
+    # Subsets of places and strains match, by name or index.
+    subset = forecast.probs([1, 7], places=["place3", 5], strains=[2, "strain0"])
+    expected = longer["median"]["probs"][[1, 7]][:, [3, 5]][:, :, [2, 0]]
+    assert subset["mean"].shape == (2, 2, 2)
+    assert torch.allclose(subset["mean"], expected, atol=1e-6)
+
+
+def test_forecast_samples():
+    T = 5
+    result = fit_forecast_result(
+        "custom",
+        "sparse-skip-reparam",
+        num_samples=9,
+        forecast_steps=3,
+        forecast_samples=9,
+    )
+    assert result["samples"]["rate"].shape == (9, 8, 4)
+    forecast = Forecast.from_result(result, max_chunk_numel=100)
+
+    # Forecasts match moments of the same samples.
+    actual = forecast.probs(range(T + 3))
+    assert torch.allclose(actual["mean"], result["mean"]["probs"], atol=1e-5)
+    assert torch.allclose(actual["std"], result["std"]["probs"], atol=1e-5)
+    subset = forecast.probs([1, 7], places=["place3", 5], strains=[2, "strain0"])
+    expected = result["mean"]["probs"][[1, 7]][:, [3, 5]][:, :, [2, 0]]
+    assert torch.allclose(subset["mean"], expected, atol=1e-5)
+
+
+def test_forecast_cache(monkeypatch):
+    T, P, S = 5, 3, 4
+    forecast = Forecast(
+        torch.randn(P, S), torch.randn(P, S), torch.randn(T, P), cache_size=2
+    )
+    compute = Forecast._compute
+    calls = []
+
+    def counted_compute(self, *args):
+        calls.append(args)
+        return compute(self, *args)
+
+    monkeypatch.setattr(Forecast, "_compute", counted_compute)
+
+    # Repeated queries hit the cache, including equivalent times.
+    expected = forecast.probs(range(T))
+    assert forecast.probs(range(T)) is expected
+    assert forecast.probs(torch.arange(T)) is expected
+    assert len(calls) == 1
+    forecast.probs([0], places=[1])
+    assert forecast.probs(range(T)) is expected
+    assert len(calls) == 2
+
+    # The least recently used query is evicted.
+    forecast.probs([1], strains=[2])
+    assert len(calls) == 3
+    forecast.probs([0], places=[1])
+    assert len(calls) == 4
+    assert forecast.probs(range(T)) is not expected
+    assert len(calls) == 5
+
+
+def test_match_field():
+    codes = np.array([2, 0, 1, 2, 0])
+    values = ["Europe / France", "Asia / Japan", "Europe / Germany"]
+    actual = match_field((codes, values), "^Europe")
+    assert actual.tolist() == [True, True, False, True, True]
+
+
+@pytest.fixture
+def gisaid_columns(tmpdir):
+    """
+    Writes a small columnar store and feature file, returning their paths and
+    the rows as ``(day, location, lineage, virus_name)`` tuples.
+    """
+    locations = [
+        "Europe / France",
+        "Europe / Germany",
+        "Asia / Japan",
+        "Europe / France / Paris",  # Too rare to be a fine region.
+        "Antarctica",  # Not a valid location.
+    ]
+    lineages = ["B.1", "B.1.1.7", "AY.4", "B.1.2"]  # B.1.2 is unsampled.
+    rng = random.Random(0)
+    rows = []
+    for i in range(200):
+        location = rng.choice(locations)
+        virus_name = f"hCoV-19/{location.split(' / ')[-1]}/{i}/2021"
+        rows.append((rng.randrange(60), location, rng.choice(lineages), virus_name))
+    columns = {
+        name: [row[i] for row in rows]
+        for i, name in enumerate(["day", "location", "lineage", "virus_name"])
+    }
+    columns["day"] = np.array(columns["day"])
+    columns_dirname = os.path.join(tmpdir, "gisaid.columns")
+    save_columns(columns_dirname, columns, encode=["location", "lineage"])
+
+    features_filename = os.path.join(tmpdir, "nextclade.features.pt")
+    mutations = ["S:D614G", "S:N501Y", "ORF1a:T3255I", "S:L452R,S:T478K"]
+    torch.save(
+        {
+            "lineages": lineages[:3],
+            "mutations": mutations,
+            "features": torch.randn(3, len(mutations)),
+        },
+        features_filename,
+    )
+    return columns_dirname, features_filename, rows
+
+
+def expected_gisaid_data(rows, include, exclude, end_day, timestep=14):
+    # Naively bins rows one at a time.
+    lineage_id = {name: i for i, name in enumerate(["B.1", "B.1.1.7", "AY.4"])}
+    counts = Counter()
+    location_id = OrderedDict()
+    for day, location, lineage, virus_name in rows:
+        fields = {"location": location, "lineage": lineage, "virus_name": virus_name}
+        if not all(re.search(v, fields[k]) for k, v in include.items()):
+            continue
+        if any(re.search(v, fields[k]) for k, v in exclude.items()):
+            continue
+        if lineage not in lineage_id or location == "Antarctica":
+            continue
+        if end_day is not None and day > end_day:
+            continue
+        place = " / ".join(location.split(" / ")[:2])
+        location_id.setdefault(place, len(location_id))
+        counts[day // timestep, place, lineage_id[lineage]] += 1
+
+    # Drop places observed in fewer than two time bins.
+    times = {place: {t for t, p, _ in counts if p == place} for place in location_id}
+    places = [place for place in location_id if len(times[place]) >= 2]
+    T = 1 + (end_day if end_day is not None else max(r[0] for r in rows)) // timestep
+    weekly_strains = torch.zeros(T, len(places), len(lineage_id))
+    for (t, place, s), count in counts.items():
+        if place in places:
+            weekly_strains[t, places.index(place), s] = count
+    return weekly_strains, places
+
+
+@pytest.mark.parametrize(
+    "include, exclude",
+    [
+        ({}, {}),
+        ({"location": "^Europe"}, {}),
+        ({}, {"lineage": "^AY", "virus_name": "/1[0-9]/"}),
+        ({"virus_name": "France"}, {"location": "Paris"}),
+    ],
+)
+@pytest.mark.parametrize("end_day", [None, 30, 41])
+def test_load_gisaid_data(gisaid_columns, include, exclude, end_day):
+    columns_dirname, features_filename, rows = gisaid_columns
+    kwargs = dict(
+        gisaid_columns_dirname=columns_dirname,
+        nextclade_features_filename=features_filename,
+        include=include,
+        exclude=exclude,
+    )
+    expected, places = expected_gisaid_data(rows, include, exclude, end_day)
+    assert expected.sum() > 0
+
+    actual = load_gisaid_data(end_day=end_day, **kwargs)
+    assert torch.equal(actual["weekly_strains"], expected)
+    assert list(actual["location_id"]) == places
+    assert list(actual["location_id"].values()) == list(range(len(places)))
+    assert actual["lineage_id_inv"] == [
+        pangolin.compress(name) for name in ["B.1", "B.1.1.7", "AY.4"]
+    ]
+    assert actual["mutations"] == ["S:D614G", "S:N501Y", "ORF1a:T3255I"]
+    assert actual["features"].shape == (3, 3)
+
+    # Rebinning a daily dataset is equivalent to loading binned data.
+    daily = load_gisaid_daily(**kwargs)
+    for end_day in [None, 30, 41]:
+        expected, places = expected_gisaid_data(rows, include, exclude, end_day)
+        actual = rebin_gisaid_data(daily, end_day=end_day)
+        assert torch.equal(actual["weekly_strains"], expected)
+        assert list(actual["location_id"]) == places
+
+
+@pytest.mark.parametrize("rising", [False, True])
+def test_fit_svi_converge(monkeypatch, rising):
+    step = SVI.step
+    num_steps = [0]
+
+    def rising_step(self, *args, **kwargs):
+        num_steps[0] += 1
+        return step(self, *args, **kwargs) + 1e6 * num_steps[0]
+
+    if rising:
+        monkeypatch.setattr(SVI, "step", rising_step)
+
+    # A point estimate with zero learning rate has a flat loss.
+    dataset = random_dataset(T=5, P=4, S=3, F=2)
+    result = fit_svi(
+        dataset,
+        model_type="sparse-skip-reparam",
+        guide_type="map",
+        num_steps=30,
+        num_samples=3,
+        learning_rate=0.0,
+        jit=False,
+        log_every=0,
+        converge_window=5,
+        converge_patience=2,
+    )
+    if rising:
+        assert result["converged_step"] is None
+        assert len(result["losses"]) == 30
+    else:
+        assert result["converged_step"] == 14
+        assert len(result["losses"]) == 15
+        assert len(set(result["losses"])) == 1
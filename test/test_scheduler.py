@@ -0,0 +1,93 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+import json
+import os
+
+import pytest
+import torch
+
+from pyrocov.scheduler import Scheduler
+
+
+def add(x, y):
+    return x + y
+
+
+def save_square(x, filename):
+    torch.save(x * x, filename)
+    return x * x
+
+
+def save_namespace(filename):
+    result = {"args": argparse.Namespace(seed=0), "x": torch.ones(2)}
+    torch.save(result, filename)
+    return result
+
+
+def fail():
+    raise ValueError("expected")
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_scheduler(jobs):
+    calls = []
+
+    def load(x):
+        calls.append(x)
+        return torch.tensor(float(x))
+
+    scheduler = Scheduler(jobs=jobs, max_memory=2.0)
+    refs = []
+    for i in range(4):
+        data = scheduler.add(f"data.{i % 2}", load, i % 2, local=True)
+        refs.append(scheduler.add(f"add.{i}", add, data, i, memory=1.0))
+    assert scheduler.run(refs) == [0.0, 2.0, 2.0, 4.0]
+
+    # Shared loads are deduplicated, and intermediate results are released.
+    assert sorted(calls) == [0, 1]
+    assert set(scheduler.results) == {f"add.{i}" for i in range(4)}
+    assert all(scheduler.status[f"add.{i}"]["state"] == "done" for i in range(4))
+
+
+def test_resume(tmpdir):
+    status_file = os.path.join(tmpdir, "status.json")
+    filenames = [os.path.join(tmpdir, f"{i}.pt") for i in range(3)]
+
+    scheduler = Scheduler(status_file=status_file)
+    x = scheduler.add("x", torch.tensor, 2.0)
+    refs = [scheduler.add(f"y.{f}", save_square, x, f, filename=f) for f in filenames]
+    refs.append(scheduler.add("fail", fail))
+    with pytest.raises(ValueError):
+        scheduler.run(refs)
+    with open(status_file) as f:
+        status = json.load(f)
+    assert status["fail"]["state"] == "failed"
+    assert all(status[f"y.{f}"]["state"] == "done" for f in filenames)
+
+    # Completed tasks are loaded, without running their dependencies.
+    scheduler = Scheduler(status_file=status_file)
+    x = scheduler.add("x", fail)
+    refs = [scheduler.add(f"y.{f}", fail, x, filename=f) for f in filenames]
+    assert scheduler.run(refs) == [4.0] * 3
+
+    # Without resume, tasks are rerun.
+    scheduler = Scheduler(status_file=status_file, resume=False)
+    x = scheduler.add("x", fail)
+    refs = [scheduler.add(f"y.{f}", fail, x, filename=f) for f in filenames]
+    with pytest.raises(ValueError):
+        scheduler.run(refs)
+
+
+def test_resume_namespace(tmpdir):
+    status_file = os.path.join(tmpdir, "status.json")
+    filename = os.path.join(tmpdir, "result.pt")
+    scheduler = Scheduler(status_file=status_file)
+    scheduler.run([scheduler.add("fit", save_namespace, filename, filename=filename)])
+
+    # Results holding arbitrary pickled objects can be loaded on resume.
+    scheduler = Scheduler(status_file=status_file)
+    (result,) = scheduler.run([scheduler.add("fit", fail, filename=filename)])
+    assert result["args"] == argparse.Namespace(seed=0)
+    assert torch.equal(result["x"], torch.ones(2))
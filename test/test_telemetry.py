@@ -0,0 +1,71 @@
+# Copyright Contributors to the Pyro-Cov project.
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+
+import pytest
+import torch
+
+from pyrocov.telemetry import Telemetry
+
+
+def run(telemetry, x, start, end):
+    for step in range(start, end):
+        telemetry.begin_step(step)
+        loss = (x * step).pow(2).sum()
+        loss.backward()
+        telemetry.end_step(step, loss.item(), lambda: {"x0": x[0].detach()})
+        x.grad = None
+
+
+@pytest.mark.parametrize("every", [1, 3])
+def test_telemetry(tmpdir, every):
+    filename = os.path.join(tmpdir, "telemetry.jsonl")
+    x = torch.tensor([1.0, -2.0], requires_grad=True)
+    telemetry = Telemetry(10, every=every, filename=filename)
+    telemetry.watch({"x": x})
+    run(telemetry, x, 0, 10)
+    telemetry.flush()
+
+    series = telemetry.series()
+    steps = list(range(0, 10, every))
+    assert series["step"] == steps
+    assert series["loss"] == [5.0 * s ** 2 for s in steps]
+    assert series["x"] == [4.0 * s ** 2 for s in steps]
+    assert series["x0"] == [1.0] * len(steps)
+    assert len(series["time"]) == len(steps)
+
+    with open(filename) as f:
+        records = [json.loads(line) for line in f]
+    assert [r["step"] for r in records] == steps
+    assert [r["x"] for r in records] == series["x"]
+
+
+def test_resume():
+    x = torch.tensor([1.0, -2.0], requires_grad=True)
+    expected = Telemetry(10, every=2)
+    expected.watch({"x": x})
+    run(expected, x, 0, 10)
+
+    telemetry = Telemetry(10, every=2)
+    telemetry.watch({"x": x})
+    run(telemetry, x, 0, 5)
+    state = telemetry.state_dict()
+    telemetry = Telemetry(10, every=2)
+    telemetry.watch({"x": x})
+    telemetry.load_state_dict(state)
+    run(telemetry, x, 5, 10)
+
+    actual = telemetry.series()
+    for name, values in expected.series().items():
+        if name != "time":
+            assert actual[name] == values
+
+
+def test_disabled():
+    x = torch.tensor([1.0, -2.0], requires_grad=True)
+    telemetry = Telemetry(10, every=0)
+    telemetry.watch({"x": x})
+    run(telemetry, x, 0, 10)
+    assert telemetry.series() == {"step": [], "time": [], "loss": []}